@@ -24,6 +24,7 @@ del path
 # import pyblah.model.labelold as label
 from pyblah.model import label
 from pyblah.model import mmf
+from pyblah.model import fileio
 from pyblah.model import model
 from pyblah.util import dtw
 from pyblah.util import kld
@@ -40,7 +41,7 @@ class InterpolationPoint(object):
     A single interpolation point is a complete utterance.
     """
 
-    def __init__(self, modelfolder, labelfile, expand=False):
+    def __init__(self, modelfolder, labelfile, expand=False, dtype=None):
         """Loads models, labels and sets up necessary data structures."""
 
         self.expanded = expand
@@ -51,10 +52,13 @@ class InterpolationPoint(object):
         self.regions_to_pdf_ids = {}
 
         # load models and labels
-        self.model = model.HTSVoiceModel()
+        self.model = model.HTSVoiceModel(dtype=dtype)
         self.model.loadModel(modelfolder)
         logger.info("Loading label file " + labelfile)
         self.utterance = label.UtteranceLabel(labelfile)
+        # the questions are answered once for all labels and trees
+        self.contexts = [l.context for l in self.utterance.labels]
+        self.answers = self.model.answerMatrix(self.contexts)
 
         # classify the labels and get spectral macros
         self.mcep_macros = self.classify_labels(self.model.getMetaTree("mcep")
@@ -133,10 +137,10 @@ class InterpolationPoint(object):
         Returns resulting macros. 
         """
         ret = []
-        for l in self.utterance.labels:
+        classified = mtree.classifyLabels(self.contexts, self.answers)
+        for l, macros in zip(self.utterance.labels, classified):
             # Classify each level using all trees.
-            for tree in mtree.treeList:
-                macro = tree.classifyLabelString(l.context)
+            for macro in macros:
                 self.labels.append(l.phon)
                 self.macros_to_phones[macro] = l.phon
                 if store_regions:
@@ -144,14 +148,14 @@ class InterpolationPoint(object):
                 ret.append(macro)
                 try:
                     self.pdfs_to_phones[
-                       id(mmf.getMacro('~p', macro).mixture.pdfs[1])] = l.phon
+                       id(mmf.getTarget('~p', macro).mixture.pdfs[1])] = l.phon
                 except:
                     pass
         return ret
 
     def get_mixtures_for_macros(self, mmf, macronames):
         """Returns the PDF objects for a number of macronames."""
-        return [mmf.getMacro('~p', m).mixture for m in macronames]
+        return [mmf.getTarget('~p', m).mixture for m in macronames]
 
     def get_pdfs_for_macros(self, mmf, macronames, store_regions=False):
         """Returns the PDF objects for a number of macronames."""
@@ -159,7 +163,7 @@ class InterpolationPoint(object):
         i = 0
 
         for m in macronames:
-            pdf = mmf.getMacro('~p', m).mixture.pdfs[1]
+            pdf = mmf.getTarget('~p', m).mixture.pdfs[1]
             if store_regions:
                 region = self.macro_ids_to_region[i]
                 if region not in self.regions_to_pdf_ids:
@@ -176,7 +180,7 @@ class InterpolationPoint(object):
         for m in macronames:
             for i in range(1, 6):
                 # print "Trying macro " + m + " for stream " + str(i)
-                ret.append(mmf.getMacro('~s', m)[i].mixture.pdfs[1])
+                ret.append(mmf.getTarget('~s', m)[i].mixture.pdfs[1])
         return ret
 
 
@@ -544,11 +548,14 @@ def _pdf_kld_distance(pdf1, pdf2):
 #===============================================================================
 def main():
     if len(sys.argv) < 6:
-        sys.exit("Usage: python interpolate.py [-e] [-r regioninfo] <alpha> <model folder 1> <label file 1> <model folder 2> <label file 2> [<out cmp mmf> <out dur mmf> [<out map>]]")
+        sys.exit("Usage: python interpolate.py [-e] [-b] [-d] [-p precision] [-r regioninfo] <alpha> <model folder 1> <label file 1> <model folder 2> <label file 2> [<out cmp mmf> <out dur mmf> [<out map>]]")
 
     region_info_fn = None
     region_info = {}
     expand = False
+    binary = False
+    dedup = False
+    dtype = None
     more = True
 
     # arguments
@@ -558,6 +565,18 @@ def main():
             sys.argv = sys.argv[1:]
             expand = True
             print "Using expanded states"
+        elif sys.argv[1].strip() == "-b":
+            sys.argv = sys.argv[1:]
+            binary = True
+            print "Writing binary MMFs"
+        elif sys.argv[1].strip() == "-d":
+            sys.argv = sys.argv[1:]
+            dedup = True
+            print "Sharing repeated streams and vectors through macros"
+        elif sys.argv[1].strip() == "-p":
+            dtype = sys.argv[2]
+            print "Storing model parameters as " + dtype
+            sys.argv = sys.argv[2:]
         elif sys.argv[1].strip() == "-r":
             region_info_fn = sys.argv[2]
             print "Using region info from " + region_info_fn
@@ -583,8 +602,8 @@ def main():
                         , format='%(asctime)s %(name)-12s %(levelname)-8s %(message)s'
                         , datefmt='%m-%d %H:%M:%S')
     try:
-        ipoint1 = InterpolationPoint(mf1, lf1, expand)
-        ipoint2 = InterpolationPoint(mf2, lf2, expand)
+        ipoint1 = InterpolationPoint(mf1, lf1, expand, dtype)
+        ipoint2 = InterpolationPoint(mf2, lf2, expand, dtype)
     except model.FileLoadException as fle:
         sys.exit("Could not load file " + fle.filename)
 
@@ -599,8 +618,13 @@ def main():
     ipolator.set_region_info(region_info)
     (newMMF, newDurMMF) = ipolator.interpolate(ipoint1, ipoint2, float(alpha))
 
-    mmf.WriteMMF(open(outcmp, 'wt'), newMMF)
-    mmf.WriteMMF(open(outdur, 'wt'), newDurMMF)
+    # .gz/.xz output names are written compressed
+    for filename, mfile in ((outcmp, newMMF), (outdur, newDurMMF)):
+        outfile = fileio.openFile(filename, 'wb')
+        try:
+            mmf.WriteMMF(outfile, mfile, binary, dedup)
+        finally:
+            outfile.close()
 
     # Visualize results
     try:
@@ -0,0 +1,697 @@
+'''
+Throughput benchmarks for the model loaders.
+
+Runs on synthetic HTS style models so no voice is needed.
+Usage: python benchmark.py [-n <leaves>] [<benchmark> ...]
+       without names all benchmarks are run.
+'''
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+import collections
+
+import numpy
+
+import mmf
+import cache
+import fileio
+import mmfsimple
+import decisiontree
+
+BENCHMARKS = collections.OrderedDict()
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+def best_of(func, repeat=3):
+    """ returns (best wall time in seconds, result of the last call) """
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        result = func()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+def report(name, seconds, size=None, count=None, unit="items"):
+    line = "  %-34s %9.3f s" % (name, seconds)
+    if size:
+        line += "  %8.1f MB/s" % (size / seconds / 1e6)
+    if count:
+        line += "  %10.0f %s/s" % (count / seconds, unit)
+    print line
+
+#-------------------------------------------
+# synthetic models
+#-------------------------------------------
+def _vector(rnd, dim, scale=1.0):
+    return "".join([" %10.6e" % (rnd.gauss(0, 1) * scale) for i in xrange(dim)])
+
+def _variance(rnd, dim):
+    return "".join([" %10.6e" % (rnd.random() + 1e-3) for i in xrange(dim)])
+
+def synthetic_mmf(leaves=500, mcep=120, bndap=15, states=5, seed=1):
+    """ text of a clustered cmp MMF with `leaves` leaves per stream and state """
+    rnd = random.Random(seed)
+    out = ['~o\n<STREAMINFO> 5 %d 1 1 1 %d\n<MSDINFO> 5 0 1 1 1 0\n'
+           '<VECSIZE> %d<NULLD><USER><DIAGC>\n' % (mcep, bndap, mcep + 3 + bndap)]
+    for s, dim in enumerate([mcep, 1, 1, 1, bndap]):
+        out.append('~v "varFloor%d"\n<VARIANCE> %d\n%s\n' % (s + 1, dim, _variance(rnd, dim)))
+    for state in xrange(2, states + 2):
+        for i in xrange(1, leaves + 1):
+            out.append('~p "mcep_s%d_%d"\n<STREAM> 1\n<MEAN> %d\n%s\n<VARIANCE> %d\n%s\n'
+                       '<GCONST> %10.6e\n' % (state, i, mcep, _vector(rnd, mcep), mcep,
+                                              _variance(rnd, mcep), rnd.gauss(0, 100)))
+            for s in (2, 3, 4):
+                out.append('~p "logF0_s%d_%d-%d"\n<STREAM> %d\n<NUMMIXES> 2\n'
+                           '<MIXTURE> 1 %10.6e\n<MEAN> 1\n%s\n<VARIANCE> 1\n%s\n'
+                           '<GCONST> %10.6e\n<MIXTURE> 2 %10.6e\n<MEAN> 0\n'
+                           '<VARIANCE> 0\n<GCONST> 0.000000e+00\n' %
+                           (state, i, s, s, 0.9, _vector(rnd, 1), _variance(rnd, 1),
+                            rnd.gauss(0, 1), 0.1))
+            out.append('~p "bndap_s%d_%d"\n<STREAM> 5\n<MEAN> %d\n%s\n<VARIANCE> %d\n%s\n'
+                       '<GCONST> %10.6e\n' % (state, i, bndap, _vector(rnd, bndap), bndap,
+                                              _variance(rnd, bndap), rnd.gauss(0, 10)))
+    out.append('~t "trP_1"\n<TRANSP> %d\n' % (states + 2))
+    for i in xrange(states + 2):
+        out.append("".join([" %10.6e" % (1.0 if j == i + 1 else 0.0)
+                            for j in xrange(states + 2)]) + "\n")
+    for h in xrange(leaves):
+        out.append('~h "ctx%d"\n<BEGINHMM>\n<NUMSTATES> %d\n' % (h, states + 2))
+        for state in xrange(2, states + 2):
+            leaf = rnd.randint(1, leaves)
+            out.append('<STATE> %d\n~w "SWeightall"\n<STREAM> 1\n~p "mcep_s%d_%d"\n'
+                       '<STREAM> 2\n~p "logF0_s%d_%d-2"\n<STREAM> 3\n~p "logF0_s%d_%d-3"\n'
+                       '<STREAM> 4\n~p "logF0_s%d_%d-4"\n<STREAM> 5\n~p "bndap_s%d_%d"\n' %
+                       (state, state, leaf, state, leaf, state, leaf, state, leaf, state, leaf))
+        out.append('~t "trP_1"\n<ENDHMM>\n')
+    return "".join(out)
+
+def synthetic_mono_mmf(phones=50, mcep=120, bndap=15, states=5, seed=1):
+    """ text of a monophone cmp MMF (inline pdfs, one ~h per phone) """
+    rnd = random.Random(seed)
+    out = ['~o\n<STREAMINFO> 5 %d 1 1 1 %d\n<MSDINFO> 5 0 1 1 1 0\n'
+           '<VECSIZE> %d<NULLD><USER><DIAGC>\n' % (mcep, bndap, mcep + 3 + bndap)]
+    for p in xrange(phones):
+        out.append('~h "ph%d"\n<BEGINHMM>\n<NUMSTATES> %d\n' % (p, states + 2))
+        for state in xrange(2, states + 2):
+            out.append('<STATE> %d\n<SWEIGHTS> 5\n 1.0 1.0 1.0 1.0 0.0\n'
+                       '<STREAM> 1\n<MEAN> %d\n%s\n<VARIANCE> %d\n%s\n<GCONST> %10.6e\n' %
+                       (state, mcep, _vector(rnd, mcep), mcep, _variance(rnd, mcep),
+                        rnd.gauss(0, 100)))
+            for s in (2, 3, 4):
+                out.append('<STREAM> %d\n<NUMMIXES> 2\n<MIXTURE> 1 %10.6e\n<MEAN> 1\n%s\n'
+                           '<VARIANCE> 1\n%s\n<GCONST> %10.6e\n<MIXTURE> 2 %10.6e\n'
+                           '<MEAN> 0\n<VARIANCE> 0\n<GCONST> 0.000000e+00\n' %
+                           (s, 0.9, _vector(rnd, 1), _variance(rnd, 1), rnd.gauss(0, 1), 0.1))
+            out.append('<STREAM> 5\n<MEAN> %d\n%s\n<VARIANCE> %d\n%s\n<GCONST> %10.6e\n' %
+                       (bndap, _vector(rnd, bndap), bndap, _variance(rnd, bndap),
+                        rnd.gauss(0, 10)))
+        out.append('<TRANSP> %d\n' % (states + 2))
+        for i in xrange(states + 2):
+            out.append("".join([" %10.6e" % (1.0 if j == i + 1 else 0.0)
+                                for j in xrange(states + 2)]) + "\n")
+        out.append('<ENDHMM>\n')
+    return "".join(out)
+
+PHONES = ['sil', 'pau', 'a', 'e', 'i', 'o', 'u', 'b', 'd', 'f', 'g', 'k', 'l', 'm',
+          'n', 'p', 'r', 's', 't', 'v', 'z', 'sch', 'ch', 'ei', 'au']
+PHONE_CLASSES = [ ('Vowel', ['a', 'e', 'i', 'o', 'u', 'ei', 'au']),
+                  ('Plosive', ['b', 'd', 'g', 'k', 'p', 't']),
+                  ('Fricative', ['f', 's', 'v', 'z', 'sch', 'ch']),
+                  ('Sonorant', ['l', 'm', 'n', 'r']),
+                  ('Silence', ['sil', 'pau']) ]
+PHONE_POSITIONS = [ ('LL', '*%s^*'), ('L', '*^%s-*'), ('C', '*-%s+*'), ('R', '*+%s=*'),
+                    ('RR', '*=%s@*') ]
+
+def synthetic_questions():
+    """ text of an HTS question set on the quinphone and some counters """
+    out = []
+    for position, pattern in PHONE_POSITIONS:
+        for phone in PHONES:
+            out.append('QS %s-%s { "%s" }\n' % (position, phone, pattern % phone))
+        for name, phones in PHONE_CLASSES:
+            out.append('QS %s-%s { %s }\n' % (position, name, ",".join(
+                        [ '"%s"' % (pattern % phone) for phone in phones ])))
+    for field, pattern in (('Pos_C-Syl_in_C-Word(Fw)', '*@%s_*'),
+                           ('Num-Syls_in_C-Word', '*/B:%s-*'),
+                           ('Pos_C-Word_in_C-Phrase(Fw)', '*&%s-*')):
+        for n in xrange(1, 20):
+            # "<=n" questions, the one digit numbers through a wildcard
+            values = [ str(i) for i in xrange(1, n + 1) ]
+            if n >= 10:
+                values = ['?'] + values[9:]
+            out.append('QS %s<=%d { %s }\n' % (field, n, ",".join(
+                        [ '"%s"' % (pattern % v) for v in values ])))
+    return "".join(out)
+
+def synthetic_tree(leaves=500, states=5, seed=1):
+    """ text of an HTS tree file with `leaves` leaves per state """
+    rnd = random.Random(seed)
+    questions = synthetic_questions()
+    names = [ line.split()[1] for line in questions.splitlines() ]
+    out = [questions, '\n']
+    for state in xrange(2, states + 2):
+        lines = []
+        def build(n, leaf=[0]):
+            if n == 1:
+                leaf[0] += 1
+                return '"mcep_s%d_%d"' % (state, leaf[0])
+            code = -len(lines)
+            lines.append(None)
+            k = rnd.randint(1, n - 1)
+            no, yes = build(k), build(n - k)
+            lines[-code] = '%6d %s %6s %s' % (code, rnd.choice(names), no, yes)
+            return str(code)
+        build(leaves)
+        out.append('{*}[%d]\n{\n%s\n}\n\n' % (state, "\n".join(lines)))
+    return "".join(out)
+
+def synthetic_labels(count=1000, seed=1):
+    """ full context label strings matching synthetic_questions """
+    rnd = random.Random(seed)
+    return [ '%s^%s-%s+%s=%s@%d_%d/A:0_0_0/B:%d-%d-%d@%d-%d&%d-%d#%d-%d$1-4!0-2;0-2|0'
+             '/C:0+0+4/D:0_0/E:content+2@1+5&1+4#0+1/F:content_2/G:0_0/H:9=5@1=1|L-L%%'
+             '/I:0=0/J:9+5-1' % (
+            tuple( rnd.choice(PHONES) for i in xrange(5) ) +
+            tuple( rnd.randint(1, 15) for i in xrange(11) ))
+             for i in xrange(count) ]
+
+def write_tmp(content, suffix='.mmf'):
+    handle, name = tempfile.mkstemp(suffix=suffix)
+    os.write(handle, content)
+    os.close(handle)
+    return name
+
+#-------------------------------------------
+# benchmarks
+#-------------------------------------------
+def _drain(lexer):
+    count = 0
+    while lexer.get() is not None:
+        count += 1
+    return count
+
+def _parse(lexer_class, name):
+    f = open(name, 'rb')
+    try:
+        return mmf.ParseMMF(lexer_class(f))
+    finally:
+        f.close()
+
+@benchmark
+def bench_lexer(leaves):
+    """ tokenizer throughput, LineLexer (readline) vs Lexer (mmap cursor) """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    try:
+        for lexer_class in (mmf.LineLexer, mmf.Lexer):
+            def tokenize():
+                f = open(name, 'rb')
+                try:
+                    return _drain(lexer_class(f))
+                finally:
+                    f.close()
+            seconds, tokens = best_of(tokenize)
+            report("%s tokenize" % lexer_class.__name__, seconds, size, tokens, "tokens")
+        for lexer_class in (mmf.LineLexer, mmf.Lexer):
+            seconds, result = best_of(lambda: _parse(lexer_class, name))
+            report("%s ParseMMF" % lexer_class.__name__, seconds, size,
+                   len(result.getMacros('~p')), "~p")
+    finally:
+        os.remove(name)
+
+@benchmark
+def bench_lazy(leaves):
+    """ eager MMF vs lazy MMF (scan plus the models of one utterance) """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    models = ['ctx%d' % i for i in xrange(0, leaves, max(1, leaves // 40))]
+    try:
+        seconds, result = best_of(lambda: mmf.MMF(name))
+        report("eager", seconds, size)
+        seconds, result = best_of(lambda: mmf.MMF(name, lazy=True))
+        report("lazy scan", seconds, size)
+        def utterance():
+            model = mmf.MMF(name, lazy=True)
+            for m in models:
+                model.getMacro('~h', m)
+            return model
+        seconds, result = best_of(utterance)
+        report("lazy scan + %d models" % len(models), seconds, size)
+    finally:
+        os.remove(name)
+
+@benchmark
+def bench_compressed(leaves):
+    """ loading and writing a plain vs a gzip compressed MMF """
+    content = synthetic_mmf(leaves)
+    name = write_tmp(content)
+    zipped = name + '.gz'
+    try:
+        f = fileio.openFile(zipped, 'wb')
+        f.write(content)
+        f.close()
+        print "  plain %.1f MB, gzip %.1f MB" % (len(content) / 1e6, os.path.getsize(zipped) / 1e6)
+        for label, source in (("plain", name), ("gzip", zipped)):
+            seconds, model = best_of(lambda: mmf.MMF(source))
+            report("MMF %s" % label, seconds, len(content))
+        def write():
+            f = fileio.openFile(zipped, 'wb')
+            try:
+                mmf.WriteMMF(f, model)
+            finally:
+                f.close()
+        seconds, result = best_of(write)
+        report("WriteMMF gzip", seconds, len(content))
+    finally:
+        os.remove(name)
+        os.remove(zipped)
+
+@benchmark
+def bench_cache(leaves):
+    """ parsing the MMF vs loading it from a warm cache """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    cachedir = tempfile.mkdtemp()
+    try:
+        seconds, result = best_of(lambda: mmf.MMF(name))
+        report("parse", seconds, size)
+        cache.loadMMF(name, cachedir)
+        seconds, result = best_of(lambda: cache.loadMMF(name, cachedir))
+        report("warm cache", seconds, size)
+    finally:
+        os.remove(name)
+        shutil.rmtree(cachedir)
+
+@benchmark
+def bench_shared(leaves):
+    """ parsing the MMF in every worker vs attaching a published one """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    try:
+        seconds, model = best_of(lambda: mmf.MMF(name))
+        report("parse", seconds, size)
+        path = cache.publishMMF(model)
+        seconds, result = best_of(lambda: cache.publishMMF(model, path))
+    finally:
+        os.remove(name)
+    try:
+        report("publish", seconds)
+        seconds, result = best_of(lambda: cache.attachMMF(path))
+        report("attach", seconds, size)
+        print "  shared payload: %.1f MB" % (os.path.getsize(path + '.npy') / 1e6)
+    finally:
+        cache.unpublishMMF(path)
+
+@benchmark
+def bench_parallel(leaves):
+    """ serial parse vs process pool """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    try:
+        seconds, result = best_of(lambda: mmf.MMF(name))
+        report("serial", seconds, size)
+        for processes in (2, 4):
+            seconds, result = best_of(lambda: mmf.MMF(name, processes=processes))
+            report("%d processes" % processes, seconds, size)
+    finally:
+        os.remove(name)
+
+@benchmark
+def bench_select(leaves):
+    """ full load vs loading only the mcep ~p macros (include filter) """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    try:
+        seconds, result = best_of(lambda: mmf.MMF(name))
+        report("all macros", seconds, size)
+        seconds, result = best_of(lambda: mmf.MMF(name, lazy=True))
+        report("scan only", seconds, size)
+        mcep = mmf.MacroFilter(types=['~p'], streams=[1])
+        seconds, result = best_of(lambda: mmf.MMF(name, include=mcep))
+        report("mcep ~p (stream 1)", seconds, size, len(result.getMacros('~p')), "~p")
+        byname = mmf.MacroFilter(types=['~p'], names='mcep_')
+        seconds, result = best_of(lambda: mmf.MMF(name, include=byname))
+        report("mcep ~p (name)", seconds, size, len(result.getMacros('~p')), "~p")
+    finally:
+        os.remove(name)
+
+@benchmark
+def bench_iterparse(leaves):
+    """ mean of the ~p means: full load vs streaming iterparse """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    def loaded():
+        means = [ target.mixture.pdfs[1].means.mean()
+                  for target in mmf.MMF(name).getMacros('~p').itervalues() ]
+        return sum(means) / len(means)
+    def streamed():
+        means = [ target.mixture.pdfs[1].means.mean()
+                  for mtype, mname, target in mmf.iterparse(name, types=['~p']) ]
+        return sum(means) / len(means)
+    try:
+        seconds, result = best_of(loaded)
+        report("MMF", seconds, size)
+        seconds, streamedResult = best_of(streamed)
+        report("iterparse ~p", seconds, size)
+        assert abs(result - streamedResult) < 1e-6
+    finally:
+        os.remove(name)
+
+def _arrays(model):
+    """ the ~p means, variances and gconsts of model as float64 arrays,
+    and the bytes the parameter arrays take """
+    means, variances, gconsts, size = [], [], [], 0
+    for mname, macro in sorted(model.getMacros('~p').iteritems()):
+        for pdf in macro.target.mixture.pdfs.itervalues():
+            means.append(numpy.asarray(pdf.means, numpy.float64))
+            variances.append(numpy.asarray(pdf.variances, numpy.float64))
+            gconsts.append(float(pdf.gconst))
+            size += pdf.means.nbytes + pdf.variances.nbytes
+    return numpy.concatenate(means), numpy.concatenate(variances), numpy.array(gconsts), size
+
+@benchmark
+def bench_precision(leaves):
+    """ load time, ~p parameter memory and max relative error per storage dtype """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    try:
+        reference = _arrays(mmf.MMF(name, dtype=numpy.float64))
+        for dtype in (numpy.float16, numpy.float32, numpy.float64):
+            seconds, model = best_of(lambda: mmf.MMF(name, dtype=dtype))
+            report(numpy.dtype(dtype).name, seconds, size)
+            arrays = _arrays(model)
+            errors = []
+            for values, expected in zip(arrays[:3], reference[:3]):
+                nonzero = expected != 0
+                errors.append(numpy.abs(values[nonzero] / expected[nonzero] - 1).max())
+            print "  %-34s %9.2f MB  error means %.1e variances %.1e gconst %.1e" % (
+                "", arrays[3] / 1e6, errors[0], errors[1], errors[2])
+    finally:
+        os.remove(name)
+
+@benchmark
+def bench_contexts(leaves):
+    """ mmfsimple.loadFullMMF, reverse lookups and the size of the CSR context index """
+    name = write_tmp(synthetic_mmf(leaves * 10))
+    size = os.path.getsize(name)
+    def load():
+        model = mmfsimple.HTSMMF()
+        model.loadFullMMF(name)
+        return model
+    try:
+        seconds, model = best_of(load)
+    finally:
+        os.remove(name)
+    report("loadFullMMF", seconds, size, len(model.labelList), "contexts")
+    index = model.contextIndex
+    seconds, result = best_of(lambda: [ model.macroToLabels[m] for m in index.macros ])
+    report("macroToLabels[macro]", seconds, count=len(index.macros), unit="lookups")
+    seconds, result = best_of(lambda: [ index.contextsOf(m) for m in index.macros ])
+    report("contextsOf(macro)", seconds, count=len(index.macros), unit="lookups")
+    # the lists the index replaces: per context and per macro
+    perContext = [ label.associatedMacroNames for label in model.labelList ]
+    perMacro = dict( (m, model.macroToLabels[m]) for m in index.macros )
+    lists = sum( sys.getsizeof(l) for l in perContext + perMacro.values() ) + sys.getsizeof(perMacro)
+    print "  %d references: CSR arrays %.2f MB, dict of lists %.2f MB" % (
+        len(index.macroIds), index.nbytes() / 1e6, lists / 1e6)
+
+@benchmark
+def bench_mono(leaves):
+    """ mmfsimple.loadMonoMMF vs mmf.MMF on a monophone MMF (leaves/10 phones) """
+    name = write_tmp(synthetic_mono_mmf(max(1, leaves // 10)))
+    size = os.path.getsize(name)
+    def load():
+        model = mmfsimple.HTSMMF()
+        model.loadMonoMMF(name)
+        return model
+    try:
+        seconds, model = best_of(load)
+        report("loadMonoMMF", seconds, size, len(model.streamList), "streams")
+        seconds, result = best_of(lambda: mmf.MMF(name))
+        report("mmf.MMF", seconds, size)
+    finally:
+        os.remove(name)
+
+@benchmark
+def bench_diff(leaves):
+    """ mmf.diff vs finding the differing macros with != (two loads of the same MMF) """
+    name = write_tmp(synthetic_mmf(leaves))
+    try:
+        a, b = mmf.MMF(name), mmf.MMF(name)
+    finally:
+        os.remove(name)
+    for mname in sorted(b.getMacros('~p'))[::100]:
+        b.getTarget('~p', mname).mixture.pdfs[1].means[0] += 1e-3
+    count = sum( len(a.getMacros(mtype)) for mtype in a.macros )
+    def unequal():
+        return [ mname for mtype in a.macros for mname, macro in a.getMacros(mtype).iteritems()
+                 if macro != b.getMacro(mtype, mname) ]
+    def compare():
+        a.pdfTables.clear()
+        b.pdfTables.clear()
+        return mmf.diff(a, b)
+    seconds, result = best_of(unequal)
+    report("!= per macro", seconds, count=count, unit="macros")
+    seconds, result = best_of(compare)
+    report("diff", seconds, count=count, unit="macros")
+    print "  changed ~p: %d" % sum( len(d.changed) for d in result if d.macroType == '~p' )
+
+def _regex_classify(tree, labelString):
+    """ DecisionTree.classifyLabelString before compiled questions """
+    node = tree.root
+    while node.macroName == "":
+        found = False
+        for ca in tree.questionsDict[node.question]:
+            if decisiontree.re.search(decisiontree.re.escape(ca.strip("\"*")).replace("\?", "."),
+                                      labelString) is not None:
+                found = True
+                break
+        node = node.right if found else node.left
+    return node.macroName
+
+@benchmark
+def bench_classify(leaves):
+    """ classifying labels against the state trees: compiled questions vs a regex per pattern """
+    name = write_tmp(synthetic_tree(leaves), '.inf')
+    try:
+        def perState():
+            for state in range(2, 7):
+                decisiontree.DecisionTree().load(name, state)
+        seconds, result = best_of(perState)
+        report("DecisionTree.load per state", seconds, os.path.getsize(name))
+        def load():
+            metatree = decisiontree.MetaTree()
+            metatree.loadTrees(name)
+            return metatree
+        seconds, metatree = best_of(load)
+        report("MetaTree.loadTrees", seconds, os.path.getsize(name))
+    finally:
+        os.remove(name)
+    labels = synthetic_labels()
+    count = len(labels) * len(metatree.treeList)
+    seconds, regex = best_of(lambda: [ [ _regex_classify(tree, l) for tree in metatree.treeList ]
+                                        for l in labels ])
+    report("regex per pattern", seconds, count=count, unit="labels")
+    seconds, compiled = best_of(lambda: map(metatree.classifyLabelString, labels))
+    report("compiled questions", seconds, count=count, unit="labels")
+    assert compiled == regex
+
+@benchmark
+def bench_voice(leaves):
+    """ classifying labels against the 4 MetaTrees of a voice: a question set per tree vs one shared """
+    names = [ write_tmp(synthetic_tree(leaves, states, seed), '.inf')
+              for seed, states in ((1, 5), (2, 5), (3, 5), (4, 1)) ]
+    try:
+        separate = [ decisiontree.MetaTree() for name in names ]
+        questionSet = decisiontree.QuestionSet()
+        shared = [ decisiontree.MetaTree(questionSet) for name in names ]
+        for metatree, name in zip(separate + shared, names + names):
+            metatree.loadTrees(name, range(2, 2 + (1 if name is names[-1] else 5)))
+    finally:
+        for name in names:
+            os.remove(name)
+    labels = synthetic_labels()
+    print "  %d questions, %d field lookups" % (len(questionSet.questions),
+                                                  len(questionSet.layout.contexts))
+    count = len(labels) * sum( len(metatree.treeList) for metatree in shared )
+    def classify(metatrees, answers):
+        return [ [ metatree.classifyLabelString(l, answers(l)) for metatree in metatrees ]
+                 for l in labels ]
+    seconds, result = best_of(lambda: classify(separate, lambda l: None))
+    report("question set per MetaTree", seconds, count=count, unit="labels")
+    seconds, sharedResult = best_of(lambda: classify(shared, questionSet.answers))
+    report("shared question set", seconds, count=count, unit="labels")
+    assert sharedResult == result
+
+@benchmark
+def bench_batch(leaves):
+    """ classifying 10000 labels against the 4 MetaTrees of a voice: per label vs FlatTree batches """
+    names = [ write_tmp(synthetic_tree(leaves, states, seed), '.inf')
+              for seed, states in ((1, 5), (2, 5), (3, 5), (4, 1)) ]
+    try:
+        questionSet = decisiontree.QuestionSet()
+        metatrees = [ decisiontree.MetaTree(questionSet) for name in names ]
+        for metatree, name in zip(metatrees, names):
+            metatree.loadTrees(name, range(2, 2 + (1 if name is names[-1] else 5)))
+    finally:
+        for name in names:
+            os.remove(name)
+    labels = synthetic_labels(10000)
+    count = len(labels) * sum( len(metatree.treeList) for metatree in metatrees )
+    def perLabel():
+        result = []
+        for l in labels:
+            answers = questionSet.answers(l)
+            result.append([ metatree.classifyLabelString(l, answers) for metatree in metatrees ])
+        return result
+    seconds, result = best_of(perLabel, 1)
+    report("per label", seconds, count=count, unit="labels")
+    seconds, flats = best_of(lambda: [ [ tree.flatTree() for tree in metatree.treeList ]
+                                       for metatree in metatrees ], 1)
+    numbers = set()
+    for flat in sum(flats, []):
+        numbers.update(flat.questionNumbers())
+    seconds, answers = best_of(lambda: questionSet.answerMatrix(labels, numbers))
+    print "  %d of %d questions asked" % (len(numbers), len(questionSet.questions))
+    report("answer matrix", seconds, count=len(labels) * len(numbers), unit="answers")
+    seconds, leaves = best_of(lambda: [ flat.classify(answers) for flat in sum(flats, []) ])
+    report("FlatTree.classify", seconds, count=count, unit="labels")
+    seconds, batch = best_of(lambda: [ metatree.classifyLabels(labels, answers)
+                                       for metatree in metatrees ])
+    report("MetaTree.classifyLabels with names", seconds, count=count, unit="labels")
+    assert map(list, zip(*batch)) == result
+
+@benchmark
+def bench_write(leaves):
+    """ WriteMMF text (with and without keepSource) and binary, loading both """
+    name = write_tmp(synthetic_mmf(leaves))
+    size = os.path.getsize(name)
+    out = name + '.out'
+    try:
+        for keepSource in (False, True):
+            model = mmf.MMF(name, keepSource=keepSource)
+            def write():
+                f = open(out, 'wb')
+                try:
+                    mmf.WriteMMF(f, model)
+                finally:
+                    f.close()
+            seconds, result = best_of(write)
+            report("WriteMMF%s" % (" keepSource" if keepSource else ""), seconds,
+                   os.path.getsize(out), len(model.getMacros('~p')), "~p")
+        def write_binary():
+            f = open(out, 'wb')
+            try:
+                mmf.WriteMMF(f, model, binary=True)
+            finally:
+                f.close()
+        seconds, result = best_of(write_binary)
+        report("WriteMMF binary", seconds, os.path.getsize(out),
+               len(model.getMacros('~p')), "~p")
+        print "  text %.1f MB, binary %.1f MB" % (size / 1e6, os.path.getsize(out) / 1e6)
+        for source in (name, out):
+            seconds, result = best_of(lambda: mmf.MMF(source))
+            report("MMF(%s)" % ("binary" if source == out else "text"), seconds,
+                   os.path.getsize(source))
+    finally:
+        os.remove(name)
+        if os.path.exists(out):
+            os.remove(out)
+
+class _DictMacro:
+    """ the former Macro: old style, attributes in a __dict__ """
+    def __init__(self, macroType, macroId, target=None):
+        self.macroType = macroType
+        self.macroId = macroId
+        self.target = target
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+@benchmark
+def bench_dedup(leaves):
+    """ WriteMMF of an interpolated style HMM (inline streams) with and without dedup """
+    name = write_tmp(synthetic_mmf(leaves))
+    try:
+        model = mmf.MMF(name)
+    finally:
+        os.remove(name)
+    resolved = model.resolve()['~p']
+    rnd = random.Random(1)
+    states = {}
+    # 10 states per label, consecutive ones often from the same leaves
+    for n in xrange(2, 2 + 10 * leaves // 5):
+        leaf = rnd.randint(1, leaves // 10 or 1)
+        states[n] = mmf.State(n, dict(
+            (s, mmf.Stream(s, resolved[pdf % (2 + n % 5, leaf)].mixture))
+            for s, pdf in ((1, 'mcep_s%d_%d'), (2, 'logF0_s%d_%d-2'), (3, 'logF0_s%d_%d-3'),
+                           (4, 'logF0_s%d_%d-4'), (5, 'bndap_s%d_%d')) ), None)
+    out = mmf.MMF()
+    out.findOrDeclareMacro('~o', '').setTarget(model.getTarget('~o', ''))
+    out.findOrDeclareMacro('~h', 'utterance').setTarget(
+        mmf.HMM(len(states) + 2, states, model.getMacro('~t', 'trP_1')))
+    out.findOrDeclareMacro('~t', 'trP_1').setTarget(model.getTarget('~t', 'trP_1'))
+    tmp = write_tmp('')
+    try:
+        for dedup in (False, True):
+            def write():
+                f = open(tmp, 'wb')
+                try:
+                    mmf.WriteMMF(f, out, dedup=dedup)
+                finally:
+                    f.close()
+            seconds, result = best_of(write)
+            report("WriteMMF%s" % (" dedup" if dedup else ""), seconds,
+                   count=len(states), unit="states")
+            print "  %.1f MB" % (os.path.getsize(tmp) / 1e6)
+            seconds, result = best_of(lambda: mmf.MMF(tmp))
+            report("  MMF() of the result", seconds, os.path.getsize(tmp))
+    finally:
+        os.remove(tmp)
+
+@benchmark
+def bench_access(leaves):
+    """ ~p pdf lookups through Macro forwarding, targets and resolve(); Macro size """
+    name = write_tmp(synthetic_mmf(leaves))
+    try:
+        model = mmf.MMF(name)
+    finally:
+        os.remove(name)
+    macros = model.getMacros('~p')
+    names = sorted(macros) * 20
+    olds = dict( (m, _DictMacro('~p', m, macros[m].target)) for m in macros )
+    seconds, resolved = best_of(lambda: model.resolve())
+    report("resolve()", seconds, count=len(macros), unit="~p")
+    resolved = resolved['~p']
+    for label, lookup in (
+        ("dict based Macro forwarding", lambda m: olds[m].mixture.pdfs[1]),
+        ("Macro forwarding", lambda m: macros[m].mixture.pdfs[1]),
+        ("Macro.target", lambda m: macros[m].target.mixture.pdfs[1]),
+        ("resolve() view", lambda m: resolved[m].mixture.pdfs[1]),
+        ("MMF.getMacro", lambda m: model.getMacro('~p', m).mixture.pdfs[1]),
+        ("MMF.getTarget", lambda m: model.getTarget('~p', m).mixture.pdfs[1]),
+        ):
+        seconds, result = best_of(lambda: map(lookup, names))
+        report(label, seconds, count=len(names), unit="lookups")
+    old = _DictMacro('~p', 'name')
+    print "  Macro: %d bytes, dict based: %d bytes (object and __dict__)" % (
+        sys.getsizeof(mmf.Macro('~p', 'name')), sys.getsizeof(old) + sys.getsizeof(old.__dict__))
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    leaves = 500
+    if args[:1] == ['-n']:
+        leaves = int(args[1])
+        args = args[2:]
+    for name in (args or BENCHMARKS.keys()):
+        if name not in BENCHMARKS:
+            sys.exit("unknown benchmark %s, available: %s" % (name, " ".join(BENCHMARKS)))
+        print "%s (%d leaves): %s" % (name, leaves, BENCHMARKS[name].__doc__.strip())
+        BENCHMARKS[name](leaves)
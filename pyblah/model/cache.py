@@ -0,0 +1,399 @@
+'''
+On-disk cache of parsed models.
+
+Parsing the MMFs and trees of a voice from text takes seconds, loading
+them from the cache mostly consists of paging in the numeric payload.
+A cache entry of a source file consists of two files:
+
+  <key>.rec          header (CACHE_VERSION, size, mtime and sha1 of the
+                     source) followed by the encoded object structure,
+                     both marshalled (much faster to load than pickles)
+  <key>.<token>.npy  all numpy arrays of the object concatenated into one
+                     byte array, memory-mapped (copy on write) on load
+
+Entries are checked against the source on every load: matching size and
+mtime are accepted right away, otherwise the content hash decides, so
+touching a file does not force a rebuild but changing it does.  Stale,
+broken or outdated (CACHE_VERSION) entries are rebuilt.
+
+The same encoding is used to share a parsed MMF between processes:
+publishMMF writes it to <path>.rec and <path>.npy (in /dev/shm by
+default, so nothing goes to disk) and attachMMF maps it read-only, the
+numeric payload is then held once in the page cache for all workers.
+'''
+
+import gc
+import os
+import sys
+import glob
+import hashlib
+import collections
+import logging
+import tempfile
+import marshal
+
+import numpy
+
+import mmf
+import decisiontree
+
+logger = logging.getLogger("cache")
+
+# bump whenever the encoding changes, older entries are rebuilt then
+CACHE_VERSION = 2
+# payload offsets are aligned for every numpy dtype
+ALIGNMENT = 16
+# the marshal format may change between python versions
+PYTHON = "%d.%d" % sys.version_info[:2]
+
+# model classes encoded slot by slot
+OBJECTS = dict( (cls.__name__, cls) for cls in
+                (mmf.GlobalOption, mmf.PDF, mmf.Mixture, mmf.Stream, mmf.State, mmf.HMM) )
+CLASSES = frozenset(OBJECTS.itervalues())
+# values stored as they are
+PLAIN = frozenset([ type(None), bool, int, long, float, str, unicode ])
+
+class NoGC(object):
+    """ with NoGC(): runs a block without the cyclic garbage collector,
+    which otherwise runs over and over while the many (long living)
+    records and model objects are created """
+    def __enter__(self):
+        self.enabled = gc.isenabled()
+        gc.disable()
+    def __exit__(self, *exc_info):
+        if self.enabled:
+            gc.enable()
+
+def cacheDir():
+    """ $PYBLAH_CACHE_DIR, else $XDG_CACHE_HOME/pyblah, else ~/.cache/pyblah """
+    if os.environ.get('PYBLAH_CACHE_DIR'):
+        return os.environ['PYBLAH_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'pyblah')
+
+def fileHash(filename):
+    sha = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        for block in iter(lambda: f.read(1 << 20), ''):
+            sha.update(block)
+    finally:
+        f.close()
+    return sha.hexdigest()
+
+def entryName(filename, kind, cachedir=None):
+    """ path (without extension) of the entry for filename loaded as kind """
+    key = hashlib.sha1("%s\0%s" % (os.path.abspath(filename), kind)).hexdigest()
+    return os.path.join(cachedir or cacheDir(), key)
+
+#-------------------------------------------
+# encoding
+#-------------------------------------------
+class Encoder(object):
+    """ turns model objects into tuples of builtins, the numpy arrays are
+    replaced by references into a single payload and numpy scalars by
+    indices into one array per dtype (pickling them one by one is slow) """
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+        self.scalars = collections.defaultdict(list)
+
+    def array(self, value):
+        offset = self.size
+        self.arrays.append( (offset, value) )
+        self.size += (value.nbytes + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        return ('a', value.dtype.str, offset, value.shape)
+
+    def encode(self, value):
+        kind = type(value)
+        if kind in PLAIN:
+            return value
+        if kind is dict:
+            return ('d', [ (k, self.encode(v)) for k, v in value.iteritems() ])
+        if kind in CLASSES:
+            return ('o', kind.__name__, [ self.encode(getattr(value, slot))
+                                          for slot in kind.__slots__ ])
+        if isinstance(value, numpy.ndarray) and value.shape:
+            return self.array(value)
+        if isinstance(value, numpy.ndarray): # 0-d views of a PDFTable
+            value = value[()]
+        if isinstance(value, numpy.generic):
+            scalars = self.scalars[value.dtype.str]
+            scalars.append(value)
+            return ('s', value.dtype.str, len(scalars) - 1)
+        if isinstance(value, mmf.Macro):
+            return ('m', value.macroType, value.macroId)
+        return value
+
+    def payload(self):
+        """ the arrays as one uint8 array """
+        payload = numpy.zeros(max(self.size, ALIGNMENT), dtype=numpy.uint8)
+        for offset, value in self.arrays:
+            data = numpy.ascontiguousarray(value).reshape(-1).view(numpy.uint8)
+            payload[offset:offset + data.size] = data
+        return payload
+
+    def scalarTable(self):
+        return dict( (dtype, numpy.array(values, dtype=dtype).tostring())
+                     for dtype, values in self.scalars.iteritems() )
+
+def Decoder(payload, scalars, context):
+    """ returns the inverse of Encoder.encode: arrays become views of
+    payload and macro references are declared in the MMF context """
+    ndarray = numpy.ndarray
+    declare = context.findOrDeclareMacro
+    def decode(value):
+        tag = value[0]
+        if tag == 'a':
+            return ndarray(value[3], value[1], payload, value[2])
+        elif tag == 's':
+            return scalars[value[1]][value[2]]
+        elif tag == 'm':
+            return declare(value[1], value[2])
+        elif tag == 'd':
+            return dict( [ (k, decode(v) if type(v) is tuple else v) for k, v in value[1] ] )
+        elif tag == 'o':
+            cls = OBJECTS[value[1]]
+            obj = cls.__new__(cls)
+            for slot, v in zip(cls.__slots__, value[2]):
+                setattr(obj, slot, decode(v) if type(v) is tuple else v)
+            return obj
+        raise ValueError("unknown cache record %r" % (tag,))
+    return lambda value: decode(value) if type(value) is tuple else value
+
+def encodeMMF(mfile, encoder):
+    mfile.loadAll()
+    macros = [ (mtype, mname, encoder.encode(macro.target))
+               for mtype, macros in mfile.macros.iteritems()
+               for mname, macro in macros.iteritems() ]
+    return macros, encoder.scalarTable()
+
+def decodeMMF(records, payload, mfile=None):
+    """ the MMF of records, the macros are added to mfile if given """
+    macros, scalars = records
+    scalars = dict( (dtype, numpy.frombuffer(values, dtype))
+                    for dtype, values in scalars.iteritems() )
+    if mfile is None:
+        mfile = mmf.MMF()
+    decode = Decoder(payload, scalars, mfile)
+    for mtype, mname, target in macros:
+        macro = mfile.findOrDeclareMacro(mtype, mname)
+        if target is not None: # dangling ones may be defined by other records
+            macro.setTarget( decode(target))
+    return mfile
+
+def encodeMetaTree(metatree, encoder):
+    """ the question tables of the trees (once each, trees loaded from one
+    file share theirs) and the trees referring to them """
+    tables, index = [], {}
+    for tree in metatree.treeList:
+        if id(tree.questionsDict) not in index:
+            index[id(tree.questionsDict)] = len(tables)
+            tables.append(tree.questionsDict)
+    return tables, [ (tree.state, tree.stream, index[id(tree.questionsDict)],
+                      [ (n.code, n.question, n.leftCode, n.rightCode) for n in tree.nodeList ])
+                     for tree in metatree.treeList ]
+
+def decodeMetaTree(records, payload, questionSet=None):
+    metatree = decisiontree.MetaTree(questionSet)
+    tables, trees = records
+    compiled = {}   # table -> questions
+    for state, stream, table, nodes in trees:
+        tree = decisiontree.DecisionTree(metatree.questionSet)
+        tree.state, tree.stream, tree.questionsDict = state, stream, tables[table]
+        for code, question, leftCode, rightCode in nodes:
+            n = tree.Node()
+            n.code, n.question, n.leftCode, n.rightCode = code, question, leftCode, rightCode
+            tree.nodeList.append(n)
+            tree.nodeDict[code] = n
+        if tree.nodeList:
+            tree.root = tree.nodeList[0]
+            tree.buildStateTree(state)
+        if table in compiled:
+            tree.questions = compiled[table]
+        else:
+            tree.compileQuestions()
+            compiled[table] = tree.questions
+        metatree.addStateTree(tree)
+    return metatree
+
+#-------------------------------------------
+# entries
+#-------------------------------------------
+def readEntry(entry, filename):
+    """ returns (header, records, payload, touched) of a valid entry, else
+    None; touched is set if only the mtime of the source changed """
+    try:
+        f = open(entry + '.rec', 'rb')
+    except IOError:
+        return None
+    try:
+        header = marshal.load(f)
+        st = os.stat(filename)
+        if header.get('version') != CACHE_VERSION or header.get('python') != PYTHON or \
+           header['size'] != st.st_size:
+            return None
+        touched = header['mtime'] != st.st_mtime
+        if touched:
+            if header['sha1'] != fileHash(filename):
+                return None
+            header['mtime'] = st.st_mtime
+        records = marshal.load(f)
+    finally:
+        f.close()
+    payload = numpy.load(os.path.join(os.path.dirname(entry), header['payload']),
+                         mmap_mode='c')
+    return header, records, numpy.asarray(payload), touched
+
+def writeEntry(entry, header, records, payload=None):
+    """ writes entry atomically; a new payload gets a new file name so
+    readers of the previous entry are not disturbed, the previous
+    payload is removed afterwards """
+    directory = os.path.dirname(entry)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if payload is not None:
+        handle, name = tempfile.mkstemp(dir=directory, prefix=os.path.basename(entry) + '.',
+                                        suffix='.npy')
+        f = os.fdopen(handle, 'wb')
+        try:
+            numpy.save(f, payload)
+        finally:
+            f.close()
+        header['payload'] = os.path.basename(name)
+    handle, name = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    f = os.fdopen(handle, 'wb')
+    try:
+        marshal.dump(header, f)
+        marshal.dump(records, f)
+    finally:
+        f.close()
+    os.rename(name, entry + '.rec')
+    for old in glob.glob(entry + '.*.npy'):
+        if os.path.basename(old) != header['payload']:
+            try:
+                os.remove(old)
+            except OSError:
+                pass
+
+def sharedDir():
+    """ $PYBLAH_SHARED_DIR, else /dev/shm if present, else the temp dir """
+    if os.environ.get('PYBLAH_SHARED_DIR'):
+        return os.environ['PYBLAH_SHARED_DIR']
+    if os.path.isdir('/dev/shm'):
+        return '/dev/shm'
+    return tempfile.gettempdir()
+
+def publishMMF(mfile, path=None):
+    """ writes mfile for attachMMF and returns the path to attach it by
+    (a new name in sharedDir() if path is not given) """
+    if path is None:
+        handle, path = tempfile.mkstemp(dir=sharedDir(), prefix='pyblah-mmf-')
+        os.close(handle)
+        os.remove(path)
+    encoder = Encoder()
+    with NoGC():
+        records = encodeMMF(mfile, encoder)
+    # the payload first, so <path>.rec never refers to a missing one
+    handle, name = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    f = os.fdopen(handle, 'wb')
+    try:
+        numpy.save(f, encoder.payload())
+    finally:
+        f.close()
+    os.rename(name, path + '.npy')
+    header = dict(version=CACHE_VERSION, python=PYTHON, kind='shared mmf',
+                  payload=os.path.basename(path) + '.npy')
+    writeEntry(path, header, records)
+    return path
+
+def attachMMF(path):
+    """ the MMF published at path, its arrays are read-only views of the
+    shared payload """
+    with NoGC():
+        f = open(path + '.rec', 'rb')
+        try:
+            header = marshal.load(f)
+            if header.get('version') != CACHE_VERSION or header.get('python') != PYTHON:
+                raise ValueError("%s was published by another version" % path)
+            records = marshal.load(f)
+        finally:
+            f.close()
+        payload = numpy.asarray(numpy.load(path + '.npy', mmap_mode='r'))
+        return decodeMMF(records, payload)
+
+def unpublishMMF(path):
+    """ removes a published MMF, attached processes keep their mapping """
+    for name in (path + '.rec', path + '.npy'):
+        try:
+            os.remove(name)
+        except OSError:
+            pass
+
+def load(filename, kind, build, encode, decode, cachedir=None):
+    """ returns decode(records, payload) of the entry for filename, or the
+    result of build() after storing it in the cache """
+    entry = entryName(filename, kind, cachedir)
+    with NoGC():
+        try:
+            cached = readEntry(entry, filename)
+        except Exception as e:
+            logger.warning("Ignoring broken cache entry %s: %s" % (entry, e))
+            cached = None
+        if cached is not None:
+            header, records, payload, touched = cached
+            logger.info("Loading %s from cache: %s" % (filename, entry))
+            try:
+                result = decode(records, payload)
+            except Exception as e:
+                logger.warning("Ignoring broken cache entry %s: %s" % (entry, e))
+                cached = None
+        if cached is not None:
+            if touched: # store the new mtime to skip hashing next time
+                try:
+                    writeEntry(entry, header, records)
+                except EnvironmentError as e:
+                    logger.warning("Could not write cache entry %s: %s" % (entry, e))
+            return result
+
+    # stat again after build: a file changed meanwhile is not stored
+    st = os.stat(filename)
+    header = dict(version=CACHE_VERSION, python=PYTHON, kind=kind, size=st.st_size,
+                  mtime=st.st_mtime, sha1=fileHash(filename))
+    result = build()
+    st = os.stat(filename)
+    if (st.st_size, st.st_mtime) != (header['size'], header['mtime']):
+        logger.warning("%s changed while loading, not caching it" % filename)
+        return result
+    encoder = Encoder()
+    with NoGC():
+        records = encode(result, encoder)
+    try:
+        writeEntry(entry, header, records, encoder.payload())
+    except EnvironmentError as e:
+        logger.warning("Could not write cache entry %s: %s" % (entry, e))
+    return result
+
+def loadMMF(filename, cachedir=None, dtype=None):
+    """ mmf.MMF(filename, dtype=dtype), from the cache if possible; each
+    dtype has its own entry """
+    kind = 'mmf' if dtype is None else 'mmf %s' % numpy.dtype(dtype).name
+    def decode(records, payload):
+        mfile = decodeMMF(records, payload)
+        if dtype is not None:
+            mfile.dtype = numpy.dtype(dtype).type
+        return mfile
+    return load(filename, kind, lambda: mmf.MMF(filename, dtype=dtype),
+                encodeMMF, decode, cachedir)
+
+def loadMetaTree(filename, stateRange, cachedir=None, questionSet=None):
+    """ a MetaTree with the trees of stateRange in filename, from the
+    cache if possible; its questions are added to questionSet if given
+    (see decisiontree.QuestionSet) """
+    def build():
+        metatree = decisiontree.MetaTree(questionSet)
+        metatree.loadTrees(filename, stateRange)
+        return metatree
+    return load(filename, 'tree %r' % list(stateRange), build, encodeMetaTree,
+                lambda records, payload: decodeMetaTree(records, payload, questionSet),
+                cachedir)
@@ -3,22 +3,81 @@
 import re
 import sys
 
+import numpy
+
+import fileio
+import label
+
+# i.e.: QS Pos_C-Syl_in_C-Phrase(Bw)<=12 { "*-?#*","*-10#*","*-11#*","*-12#*" }
+QUESTION_LINE = re.compile( r'QS\s+([^{]+){([^}]+).*' )
+# i.e.:                   -29   L-sil    -51   "mcep_s2_1"
+NODE_LINE = re.compile( r'([0-9-]+)\s+(\S+)\s+(\S+)\s+(\S+)' )
+
+def loadStateTrees(path, trees):
+    """ reads the trees of a tree file in one pass: trees maps state
+    numbers to the (empty) DecisionTrees to fill, they share the question
+    table of the file """
+    questionsDict = {}
+    currentTree = None
+    for state, tree in trees.iteritems():
+        tree.state = state
+        tree.questionsDict = questionsDict
+    
+    treeFile = fileio.openFile(path)
+    for line in treeFile:
+        line = line.strip()
+        # Question definition
+        if line.startswith( 'QS' ):
+            m = QUESTION_LINE.match( line )
+            if m is not None:
+                questionsDict[ m.group(1).strip() ] =  [ x.strip().strip("\"") for x in m.group(2).split(",") ]
+        # begin of section - state and stream info, i.e. {*}[2].stream[1]
+        elif line.startswith( '{*}[' ):
+            try:
+                currentTree = trees.get( int( line[4:line.find(']')] ) )
+            except ValueError:
+                currentTree = None
+        # begin of tree structure info   
+        elif line == '{':
+            continue
+        # end of tree structure info  
+        elif line == '}' and currentTree is not None:
+            currentTree.buildStateTree( currentTree.state )
+            currentTree = None
+        # tree structure line                
+        elif currentTree is not None:
+            currentTree._handleLine( currentTree.state, line )
+    treeFile.close()
+
+    compiled = {}   # id of a QuestionSet -> questions
+    for tree in trees.itervalues():
+        questions = compiled.get( id(tree.questionSet) )
+        if questions is None:
+            tree.compileQuestions()
+            compiled[ id(tree.questionSet) ] = tree.questions
+        else:
+            tree.questions = questions
+    return trees
+
 class MetaTree:
     """ Contains mutliple Decision Trees (for each state).
         So a MetaTree might represents the mcep-stream and hold 5 trees for each state. """
     
-    def __init__(self):
+    def __init__(self, questionSet=None):
         self.treeList = []
         self.treeDict = {}
         self.leavesList = []
         self.leavesDict = {}
         self.nodeList = []
+        # shared by the trees loaded, and by the MetaTrees of a voice
+        self.questionSet = questionSet if questionSet is not None else QuestionSet()
         
     def loadTrees(self, filename, stateRange=range(2,7)):        
+        """ loads the trees of stateRange from filename (in one pass) """
+        trees = loadStateTrees( filename,
+                                dict( (i, DecisionTree(self.questionSet)) for i in stateRange ) )
         for i in stateRange:
-            dt = DecisionTree()
-            dt.load( filename, i )
-            self.addStateTree( dt )
+            self.addStateTree( trees[i] )
         
     def printStats(self):
         for t in self.treeList:
@@ -32,22 +91,251 @@ class MetaTree:
         self.leavesList +=  tree.leavesList        
         self.nodeList += tree.nodeList 
         
-        self.leavesDict = {}
-        for l in self.leavesList:
+        for l in tree.leavesList:
             self.leavesDict[ l.macroName ] = l
             
             
-    def classifyLabelString(self, labelString):
+    def classifyLabelString(self, labelString, answers=None):
+        """ classifies labelString with each state tree, answers are its
+        LabelAnswers in questionSet if already created (others are ignored) """
         ret = []
+        if answers is None or answers.questionSet is not self.questionSet:
+            answers = self.questionSet.answers( labelString )
         for t in self.treeList:
-            ret.append( t.classifyLabelString( labelString ) )
+            ret.append( t.classifyLabelString( labelString,
+                                               answers if t.questionSet is self.questionSet else None ) )
             
         return ret            
             
+    def classifyLabels(self, labelStrings, answers=None):
+        """ classifies labelStrings with each state tree in batch (see
+        FlatTree), returns the list of classifyLabelString results;
+        answers is the answer matrix of labelStrings in questionSet if
+        already computed (see QuestionSet.answerMatrix), it is recomputed
+        if its shape does not fit questionSet.  Trees with a QuestionSet
+        of their own get an answer matrix of their own. """
+        flatTrees = [ (t.questionSet, t.flatTree()) for t in self.treeList ]
+        if answers is not None and \
+           answers.shape != ( len(labelStrings), len(self.questionSet.questions) ):
+            answers = None # of another QuestionSet, or from before questions were added
+        matrices = {} if answers is None else { id(self.questionSet): answers }
+        for questionSet, flat in flatTrees:
+            if id(questionSet) not in matrices:
+                numbers = set()
+                for other, otherFlat in flatTrees:
+                    if other is questionSet:
+                        numbers.update( otherFlat.questionNumbers() )
+                matrices[id(questionSet)] = questionSet.answerMatrix( labelStrings, numbers )
+        names = [ flat.names( flat.classify( matrices[id(questionSet)] ) )
+                  for questionSet, flat in flatTrees ]
+        return [ list(ret) for ret in zip( *names ) ] if names else [ [] for l in labelStrings ]
+            
     def getStateTree(self, statenum ):
         return self.treeDict[ statenum ]
 
 
+class Question(object):
+    """ A QS question compiled for classification: true if any of its
+    patterns occurs in a label string.  The enclosing quotes and "*" of a
+    pattern are dropped and "?" matches any single character.  Patterns
+    testing the value of one field (see label.questionField) become set
+    lookups on the fields of layout, of the others the ones without "?"
+    are plain substring tests and the rest form one regex. """
+    __slots__ = 'name patterns number layout fields substrings regex'.split()
+
+    def __init__(self, name, patterns, layout=None, number=None):
+        self.name = name
+        self.patterns = patterns
+        self.number = number    # in its QuestionSet
+        self.layout = layout if layout is not None else label.FieldLayout()
+        fieldValues = {}
+        rest = []
+        for p in patterns:
+            p = p.strip("\"*")
+            split = label.questionField(p)
+            if split is None:
+                rest.append(p)
+            else:
+                left, value, right = split
+                fieldValues.setdefault(self.layout.field(left, right), set()).add(value)
+        self.fields = tuple( (field, frozenset(values))
+                             for field, values in sorted(fieldValues.iteritems()) )
+        self.substrings = tuple( p for p in rest if '?' not in p )
+        wildcards = [ re.escape(p).replace("\?", ".") for p in rest if '?' in p ]
+        self.regex = re.compile("|".join(wildcards)) if wildcards else None
+
+    def matches(self, labelString, fields=None):
+        """ fields are the label.LabelFields of labelString in layout,
+        parsed if None """
+        if self.fields:
+            if fields is None:
+                fields = self.layout.parse(labelString)
+            for field, values in self.fields:
+                if not values.isdisjoint(fields[field]):
+                    return True
+        for substring in self.substrings:
+            if substring in labelString:
+                return True
+        return self.regex is not None and self.regex.search(labelString) is not None
+
+
+class QuestionSet(object):
+    """ The QS questions of a voice, shared by all its trees: each distinct
+    question (name and patterns) is compiled once and numbered, and the
+    LabelAnswers of a label answer each of them at most once. """
+    __slots__ = 'layout questions index'.split()
+
+    def __init__(self):
+        self.layout = label.FieldLayout()
+        self.questions = []     # number -> Question
+        self.index = {}         # (name, patterns) -> Question
+
+    def add(self, name, patterns):
+        """ the Question name with patterns, compiled if new """
+        key = (name, tuple(patterns))
+        question = self.index.get(key)
+        if question is None:
+            question = Question(name, patterns, self.layout, len(self.questions))
+            self.index[key] = question
+            self.questions.append(question)
+        return question
+
+    def answers(self, labelString):
+        return LabelAnswers(self, labelString)
+
+    def answerMatrix(self, labelStrings, numbers=None):
+        """ the answers of labelStrings to the questions as a bool array
+        (labels x questions), only the columns of the question numbers
+        given are filled in if numbers is not None.  Field lookups are
+        done per field value for all labels at once, the other patterns
+        are searched in all labels joined by newlines. """
+        answers = numpy.zeros((len(labelStrings), len(self.questions)), bool)
+        if not len(labelStrings):
+            return answers
+        parsed = [ self.layout.parse(labelString) for labelString in labelStrings ]
+        indicators = {} # field -> ({value: column}, labels x values bool array)
+        text = None
+        for question in (self.questions if numbers is None
+                         else [ self.questions[n] for n in sorted(numbers) ]):
+            column = answers[:, question.number]
+            for field, values in question.fields:
+                if field not in indicators:
+                    columns, rows, cols = {}, [], []
+                    for row, fields in enumerate(parsed):
+                        for value in fields[field]:
+                            rows.append(row)
+                            cols.append(columns.setdefault(value, len(columns)))
+                    indicator = numpy.zeros((len(parsed), len(columns)), bool)
+                    indicator[rows, cols] = True
+                    indicators[field] = columns, indicator
+                columns, indicator = indicators[field]
+                found = [ columns[value] for value in values if value in columns ]
+                if found:
+                    column |= indicator[:, found].any(axis=1)
+            if question.substrings or question.regex is not None:
+                if text is None:
+                    text = "\n".join(labelStrings)
+                    ends = numpy.cumsum([ len(labelString) + 1 for labelString in labelStrings ])
+                # no pattern matches a newline, so no match spans two labels
+                patterns = [ re.escape(p) for p in question.substrings ]
+                if question.regex is not None:
+                    patterns.append( question.regex.pattern )
+                regex = re.compile("|".join(patterns))
+                starts = [ m.start() for m in regex.finditer(text) ]
+                column[ numpy.searchsorted(ends, starts, 'right') ] = True
+        return answers
+
+
+UNKNOWN = 2
+
+class LabelAnswers(object):
+    """ The answers of a label string to the questions of a QuestionSet:
+    known holds 1 (yes), 0 (no) or UNKNOWN per question number, a question
+    is evaluated on first use. """
+    __slots__ = 'questionSet string fields known'.split()
+
+    def __init__(self, questionSet, labelString):
+        self.questionSet = questionSet
+        self.string = labelString
+        self.fields = questionSet.layout.parse(labelString)
+        self.known = bytearray([UNKNOWN]) * len(questionSet.questions)
+
+    def answer(self, number):
+        try:
+            answer = self.known[number]
+        except IndexError: # added to the question set afterwards
+            self.known.extend(bytearray([UNKNOWN]) * (len(self.questionSet.questions) - len(self.known)))
+            answer = UNKNOWN
+        if answer == UNKNOWN:
+            answer = self.known[number] = \
+                self.questionSet.questions[number].matches(self.string, self.fields)
+        return answer
+
+
+class FlatTree(object):
+    """ A DecisionTree as arrays indexed by node (breadth first, the root
+    is 0): the question number of the node in the QuestionSet, the yes
+    (right) and no (left) child and the leaf number of leaves.  Leaves,
+    and nodes with an unknown question, have question -1; leaf is -1 for
+    all but leaves, leafNames holds the macro names of the leaves
+    (unknown questions are reported once, when the FlatTree is built).
+    classify walks all labels down the tree one level per step. """
+    __slots__ = 'question yes no leaf leafNames'.split()
+
+    def __init__(self, tree):
+        question, yes, no, leaf = [], [], [], []
+        self.leafNames = []
+        unknown = set()
+        queue = [ tree.root ] if tree.root is not None else []
+        for node in queue: # grows while walking it
+            q = tree.questions.get( node.question ) if node.macroName == "" else None
+            if q is None and node.macroName == "" and node.question not in unknown:
+                unknown.add( node.question )
+                print "ERROR: Question " + node.question + " unknown!"
+            if q is not None:
+                question.append( q.number )
+                yes.append( len(queue) )
+                no.append( len(queue) + 1 )
+                leaf.append( -1 )
+                queue += [ node.right, node.left ]
+            else:
+                question.append( -1 )
+                yes.append( 0 )
+                no.append( 0 )
+                if node.macroName != "":
+                    leaf.append( len(self.leafNames) )
+                    self.leafNames.append( node.macroName )
+                else:
+                    leaf.append( -1 )
+        self.question = numpy.array( question, numpy.int32 )
+        self.yes = numpy.array( yes, numpy.int32 )
+        self.no = numpy.array( no, numpy.int32 )
+        self.leaf = numpy.array( leaf, numpy.int32 )
+
+    def questionNumbers(self):
+        """ the question numbers asked in the tree """
+        return numpy.unique( self.question[self.question >= 0] )
+
+    def classify(self, answers):
+        """ the leaf numbers (-1 for none) of the labels of answers, a bool
+        array (labels x questions, see QuestionSet.answerMatrix) """
+        if not len(self.question):
+            return numpy.full( len(answers), -1, numpy.int32 )
+        nodes = numpy.zeros( len(answers), numpy.int32 )
+        active = numpy.arange( len(answers) if self.question[0] >= 0 else 0 )
+        while len(active):
+            current = nodes[active]
+            nodes[active] = numpy.where( answers[active, self.question[current]],
+                                         self.yes[current], self.no[current] )
+            active = active[ self.question[nodes[active]] >= 0 ]
+        return self.leaf[nodes]
+
+    def names(self, leaves):
+        """ the macro names of leaf numbers, "" for -1 """
+        names = self.leafNames + [ "" ]
+        return [ names[l] for l in leaves ]
+
+
 class DecisionTree:
     """ Represents a single decision tree (for a single state and stream) """
 
@@ -108,7 +396,7 @@ class DecisionTree:
                  
                  
     # init             
-    def __init__(self):       
+    def __init__(self, questionSet=None):       
         self.leavesList = []       
         self.leavesDict = {}
         self.nodeList = []
@@ -116,7 +404,10 @@ class DecisionTree:
         self.state = 0
         self.stream = 1
         self.questionsDict = {}
+        self.questions = {}     # name -> Question, see compileQuestions
+        self.questionSet = questionSet if questionSet is not None else QuestionSet()
         self.root = None
+        self.flat = None        # see flatTree
  
  
     def printStats(self):
@@ -127,47 +418,25 @@ class DecisionTree:
     # load
     def load(self, path, state):
         """ loads a tree from path for the given state and stream """
-        
-        self.state = state
-        currentState = 0
-        
-        # load tree file
-        treeFile = open(path)
-        
-        # loop tree file
-        for line in treeFile:
-            line = line.strip()            
-            #print line , " compare with {*}[" + str(state) + "]"
-            # Question definition
-            # i.e.: QS Pos_C-Syl_in_C-Phrase(Bw)<=12 { "*-?#*","*-10#*","*-11#*","*-12#*" }
-            m = re.match( r'QS\s+([^{]+){([^}]+).*', line )
-            if m is not None:
-                self.questionsDict[ m.group(1).strip() ] =  [ x.strip().strip("\"") for x in m.group(2).split(",") ]
-
-            # begin of section - state and stream info
-            elif line.startswith( '{*}[' + str(state) + ']' ):
-                currentState = int(state)             
-            # begin of tree structure info   
-            elif line == '{':
-                continue                  
-            # end of tree structure info  
-            elif line == '}' and currentState > 0:                
-                self.buildStateTree(currentState)
-                currentState = 0
-            # tree structure line                
-            elif currentState > 0:
-                self._handleLine(currentState, line)
-        
-        treeFile.close()                                                    
+        loadStateTrees( path, { state: self } )
         return True
+
+    def flatTree(self):
+        """ the FlatTree of the tree, built on first use """
+        if self.flat is None:
+            self.flat = FlatTree( self )
+        return self.flat
+
+    def compileQuestions(self):
+        """ compiles questionsDict into questionSet for classifyLabelString """
+        self.questions = dict( (name, self.questionSet.add(name, patterns))
+                               for name, patterns in sorted(self.questionsDict.iteritems()) )
         
     # handleLine
     def _handleLine(self, state, line):
         """ Handles a single tree line """
 
-        # example line:
-        #                   -29   L-sil    -51   "mcep_s2_1"        
-        m = re.match(r'([0-9-]+)\s+(\S+)\s+(\S+)\s+(\S+)', line)
+        m = NODE_LINE.match(line)
         if m is None:
             print 'Invalid line: ' + line
         else:                        
@@ -225,32 +494,31 @@ class DecisionTree:
             
 
 
-    def classifyLabelString(self, labelString):
-        """ classifies a given labelstring and returns the name of the resulting model """
+    def classifyLabelString(self, labelString, answers=None):
+        """ classifies a given labelstring and returns the name of the resulting model,
+        answers are the LabelAnswers of labelString in questionSet if already created
+        (others are ignored) """
         
         if self.root is None: return ""
          
         currentNode = self.root
+        questions = self.questions
+        if answers is None or answers.questionSet is not self.questionSet:
+            answers = self.questionSet.answers( labelString )
+        known = answers.known
         
         while currentNode.macroName == "":
             # answer question            
-            if currentNode.question not in self.questionsDict:
+            question = questions.get( currentNode.question )
+            if question is None:
                 print "ERROR: Question " + currentNode.question + " unknown!"
                 return ""
             
-            correctAnswerList = self.questionsDict[ currentNode.question ]
-
             # see if the label answers any of the questions correctly            
-            found = False                                                    
-            for ca in correctAnswerList:
-                ca_mod = (re.escape( ca.strip("\"*") )).replace( "\?", "." )
-                
-                if re.search( ca_mod, labelString ) is not None:
-                    found = True
-                    break
-                 
-            #if True in [ x.strip("\"*") in labelString  for x in correctAnswerList ]:
-            if found:
+            answer = known[ question.number ] if question.number < len( known ) else UNKNOWN
+            if answer == UNKNOWN:
+                answer = answers.answer( question.number )
+            if answer:
                 currentNode = currentNode.right
             else:
                 currentNode = currentNode.left
@@ -265,9 +533,9 @@ class DecisionTree:
 
         
 if __name__ == '__main__':
-    #label = r"         0    3460000 x^x-sil+h=OY@x_x/A:0_0_0/B:x-x-x@x-x&x-x#x-x$x-x!x-x;x-x|x/C:1+1+2/D:0_0/E:x+x@x+x&x+x#x+x/F:content_2/G:0_0/H:x=x@1=1|0/I:9=4/J:9+4-1/VAR:at"
-    #label = r"   3460000    4080000 x^sil-h+OY=t@1_2/A:0_0_0/B:1-1-2@1-2&1-9#1-4$1-4!0-2;0-2|0/C:0+0+2/D:0_0/E:content+2@1+4&1+3#0+1/F:content_1/G:0_0/H:9=4@1=1|L-L%/I:0=0/J:9+4-1/VAR:at"
-    label = r"  14020000   14380000 B^P6-s+f=P9e@3_1/A:0_0_1/B:0-0-3@2-1&7-2#3-2$3-2!2-1;2-1|0/C:1+1+3/D:content_1/E:content+2@5+2&5+1#1+1/F:content_1/G:0_0/H:8=6@1=1|L-L%/I:0=0/J:8+6-1/VAR:goi"
+    #labelString = r"         0    3460000 x^x-sil+h=OY@x_x/A:0_0_0/B:x-x-x@x-x&x-x#x-x$x-x!x-x;x-x|x/C:1+1+2/D:0_0/E:x+x@x+x&x+x#x+x/F:content_2/G:0_0/H:x=x@1=1|0/I:9=4/J:9+4-1/VAR:at"
+    #labelString = r"   3460000    4080000 x^sil-h+OY=t@1_2/A:0_0_0/B:1-1-2@1-2&1-9#1-4$1-4!0-2;0-2|0/C:0+0+2/D:0_0/E:content+2@1+4&1+3#0+1/F:content_1/G:0_0/H:9=4@1=1|L-L%/I:0=0/J:9+4-1/VAR:at"
+    labelString = r"  14020000   14380000 B^P6-s+f=P9e@3_1/A:0_0_1/B:0-0-3@2-1&7-2#3-2$3-2!2-1;2-1|0/C:1+1+3/D:content_1/E:content+2@5+2&5+1#1+1/F:content_1/G:0_0/H:8=6@1=1|L-L%/I:0=0/J:8+6-1/VAR:goi"
     
     if len(sys.argv) < 2:
         sys.exit( "Usage: python " + sys.argv[0] + " <treefile>" )
@@ -281,5 +549,5 @@ if __name__ == '__main__':
         t.load( "../../../../csc_to_goi/models_goi_1.0_mono2/tree.logF0.inf" , i)   
             
         # classify test
-        print t.classifyLabelString( label )
+        print t.classifyLabelString( labelString )
     
\ No newline at end of file
@@ -0,0 +1,85 @@
+'''
+Transparent access to compressed model and label files.
+
+openFile opens gzip and xz compressed files like plain ones: when
+reading the compression is detected by the magic bytes, when writing
+by the extension (.gz, .xz).  Compressed files are decompressed while
+they are read, never as a whole, so reading them line by line takes
+no more memory than reading the plain file.  xz needs the lzma module
+(backports.lzma on python 2).
+'''
+
+import io
+import os
+import gzip
+import shutil
+import tempfile
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+GZIP_MAGIC = '\x1f\x8b'
+XZ_MAGIC = '\xfd7zXZ\x00'
+# gzip's default of 9 is several times slower for little gain on MMFs
+GZIP_LEVEL = 6
+BUFFER_SIZE = 1 << 16
+
+def compression(filename):
+    """ 'gz', 'xz' or None for plain files, by the magic bytes of filename """
+    f = open(filename, 'rb')
+    try:
+        magic = f.read(len(XZ_MAGIC))
+    finally:
+        f.close()
+    if magic.startswith(GZIP_MAGIC):
+        return 'gz'
+    if magic == XZ_MAGIC:
+        return 'xz'
+    return None
+
+def _requireLzma(filename):
+    if lzma is None:
+        raise IOError("%s is xz compressed, reading or writing it needs the "
+                      "lzma module (pip install backports.lzma)" % filename)
+
+def openFile(filename, mode='rb'):
+    """ filename opened for reading ('r', 'rb', 'rt') or writing ('w',
+    'wb', 'wt'); compressed files are returned as buffered streams with
+    peek, readline and iteration, plain files as file objects """
+    if mode[0] not in 'rw':
+        raise ValueError("unsupported mode %r" % mode)
+    if mode[0] == 'r':
+        kind = compression(filename)
+        if kind is None:
+            return open(filename, mode)
+        if kind == 'gz':
+            return io.BufferedReader(gzip.GzipFile(filename, 'rb'), BUFFER_SIZE)
+        _requireLzma(filename)
+        return io.BufferedReader(lzma.LZMAFile(filename, 'rb'), BUFFER_SIZE)
+    extension = os.path.splitext(filename)[1]
+    if extension == '.gz':
+        return io.BufferedWriter(gzip.GzipFile(filename, 'wb', GZIP_LEVEL), BUFFER_SIZE)
+    if extension == '.xz':
+        _requireLzma(filename)
+        return io.BufferedWriter(lzma.LZMAFile(filename, 'wb'), BUFFER_SIZE)
+    return open(filename, mode)
+
+def decompressToTemp(stream, directory=None):
+    """ copies the content of stream into a temporary file and returns
+    its name, for readers that need random access (memory-mapping);
+    the caller removes the file """
+    handle, name = tempfile.mkstemp(dir=directory, prefix='pyblah-', suffix='.mmf')
+    f = os.fdopen(handle, 'wb')
+    try:
+        shutil.copyfileobj(stream, f, 1 << 20)
+    except:
+        f.close()
+        os.remove(name)
+        raise
+    f.close()
+    return name
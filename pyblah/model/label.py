@@ -15,6 +15,8 @@ Classes to read label files.
 import sys
 import re
 
+import fileio
+
 def quinphone(key):
     left = 0
     right = key.find('@')
@@ -45,6 +47,72 @@ def triphone(key):
     return key[ left:right ]
 
 
+# a question pattern testing one field: the text left of the field, the
+# value (letters and digits) and the delimiters right of it,
+# i.e. "-a+" of "*-a+*" or "/B:1-" of "*/B:1-*"
+FIELD_PATTERN = re.compile(r'(.*[^A-Za-z0-9])([A-Za-z0-9]+)([^A-Za-z0-9]+)$')
+
+def questionField(pattern):
+    """ (left, value, right) of a question pattern without the enclosing
+    "*", or None if it does not test a single field by its value """
+    if '?' in pattern:
+        return None
+    m = FIELD_PATTERN.match(pattern)
+    if m is None:
+        return None
+    return m.groups()
+
+
+class FieldLayout(object):
+
+    '''
+    The fields of full context labels tested by a question set.  A field
+    is given by the text around it, (left, right); its values in a label
+    are the runs of letters and digits between an occurrence of left and
+    one of right.  The question pattern "*-a+*" occurs in a label exactly
+    if "a" is a value of the field ('-', '+'), as left and right end and
+    start with delimiters.
+    '''
+
+    __slots__ = ['contexts', 'index', 'finders']
+    def __init__(self):
+        self.contexts = []  # field -> (left, right)
+        self.index = {}     # (left, right) -> field
+        self.finders = []   # field -> findall of a regex of its values
+
+    def field(self, left, right):
+        """ the field number of (left, right), added if new """
+        field = self.index.get((left, right))
+        if field is None:
+            field = self.index[(left, right)] = len(self.contexts)
+            self.contexts.append((left, right))
+            if any( left.startswith(left[i:]) for i in xrange(1, len(left)) ):
+                # occurrences of left may overlap, consume none of them
+                regex = r'(?=%s([A-Za-z0-9]+)%s)'
+            else:
+                regex = r'%s(?=([A-Za-z0-9]+)%s)'
+            regex = regex % (re.escape(left), re.escape(right))
+            self.finders.append(re.compile(regex).findall)
+        return field
+
+    def parse(self, labelString):
+        return LabelFields(self, labelString)
+
+
+class LabelFields(dict):
+
+    ''' A label string split into the fields of a FieldLayout: maps each
+    field to the frozenset of its values, parsed on first use. '''
+
+    __slots__ = ['layout', 'string']
+    def __init__(self, layout, labelString):
+        self.layout = layout
+        self.string = labelString
+
+    def __missing__(self, field):
+        values = self[field] = frozenset(self.layout.finders[field](self.string))
+        return values
+
 
 class UtteranceLabel(object):
     
@@ -52,7 +120,8 @@ class UtteranceLabel(object):
     
     def __init__(self, file_or_name):
         ''' 
-        Reads the utterance from a full or mono context label file.
+        Reads the utterance from a full or mono context label file
+        (gzip/xz compressed ones too).
         Access the internal label objects (of type Label) using .labels
         '''
         
@@ -60,7 +129,7 @@ class UtteranceLabel(object):
         
         # read label file
         if isinstance(file_or_name, str):
-            uttfile = open(file_or_name, 'rt')
+            uttfile = fileio.openFile(file_or_name, 'rt')
         else:
             uttfile = file_or_name
             
@@ -0,0 +1,160 @@
+'''
+Memory accounting for loaded models.
+
+MemoryReport walks the objects of a model once and sums their sizes
+(sys.getsizeof) by section and kind of object.  The sections are the
+macro types of the mmfs, ~p and ~s per stream, the PDF tables, the
+state trees and the rest of each mmf and tree; the kinds are the
+classes (Macro, Stream, dict, Node, str, ...) plus the numpy payloads:
+"payload" is array data owned by the model, "mapped" array data or
+files mapped into memory (shared MMFs, keepSource buffers) that is
+backed by the page cache.  Objects reachable from several sections
+are counted once, in the section walked first: referenced macros are
+walked before the macros referring to them, PDF tables before the
+pdfs that are views into them.
+'''
+
+import sys
+import mmap
+import types
+import collections
+
+import numpy
+
+# referenced by models but not part of them
+SKIPPED = (type, types.ClassType, types.FunctionType, types.BuiltinFunctionType,
+           types.ModuleType, types.MethodType, file)
+
+class MemoryReport(object):
+    """ object counts and bytes by section and kind of object """
+    __slots__ = 'counts sizes seen'.split()
+    def __init__(self):
+        self.counts = collections.OrderedDict() # section -> {kind: objects}
+        self.sizes = collections.OrderedDict()  # section -> {kind: bytes}
+        self.seen = set()                       # ids of the objects counted
+
+    def _count_(self, section, kind, size, objects=1):
+        if section not in self.counts:
+            self.counts[section] = collections.defaultdict(int)
+            self.sizes[section] = collections.defaultdict(int)
+        self.counts[section][kind] += objects
+        self.sizes[section][kind] += size
+
+    def add(self, section, value):
+        """ counts value and everything reachable from it that has not
+        been counted yet under section """
+        stack = [value]
+        while stack:
+            value = stack.pop()
+            if value is None or id(value) in self.seen or isinstance(value, SKIPPED):
+                continue
+            self.seen.add(id(value))
+            if isinstance(value, numpy.ndarray):
+                owned = value.nbytes if value.flags.owndata else 0
+                self._count_(section, 'ndarray', sys.getsizeof(value) - owned)
+                if owned:
+                    self._count_(section, 'payload', owned, 0)
+                elif isinstance(value.base, numpy.ndarray):
+                    stack.append(value.base) # a view
+                elif value.base is not None:
+                    self._count_(section, 'mapped', value.nbytes, 0)
+                    self.seen.add(id(value.base))
+            elif isinstance(value, dict):
+                self._count_(section, 'dict', sys.getsizeof(value))
+                stack.extend(value.iterkeys())
+                stack.extend(value.itervalues())
+            elif isinstance(value, (list, tuple, set, frozenset)):
+                self._count_(section, type(value).__name__, sys.getsizeof(value))
+                stack.extend(value)
+            elif isinstance(value, mmap.mmap):
+                self._count_(section, 'mmap', sys.getsizeof(value))
+                self._count_(section, 'mapped', len(value), 0)
+            else:
+                kind = getattr(value, '__class__', type(value))
+                size = sys.getsizeof(value)
+                # Macro and Stream forward other attributes, dunders are safe
+                attrs = getattr(value, '__dict__', None)
+                if attrs is not None:
+                    self.seen.add(id(attrs))
+                    size += sys.getsizeof(attrs)
+                    stack.extend(attrs.itervalues())
+                for slot in getattr(kind, '__slots__', ()):
+                    if not slot.startswith('__'):
+                        stack.append(getattr(value, slot, None))
+                self._count_(section, kind.__name__, size)
+        return self
+
+    def total(self, section=None):
+        """ (objects, bytes) of section, or of all sections """
+        sections = self.counts.keys() if section is None else [section]
+        return (sum( sum(self.counts[s].itervalues()) for s in sections ),
+                sum( sum(self.sizes[s].itervalues()) for s in sections ))
+
+    def format(self, kinds=4):
+        """ a table with a line per section: objects, bytes and the kinds
+        taking the most bytes (with their object counts) """
+        lines = []
+        for section in self.counts:
+            objects, size = self.total(section)
+            counts, sizes = self.counts[section], self.sizes[section]
+            largest = sorted(sizes, key=lambda kind: -sizes[kind])[:kinds]
+            lines.append("%-28s %9d objects %10s  %s" % (
+                    section, objects, formatBytes(size),
+                    ", ".join( "%s %s%s" % (kind, "%d/" % counts[kind] if counts[kind] else "",
+                                            formatBytes(sizes[kind]))
+                               for kind in largest )))
+        objects, size = self.total()
+        lines.append("%-28s %9d objects %10s" % ("total", objects, formatBytes(size)))
+        return "\n".join(lines)
+
+def formatBytes(size):
+    for unit in ('B', 'kB', 'MB'):
+        if size < 1000:
+            return "%.1f %s" % (size, unit) if unit != 'B' else "%d B" % size
+        size /= 1000.0
+    return "%.1f GB" % size
+
+def reportMMF(mfile, name='mmf', report=None):
+    """ adds the sections of an mmf.MMF to report (a new one if None):
+    "<name> pdf tables", "<name> ~x" per macro type, with ~p and ~s by
+    stream ("<name> ~p stream 1"), and "<name>" for the rest """
+    report = report or MemoryReport()
+    report.add(name + ' pdf tables', mfile.pdfTables)
+    order = "oeutvwpsh"
+    for mtype in sorted(mfile.macros, key=lambda mtype: (order.find(mtype[-1:]), mtype)):
+        section = '%s %s' % (name, mtype)
+        for mname, macro in sorted(mfile.macros[mtype].iteritems()):
+            target = macro.target
+            if mtype == '~s' and type(target) is dict:
+                for stream, value in sorted(target.iteritems()):
+                    report.add('%s stream %d' % (section, stream), value)
+            elif mtype == '~p' and getattr(target, 'streamNumber', None) is not None:
+                report.add('%s stream %d' % (section, target.streamNumber), macro)
+                continue
+            report.add(section, macro)
+    report.add(name, mfile)
+    return report
+
+def reportMetaTree(metatree, name='tree', report=None):
+    """ adds the sections of a decisiontree.MetaTree to report: "<name>
+    questions" (unless already counted for another tree), "<name> state n"
+    per state tree and "<name>" for the rest """
+    report = report or MemoryReport()
+    report.add(name + ' questions', metatree.questionSet)
+    for tree in metatree.treeList:
+        report.add('%s state %d' % (name, tree.state), tree)
+    report.add(name, metatree)
+    return report
+
+def reportModel(model):
+    """ MemoryReport of a model.HTSVoiceModel: its mmfs (cmp, dur) and
+    trees (tree mcep, ...) """
+    report = MemoryReport()
+    for name, mfile in (('cmp', model.cmpMMF), ('dur', model.durMMF)):
+        if mfile is not None:
+            reportMMF(mfile, name, report)
+    report.add('questions', model.questionSet)
+    for name in sorted(model.trees):
+        reportMetaTree(model.trees[name], 'tree ' + name, report)
+    report.add('model', model)
+    return report
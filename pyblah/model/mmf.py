@@ -2,10 +2,23 @@
 
 #from profilehooks import profile
 
+import os
 import re
+import zlib
+import hashlib
+import mmap
+import bisect
+import struct
+import marshal
 import logging
+import itertools
 import numpy
 import collections
+import multiprocessing
+
+import fileio
+
+logger = logging.getLogger("mmf")
 
 ##------------------------------------------------------------------
 ####### Created by tomer filiba on Fri, 26 May 2006 (PSF-License) 
@@ -141,20 +154,22 @@ GlobalOption.parmkinds= set("DISCRETE LPC LPCEPSTRA MFCC FBANK MELSPEC LPREFC LP
 # Macro
 #-------------------------------------------
 def isMacro(value):
-    return getattr(value, 'macroType', None) and getattr(value, 'macroId', None)
+    return isinstance(value, Macro) and value.macroType and value.macroId
 def macroName(value):
     return getattr(value, 'macroId', None)
 def macroType(value):
     return getattr(value, 'macroType', None)
 def isDanglingMacro(value):
-    return not bool( getattr(value, 'target', False))
+    return getattr(value, 'target', None) is None
 
 
-### this is more difficult to transform into a new style class, as
-### proxying of special methods bypasses __getattr__ probably need to
-### use the proxy class included above
-class Macro:
-#    __slots__ = 'macroType macroId target'.split()
+class Macro(object):
+    """ a macro (~p "name") and its value, the target.  Attribute access,
+    indexing, iteration, comparison, arithmetic and numpy conversion are
+    forwarded to the target, so a Macro can mostly be used in place of its
+    value.  Hot code should use MMF.getTarget or MMF.resolve instead,
+    forwarding costs a failed lookup and a call on every access. """
+    __slots__ = 'macroType macroId target'.split()
     def __init__(self, macroType, macroId, target=None):
         self.macroType= macroType
         self.macroId = macroId
@@ -162,15 +177,6 @@ class Macro:
 
     def setTarget(self, target):
         self.target=target
-        # def __getattribute__(self,name):
-        #     #        print "was asked for %s" % name
-        #     if object.__getattribute__(self,'__dict__').has_key(
-        #     if object.__getattribute__(self,'__dict__').has_key(name):
-        #         x =object.__getattribute__(self,name)
-        #         return x
-        #     elif self.target:
-        #         print "key %s not a self" % name
-        #         return getattr(self.target,name)
     def __eq__(self, other):
         x=self.target
         if isMacro(other):
@@ -181,6 +187,20 @@ class Macro:
             return (x==y).all()
         else:
             return x==y
+    def __ne__(self, other):
+        return not self.__eq__(other)
+    __hash__ = object.__hash__
+
+    def __nonzero__(self):
+        # like the target if it has a truth value, a Mixture is always true
+        target = self.target
+        kind = type(target)
+        if hasattr(kind, '__nonzero__') or hasattr(kind, '__len__'):
+            return bool(target)
+        return True
+
+    def __array__(self, *args):
+        return numpy.asarray(self.target, *args)
             
     def __repr__(self):
         return "%s(%s,%s, target=%r)" % (self.__class__.__name__,
@@ -188,14 +208,78 @@ class Macro:
                                          self.macroId,
                                          self.target)
     def __getattr__(self, name):
+        # special methods and slots not set yet (copy, pickle) are not forwarded
+        if name.startswith('__') or name in Macro.__slots__:
+            raise AttributeError(name)
         return getattr(self.target,name)
 
     def __dir__(self):
-        macro_items = ['__init__','__doc__','__module__','macroType','macroId','target','setTarget','__getattr__','__dir__']
+        macro_items = dir(Macro)
         if self.target:
             macro_items.extend( dir(self.target))
         return macro_items
-        
+
+def _forward_(name, binary):
+    if binary: # NotImplemented lets python try the reflected operation
+        def method(self, other):
+            func = getattr(self.target, name, None)
+            return NotImplemented if func is None else func(other)
+    else:
+        def method(self, *args):
+            return getattr(self.target, name)(*args)
+    method.__name__ = name
+    return method
+# new style classes look special methods up on the type, not via __getattr__
+for _name in ('__len__ __getitem__ __setitem__ __delitem__ __iter__ __contains__ '
+              '__float__ __int__ __neg__ __pos__ __abs__').split():
+    setattr(Macro, _name, _forward_(_name, False))
+for _name in ('__add__ __radd__ __sub__ __rsub__ __mul__ __rmul__ __div__ __rdiv__ '
+              '__truediv__ __rtruediv__ __pow__ __rpow__ __lt__ __le__ __gt__ __ge__').split():
+    setattr(Macro, _name, _forward_(_name, True))
+del _name
+
+def Resolve(value, memo):
+    """ value with every Macro in it replaced by its resolved target.
+    Model objects and dicts containing macros are copied, everything else
+    is shared; memo maps id() of resolved values to their results """
+    kind = type(value)
+    if kind is not Macro and kind is not dict and kind not in Resolve.classes:
+        return value
+    key = id(value)
+    result = memo.get(key)
+    if result is not None:
+        return result
+    if kind is Macro:
+        result = Resolve(value.target, memo)
+    elif kind is dict:
+        result = value
+        for k, v in value.iteritems():
+            r = Resolve(v, memo)
+            if r is not v:
+                if result is value:
+                    result = dict(value)
+                result[k] = r
+    elif kind is Stream and type(Resolve(value.mixture, memo)) is Stream:
+        # <STREAM> n ~p "name": the ~p value is a stream itself
+        inner = Resolve(value.mixture, memo)
+        if inner.streamNumber == value.streamNumber and value.deptrans is None:
+            result = inner
+        else:
+            result = Stream(value.streamNumber, inner.mixture,
+                            Resolve(value.deptrans, memo) if value.deptrans is not None
+                            else inner.deptrans, value.pseudo)
+    else:
+        slots = kind.__slots__
+        values = [ Resolve(getattr(value, slot), memo) for slot in slots ]
+        result = value
+        for slot, v in zip(slots, values):
+            if v is not getattr(value, slot):
+                result = kind.__new__(kind)
+                for slot, v in zip(slots, values):
+                    setattr(result, slot, v)
+                break
+    memo[key] = result
+    return result
 
 #-------------------------------------------
 # PDF
@@ -251,8 +335,18 @@ class Stream(object):
         self.mixture = mixture
         self.deptrans = deptrans
         self.pseudo = pseudo
-        
+
+    # the common lookups through to the mixture, without __getattr__
+    @property
+    def pdfs(self):
+        return self.mixture.pdfs
+    @property
+    def weights(self):
+        return self.mixture.weights
+
     def __getattr__(self, name):
+        if name.startswith('__') or name in Stream.__slots__:
+            raise AttributeError(name)
         return getattr(self.mixture,name)
     def __eq__(self, other):
         return(
@@ -282,10 +376,14 @@ class State(object):
         self.weight = weight if weight!=None else {}
         
     def __eq__(self,other):
+        if isinstance(self.weight, numpy.ndarray) or isinstance(other.weight, numpy.ndarray):
+            weights = numpy.array_equal(self.weight, other.weight)
+        else:
+            weights = self.weight == other.weight
         return (
             self.number == other.number and
             self.stream == other.stream and
-            self.weight == other.weight
+            weights
             )
                
     def __repr__(self):
@@ -317,31 +415,534 @@ class HMM(object):
                  self.state,
                  self.transp)
 
+
+Resolve.classes = frozenset([PDF, Mixture, Stream, State, HMM])
+
+#-------------------------------------------
+# PDFTable
+#-------------------------------------------
+class PDFTable(object):
+    """ the pdfs of one stream and mixture component of all macros of a
+    type, as contiguous arrays: row i of means/variances (N x D), gconst
+    and weights (the mixture weights, i.e. the voiced weight of MSD
+    streams) belongs to macro names[i], index maps names to rows.
+
+    The table owns the values, the PDF objects of the macros keep
+    working as views of its rows: means and variances (shared ~u/~v
+    macros are left alone), gconst and the mixture weight (if given)
+    become a row and 0-d views of the table.  Changes in place show on
+    both sides (pdf.gconst[...] = value, table.gconst[row] = value),
+    assigning a new object to a PDF detaches it from the table. """
+    __slots__ = 'stream mixture names index means variances gconst weights'.split()
+    def __init__(self, stream, mixture, names, means, variances, gconst, weights):
+        self.stream = stream
+        self.mixture = mixture
+        self.names = names
+        self.index = dict( (name, row) for row, name in enumerate(names))
+        self.means = means
+        self.variances = variances
+        self.gconst = gconst
+        self.weights = weights
+    def __len__(self):
+        return len(self.names)
+    def __repr__(self):
+        return "%s(stream=%r, mixture=%r, rows=%d, dim=%d)" % \
+               (self.__class__.__name__, self.stream, self.mixture,
+                len(self.names), self.means.shape[1])
+
+def BuildPDFTable(mmfile, stream, mixture=1, macroType='~p'):
+    """ collects the PDFTable of stream/mixture of the ~p (or ~s) macros
+    of mmfile.  Streams referring to shared ~p macros are skipped, their
+    pdfs are in the ~p table """
+    rows = []
+    macros = mmfile.getMacros(macroType) or {}
+    for name in sorted(macros.iterkeys()):
+        target = macros[name].target
+        if macroType == '~s':
+            target = target.get(stream)
+        if target is None or target.streamNumber != stream or isMacro(target.mixture):
+            continue
+        mix = target.mixture
+        if mixture not in mix.pdfs:
+            continue
+        rows.append( (name, mix.pdfs[mixture], mix) )
+    if not rows:
+        raise KeyError("no pdfs for stream %r mixture %r in %s macros" % (stream, mixture, macroType))
+
+    def values(vector):
+        return vector.target if isMacro(vector) else vector
+    dims = set( len(values(pdf.means)) for name, pdf, mix in rows )
+    if len(dims) != 1:
+        raise ValueError("pdfs of stream %r mixture %r differ in size: %r" %
+                         (stream, mixture, sorted(dims)))
+    dtype = mmfile.dtype
+    means = numpy.array([ values(pdf.means) for name, pdf, mix in rows ], dtype=dtype)
+    variances = numpy.array([ values(pdf.variances) for name, pdf, mix in rows ], dtype=dtype)
+    gconst = numpy.array([ numpy.nan if pdf.gconst is None else pdf.gconst
+                           for name, pdf, mix in rows ], dtype=dtype)
+    weights = numpy.array([ mix.weights.get(mixture, 1.0) for name, pdf, mix in rows ],
+                          dtype=dtype)
+    for row, (name, pdf, mix) in enumerate(rows):
+        if not isMacro(pdf.means):
+            pdf.means = means[row]
+        if not isMacro(pdf.variances):
+            pdf.variances = variances[row]
+        if pdf.gconst is not None:
+            pdf.gconst = gconst[row:row + 1].reshape(())
+        if mixture in mix.weights:
+            mix.weights[mixture] = weights[row:row + 1].reshape(())
+    return PDFTable(stream, mixture, [ name for name, pdf, mix in rows ],
+                    means, variances, gconst, weights)
+
                
 #-------------------------------------------
 # HTSMMF
 #-------------------------------------------
+def Fingerprint(value, crc=0, update=zlib.crc32):
+    """ crc32 over the content of a macro value (arrays, scalars, nested
+    model objects and the names of referenced macros); other checksums
+    are computed with update(data, state) returning the new state """
+    kind = type(value)
+    if kind is numpy.ndarray:
+        if not value.shape: # table views of scalars (see PDFTable)
+            return update(repr(value[()]), crc)
+        if not value.flags.c_contiguous:
+            value = value.copy()
+        return update(value, update(repr(value.shape), crc))
+    if kind is dict:
+        for k in sorted(value):
+            crc = Fingerprint(value[k], update(repr(k), crc), update)
+        return crc
+    if isinstance(value, Macro):
+        return update('%s "%s"' % (value.macroType, value.macroId), crc)
+    slots = getattr(kind, '__slots__', None)
+    if slots:
+        for slot in slots:
+            crc = Fingerprint(getattr(value, slot), crc, update)
+        return crc
+    return update(repr(value), crc)
+
+def _sha1Update_(data, sha):
+    sha.update(data)
+    return sha
+
+def ContentHash(value):
+    """ sha1 hex digest of the content of value (see Fingerprint) """
+    return Fingerprint(value, hashlib.sha1(), _sha1Update_).hexdigest()
+
+class MacroDiff(object):
+    """ differences between the macros of one type (and stream, for ~p
+    and ~s) of two MMFs, see diff.  added/removed are the names only in
+    the second/first MMF, changed the common ones whose values differ,
+    compared the number of common ones.  maxDiff and meanDiff map the
+    parameters (means, variances, gconst, weights, or values for array
+    macros) to the max/mean absolute difference over the compared
+    values.  False if nothing differs. """
+    __slots__ = 'macroType stream added removed changed compared maxDiff meanDiff _sums_'.split()
+    def __init__(self, macroType, stream=None):
+        self.macroType = macroType
+        self.stream = stream
+        self.added = []
+        self.removed = []
+        self.changed = set()
+        self.compared = 0
+        self.maxDiff = {}
+        self.meanDiff = {}
+        self._sums_ = {} # parameter -> [sum, count]
+
+    def addDifferences(self, param, names, a, b):
+        """ compares the rows of a and b (one per name) in bulk """
+        a = numpy.asarray(a, numpy.float64).reshape(len(names), -1)
+        b = numpy.asarray(b, numpy.float64).reshape(len(names), -1)
+        nans = numpy.isnan(a)
+        differences = numpy.abs(a - b)
+        differences[nans & numpy.isnan(b)] = 0 # unset gconsts
+        if not differences.size:
+            return
+        unequal = numpy.isnan(differences)
+        differences[unequal] = 0
+        rows = differences.max(axis=1)
+        self.changed.update( names[i] for i in numpy.flatnonzero((rows > 0) | unequal.any(axis=1)) )
+        self.maxDiff[param] = max(self.maxDiff.get(param, 0.0), float(rows.max()))
+        sums = self._sums_.setdefault(param, [0.0, 0])
+        sums[0] += float(differences.sum())
+        sums[1] += differences.size
+        self.meanDiff[param] = sums[0] / sums[1]
+
+    def __nonzero__(self):
+        return bool(self.added or self.removed or self.changed)
+
+    def __repr__(self):
+        return "%s(%s%s, added=%d, removed=%d, changed=%d, compared=%d)" % \
+               (self.__class__.__name__, self.macroType,
+                "" if self.stream is None else " stream %d" % self.stream,
+                len(self.added), len(self.removed), len(self.changed), self.compared)
+
+def diff(a, b):
+    """ compares the MMFs a and b, returns a MacroDiff per macro type,
+    and per stream for ~p and ~s, sorted by type and stream.  The pdfs
+    of ~p and ~s are stacked by stream, mixture and size and compared
+    in bulk, so are the arrays of ~e/~t/~u/~v/~w; other macros (and
+    streams with shared mixtures) are compared value by value, with
+    references compared by macro name. """
+    a.loadAll()
+    b.loadAll()
+    diffs = []
+    for mtype in sorted(set(a.macros) | set(b.macros)):
+        # macros that are only referenced count as missing
+        macrosA, macrosB = [ dict( (mname, macro) for mname, macro in
+                                   (mfile.getMacros(mtype) or {}).iteritems()
+                                   if macro.target is not None )
+                             for mfile in (a, b) ]
+        if not macrosA and not macrosB:
+            continue
+        if mtype in ('~p', '~s'):
+            diffs.extend(_diffPDFs_(mtype, macrosA, macrosB))
+            continue
+        result = MacroDiff(mtype)
+        result.removed = sorted( set(macrosA) - set(macrosB) )
+        result.added = sorted( set(macrosB) - set(macrosA) )
+        common = sorted( set(macrosA) & set(macrosB) )
+        result.compared = len(common)
+        if mtype in ('~e', '~t', '~u', '~v', '~w'):
+            byShape = collections.defaultdict(list)
+            for name in common:
+                valueA, valueB = macrosA[name].target, macrosB[name].target
+                if numpy.shape(valueA) != numpy.shape(valueB):
+                    result.changed.add(name)
+                else:
+                    byShape[numpy.shape(valueA)].append(name)
+            for shape, names in byShape.iteritems():
+                result.addDifferences('values', names,
+                                      [ macrosA[name].target for name in names ],
+                                      [ macrosB[name].target for name in names ])
+        else:
+            result.changed.update( name for name in common if
+                                   not _sameValue_(macrosA[name].target, macrosB[name].target) )
+        diffs.append(result)
+    return diffs
+
+def _sameValue_(a, b):
+    """ whether the macro values a and b are equal, referenced macros
+    are compared by name (like Fingerprint, but stops at the first
+    difference) """
+    kind = type(a)
+    if kind is not type(b):
+        return False
+    if kind is numpy.ndarray:
+        return a.shape == b.shape and a.dtype == b.dtype and bool((a == b).all())
+    if kind is dict:
+        return len(a) == len(b) and all( k in b and _sameValue_(v, b[k]) for k, v in a.iteritems() )
+    if kind is Macro:
+        return a.macroType == b.macroType and a.macroId == b.macroId
+    slots = getattr(kind, '__slots__', None)
+    if slots:
+        return all( _sameValue_(getattr(a, slot), getattr(b, slot)) for slot in slots )
+    return a == b
+
+def _pdfsByStream_(mtype, macros):
+    """ {(stream, mixture): {name: (means, variances, gconst, weight)}}
+    of the ~p or ~s macros, streams with shared mixtures are left out """
+    def values(vector):
+        return vector.target if isMacro(vector) else vector
+    groups = collections.defaultdict(dict)
+    for name, macro in macros.iteritems():
+        target = macro.target
+        if target is None:
+            continue
+        for stream in (target.itervalues() if mtype == '~s' else (target,)):
+            if isMacro(stream) or isMacro(stream.mixture):
+                continue
+            mixture = stream.mixture
+            for number, pdf in mixture.pdfs.iteritems():
+                groups[(stream.streamNumber, number)][name] = (
+                    values(pdf.means), values(pdf.variances),
+                    numpy.nan if pdf.gconst is None else pdf.gconst,
+                    mixture.weights.get(number, 1.0))
+    return groups
+
+def _diffPDFs_(mtype, macrosA, macrosB):
+    """ diff of the ~p or ~s macros, one MacroDiff per stream """
+    def streams(target):
+        if target is None:
+            return ()
+        return sorted(target) if mtype == '~s' else [target.streamNumber]
+    diffs = {}
+    def streamDiff(stream):
+        if stream not in diffs:
+            diffs[stream] = MacroDiff(mtype, stream)
+        return diffs[stream]
+    common = collections.defaultdict(set)
+    for name in sorted( set(macrosA) | set(macrosB) ):
+        streamsA = streams(macrosA[name].target) if name in macrosA else ()
+        streamsB = streams(macrosB[name].target) if name in macrosB else ()
+        for stream in set(streamsA) | set(streamsB):
+            if stream not in streamsB:
+                streamDiff(stream).removed.append(name)
+            elif stream not in streamsA:
+                streamDiff(stream).added.append(name)
+            else:
+                common[stream].add(name)
+    for stream, names in common.iteritems():
+        streamDiff(stream).compared = len(names)
+    pdfsA, pdfsB = _pdfsByStream_(mtype, macrosA), _pdfsByStream_(mtype, macrosB)
+    compared = collections.defaultdict(set)
+    for key in set(pdfsA) | set(pdfsB):
+        stream = key[0]
+        if stream not in common:
+            continue
+        result = streamDiff(stream)
+        groupA, groupB = pdfsA.get(key, {}), pdfsB.get(key, {})
+        # a mixture only one of them has
+        result.changed.update( name for name in common[stream] if (name in groupA) != (name in groupB) )
+        byShape = collections.defaultdict(list)
+        for name in common[stream]:
+            if name in groupA and name in groupB:
+                compared[stream].add(name)
+                meansA, variancesA = groupA[name][:2]
+                meansB, variancesB = groupB[name][:2]
+                if meansA.shape != meansB.shape or variancesA.shape != variancesB.shape:
+                    result.changed.add(name)
+                else:
+                    byShape[(meansA.shape, variancesA.shape)].append(name)
+        for names in byShape.itervalues():
+            names.sort()
+            rowsA = [ groupA[name] for name in names ]
+            rowsB = [ groupB[name] for name in names ]
+            for i, param in enumerate(('means', 'variances', 'gconst', 'weights')):
+                result.addDifferences(param, names, [ row[i] for row in rowsA ],
+                                      [ row[i] for row in rowsB ])
+    # streams with shared mixtures and the like are compared value by value
+    for stream, names in common.iteritems():
+        for name in names - compared[stream]:
+            valueA, valueB = macrosA[name].target, macrosB[name].target
+            if mtype == '~s':
+                valueA, valueB = valueA[stream], valueB[stream]
+            if not _sameValue_(valueA, valueB):
+                streamDiff(stream).changed.add(name)
+    return [ diffs[stream] for stream in sorted(diffs) ]
+
+def FormatDiff(diffs, names=False):
+    """ a report of the MacroDiffs returned by diff, one line per type
+    and stream; with names the added, removed and changed macros are
+    listed as well """
+    lines = []
+    for result in diffs:
+        line = "%s%s: %d compared, %d added, %d removed, %d changed" % \
+               (result.macroType, "" if result.stream is None else " stream %d" % result.stream,
+                result.compared, len(result.added), len(result.removed), len(result.changed))
+        for param in ('means', 'variances', 'gconst', 'weights', 'values'):
+            if param in result.maxDiff:
+                line += "; %s max %.3e mean %.3e" % (param, result.maxDiff[param],
+                                                     result.meanDiff[param])
+        lines.append(line)
+        if names:
+            for sign, macros in (('+', result.added), ('-', result.removed),
+                                 ('*', sorted(result.changed))):
+                lines.extend( '  %s %s "%s"' % (sign, result.macroType, name) for name in macros )
+    return "\n".join(lines)
+
+class MacroFilter(object):
+    """ selects macros by type (like "~p" or "p"), name (a regular
+    expression matched at the start of the name) and stream number.
+    Given criteria must all match; the stream number only restricts ~p
+    macros (single stream pdfs), macros of other types pass it. """
+    __slots__ = 'types names streams'.split()
+    def __init__(self, types=None, names=None, streams=None):
+        self.types = None if types is None else set( '~' + t.lstrip('~') for t in types )
+        self.names = re.compile(names) if isinstance(names, basestring) else names
+        self.streams = None if streams is None else set(streams)
+
+    def match(self, mtype, mname, streamOf):
+        """ streamOf() returns the stream number of the macro, it is only
+        called if needed """
+        if self.types is not None and mtype not in self.types:
+            return False
+        if self.names is not None and not self.names.match(mname):
+            return False
+        if self.streams is not None and mtype == '~p' and streamOf() not in self.streams:
+            return False
+        return True
+
 mmf_rex_macro = re.compile(r'\s+~(\w)\s+\"([A-Za-z_\-0-9]+)\"')
 class MMF:
-    def __init__(self, filename=None):
+    """ macros of an MMF by type and name.
+
+    With lazy=True the file is only scanned (see ScanMMF) and each macro
+    is parsed when it is first requested through getMacro,
+    findOrDeclareMacro or getMacros; loadAll parses the rest.
+    With processes > 1 the file is parsed by a process pool, see
+    ParseMMFParallel.
+    include and exclude (MacroFilter) restrict the macros loaded: the file
+    is scanned and only the macros selected by include and not by
+    exclude are parsed (on demand if lazy), the others are left out and
+    references to them stay undefined.  Global options are always loaded.
+    gzip and xz compressed files are read as well (see fileio): a
+    decompressed temporary copy is mapped like a plain file (text is
+    only parsed while it is decompressed if the copy can not be written).
+    With keepSource=True the text of every macro parsed from a text MMF
+    is remembered together with a Fingerprint of its value, WriteMMF
+    copies the text of the macros that are still unchanged (this costs
+    about a third of the parsing time and is not done in parallel).
+    dtype is the precision the parameters are stored in (DTYPE_FLOAT by
+    default): float16 halves the memory of bulk analyses, float64 keeps
+    sensitive computations from rounding; it applies to macros loaded
+    later on as well. """
+    def __init__(self, filename=None, lazy=False, processes=None, keepSource=False,
+                 include=None, exclude=None, dtype=None):
         self.macros = collections.defaultdict(dict)
+        self.dtype = numpy.dtype(DTYPE_FLOAT if dtype is None else dtype).type
+        self.offsets = {} # mtype -> {mname: offset} of macros not parsed yet
+        self.buf = None
+        self.lexerClass = None
+        self.pdfTables = {}
+        self.sources = None # (mtype, mname) -> (start, end, fingerprint) in buf
         if filename:
-            
-            self.file = open( filename, 'rt')
-            ParseMMF( Lexer( self.file ), self )
+            selective = include is not None or exclude is not None
+            self.file = fileio.openFile( filename, 'rb')
+            if isinstance(self.file, file):
+                self._parse_(self.file, filename, lazy, processes, keepSource, include, exclude)
+                self.file.close()
+                return
+            # the mapped Lexer on a temporary copy is faster than the
+            # LineLexer on the decompressing stream (and the modes that
+            # need random access need the copy anyway)
+            try:
+                name = fileio.decompressToTemp(self.file)
+            except EnvironmentError:
+                self.file.close()
+                if lazy or selective or keepSource or (processes and processes > 1):
+                    raise
+                self.file = fileio.openFile( filename, 'rb')
+                if BinaryLexer.detect_rex.search(self.file.peek(4096)[:4096]):
+                    raise
+                logger.warning("No room to decompress %s, parsing it while decompressing" % filename)
+                ParseMMF( LineLexer(self.file, self.dtype), self )
+            else:
+                self.file.close()
+                try:
+                    self.file = open( name, 'rb')
+                    self._parse_(self.file, name, lazy, processes, keepSource, include, exclude)
+                finally:
+                    os.remove(name)
             self.file.close()
 
+    def _parse_(self, f, filename, lazy, processes, keepSource, include, exclude):
+        """ parses or scans the (plain) file f, see __init__ """
+        lexer = MakeLexer( f )
+        lexer.dtype = self.dtype
+        if keepSource and isinstance(lexer, Lexer):
+            self.buf, self.lexerClass = lexer.buf, lexer.__class__
+            self.sources = {}
+        selective = include is not None or exclude is not None
+        if lazy or selective:
+            self.buf, self.lexerClass = lexer.buf, lexer.__class__
+            ScanMMF( lexer, self )
+            if selective:
+                self._select_(include, exclude)
+            if not lazy:
+                self.loadAll()
+        elif processes and processes > 1 and self.sources is None:
+            ParseMMFParallel( lexer, filename, processes, self )
+        else:
+            ParseMMF( lexer, self )
+
+    def _load_(self, mtype, mname):
+        """ parses a macro recorded by ScanMMF, the offset is dropped first
+        so the declaration in ParseMacro does not recurse """
+        pos = self.offsets[mtype].pop(mname)
+        lexer = self.lexerClass(self.buf, pos)
+        lexer.dtype = self.dtype
+        macro = ParseMacro( lexer, self)
+        if self.sources is not None:
+            self.keepSource(macro, pos, lexer.tell())
+        return macro
+
+    def _select_(self, include, exclude):
+        """ drops the offsets of the macros include/exclude leave out """
+        for mtype, offsets in self.offsets.items():
+            for mname, pos in offsets.items():
+                streamOf = lambda: self._streamAt_(pos)
+                if (include is not None and not include.match(mtype, mname, streamOf)) or \
+                   (exclude is not None and exclude.match(mtype, mname, streamOf)):
+                    del offsets[mname]
+            if not offsets:
+                del self.offsets[mtype]
+
+    def _streamAt_(self, pos):
+        """ stream number of the ~p defined at offset pos, without parsing it """
+        lexer = self.lexerClass(self.buf, pos)
+        lexer.get()
+        lexer.get()
+        lexer.skipToNextLine()
+        if lexer.peek() != "<STREAM>":
+            return 1 # pseudo stream
+        lexer.get()
+        return lexer.getType(int)
+
+    def keepSource(self, macro, start, end):
+        """ remembers buf[start:end] as the text of macro """
+        self.sources[(macro.macroType, macro.macroId)] = (start, end, Fingerprint(macro.target))
+
+    def getSource(self, mtype, mname):
+        """ the text macro was parsed from if it is unchanged, else None """
+        if not self.sources:
+            return None
+        source = self.sources.get((mtype, mname))
+        if source is None:
+            return None
+        start, end, fingerprint = source
+        if Fingerprint(self.macros[mtype][mname].target) != fingerprint:
+            return None
+        text = self.buf[start:end]
+        return text if text.endswith('\n') else text + '\n'
+
+    def getTarget(self, mtype, mname):
+        """ the value of a macro, without the Macro forwarding to it """
+        return self.getMacro(mtype, mname).target
+
+    def resolve(self):
+        """ {mtype: {mname: value}} of all macros, with the macro references
+        inside the values replaced by the referenced values (see Resolve).
+        The MMF itself is not changed, what WriteMMF writes stays the same;
+        the view shares the arrays but not the structure, structural
+        changes after resolve are not seen in it """
+        self.loadAll()
+        memo = {}
+        return dict( (mtype, dict( (mname, Resolve(macro.target, memo))
+                                   for mname, macro in macros.iteritems() ))
+                     for mtype, macros in self.macros.iteritems() )
+
+    def getPDFTable(self, stream, mixture=1, macroType='~p'):
+        """ the PDFTable of stream/mixture, built on first use (macros
+        added afterwards are not in it) """
+        key = (macroType, stream, mixture)
+        if not self.pdfTables.has_key(key):
+            self.pdfTables[key] = BuildPDFTable(self, stream, mixture, macroType)
+        return self.pdfTables[key]
+
+    def loadAll(self):
+        for mtype in self.offsets.keys():
+            self.getMacros(mtype)
+
     def getMacros(self, mtype):
+        if self.offsets.has_key(mtype):
+            for mname in self.offsets[mtype].keys():
+                self._load_(mtype, mname)
         if not self.macros.has_key(mtype):
             return None
         return self.macros[mtype]
     def hasMacro(self, mtype, mname):
+        if self.offsets and mname in self.offsets.get(mtype, ()):
+            return True
         if not self.macros.has_key(mtype):
             return False
         return self.macros[mtype].has_key(mname)
 
         
     def getMacro(self, mtype, mname):
+        if self.offsets and mname in self.offsets.get(mtype, ()):
+            self._load_(mtype, mname)
         if not self.macros.has_key(mtype):
             return None
         tmacros = self.macros[mtype]
@@ -351,6 +952,8 @@ class MMF:
     def findOrDeclareMacro(self, macro_type, macro_name):
         mtype = macro_type.strip()
         mname = macro_name.strip(' "\'')
+        if self.offsets and mname in self.offsets.get(mtype, ()):
+            self._load_(mtype, mname)
         tmacros= self.macros[mtype]
         if not tmacros.has_key(mname):
             tmacros[mname] = Macro(mtype, mname)
@@ -363,10 +966,90 @@ class MMF:
 # PARSE TOOLS - Lexer
 #-------------------------------------------
 
-class Lexer(object):
-    __slots__ = "file stack _elements_ _ret_elements_ _line_no_".split()
-    def __init__(self, filelike):
+class LexerBase(object):
+    """ error reporting and typed access shared by the tokenizers below;
+    subclasses provide peek/get/getN/skipToNextLine """
+    __slots__ = ()
+    # while set, getFloats/getFloatRows skip payloads and return SKIMMED
+    skim = False
+
+    def getLineNo(self):
+        return self._line_no_
+    def getRetElements(self):
+        return self._ret_elements_
+
+    def DebugState(self, string=""):
+        return "%s; Line %d, Last elements: %r" % \
+                           (string,self.getLineNo(),self.getRetElements())
+
+
+    def Error(self,string):
+        raise RuntimeError("%s; Line %d, Last elements: %r" %
+                           (string,self.getLineNo(),self.getRetElements() ))
+
+    def getRequireNextReg(self, rex, error_context="" ):
+        val = self.get()
+        if not rex.match(val):
+            self.Error("lexer returned %r but %r compliance was expected - %s"%\
+                       (val, rex.pattern, error_context) )
+        return val
+        
+    def getRequireNext(self, string, context=""):
+        val = self.get()
+        if val != string:
+            self.Error("lexer returned %r but %r was expected - %s" % (val, string, context) )
+        return val
+
+    def getType(self, usetype, message=None):
+        try:
+            retval = usetype(self.get())
+        except (ValueError, TypeError):
+            self.Error(message or "couldn't convert mixture num to %r" % usetype)
+        return retval
+
+        
+        
+    # def getRemaining(self):
+    #     ("get the elements remaining in the internal buffer, usually that is until newline\n"
+    #      "usually implies that this function probably is not a good idea")
+    #     if self.hasMore():
+    #         e = self.elements
+    #         self.elements = []
+    #         return e
+    #     return []
+
+    def skipIfNL(self):
+        if(self.peek()=='\n'):
+            self.skipToNextLine()
+
+    def getEOL(self):
+        """ consumes the newline closing a line of values, returns the
+        element found (\\n unless the input is malformed) """
+        return self.get()
+
+    def getRequireEOL(self, context=""):
+        return self.getRequireNext('\n', context)
+
+    def getFloats(self, num, dtype):
+        """ fast path for numeric payloads: returns the rest of the current
+        line as a vector of num values, or None (consuming nothing) if
+        that is not possible.  Callers then fall back to getN, which
+        also produces the error messages for malformed payloads. """
+        return None
+
+    def getFloatRows(self, rows, columns, dtype):
+        """ like getFloats for a rows x columns matrix written one row per
+        line; on success the newline after the last row is consumed """
+        return None
+
+
+class LineLexer(LexerBase):
+    """ line based tokenizer, reads the file one line at a time.  Used for
+    streams that can neither be memory-mapped nor read at once """
+    __slots__ = "file dtype stack _elements_ _ret_elements_ _line_no_".split()
+    def __init__(self, filelike, dtype=None):
         self.file = filelike;
+        self.dtype = DTYPE_FLOAT if dtype is None else dtype
         self.stack = [self.file.tell()]
         self._elements_=[]
         self._ret_elements_=[]
@@ -393,10 +1076,6 @@ class Lexer(object):
     #     return True
     #     #return self.hasMore()
 
-    def getLineNo(self):
-        return self._line_no_
-    def getRetElements(self):
-        return self._ret_elements_
 #    @profile
     def _fill_buf_(self):
         #        while True:
@@ -405,7 +1084,7 @@ class Lexer(object):
             return False
         self._line_no_ = self._line_no_+1
         # self._elements_ = [i.strip(' \t') for i in Lexer.split_rex.split(line) if i.strip(' \t')]
-        self._elements_.extend( Lexer.find_rex.findall(line))
+        self._elements_.extend( LineLexer.find_rex.findall(line))
         return True
         pass
 
@@ -481,61 +1160,346 @@ class Lexer(object):
 #            print "skipTonext: %r" % s
 
 
+def MapFile(filelike):
+    """ returns the remaining content of filelike as a buffer and the
+    offset it starts at.  Real files are memory-mapped (nothing is
+    copied, pages are loaded by the OS on demand), anything else
+    (StringIO, pipes, empty files) is read into a string """
+    if isinstance(filelike, file):
+        pos = filelike.tell()
+        try:
+            return mmap.mmap(filelike.fileno(), 0, access=mmap.ACCESS_READ), pos
+        except (ValueError, EnvironmentError):
+            # empty file or not mappable (pipe, tty)
+            pass
+    return filelike.read(), 0
+
+
+class Lexer(LexerBase):
+    """ tokenizer that walks a cursor over the whole file at once.
+
+    The file is memory-mapped (see MapFile) and tokenized lazily with
+    find_rex, so there is no per line buffering and no token list to
+    shift.  The last consumed elements for error messages are
+    reconstructed from the buffer only when an error is raised. """
+    __slots__ = "buf skim dtype lineBase _end_ _tokens_ _next_ _pos_".split()
+    def __init__(self, filelike, pos=None):
+        if isinstance(filelike, (str, mmap.mmap)):
+            self.buf, start = filelike, 0
+        else:
+            self.buf, start = MapFile(filelike)
+        self.skim = False
+        self.dtype = DTYPE_FLOAT
+        self.lineBase = 0 # lines before buf (of a chunk of a file)
+        self._end_ = len(self.buf)
+        self.seek(start if pos is None else pos)
+
+    def tell(self):
+        """ offset of the next token in the buffer """
+        return self._pos_
+
+    def seek(self, pos):
+        """ continue tokenizing at offset pos of the buffer """
+        self._tokens_ = Lexer.find_rex.finditer(self.buf, pos)
+        self._advance_()
+
+    def _advance_(self):
+        m = next(self._tokens_, None)
+        if m is None:
+            self._next_ = None
+            self._pos_ = self._end_
+        else:
+            self._next_ = m.group()
+            self._pos_ = m.start()
+        return self._next_
 
+    def getLineNo(self):
+        return self.lineBase + self.buf[:self._pos_].count('\n') + 1
 
-    def DebugState(self, string=""):
-        return "%s; Line %d, Last elements: %r" % \
-                           (string,self.getLineNo(),self.getRetElements())
+    def getRetElements(self, num=10):
+        """ the last num consumed elements, re-tokenized from the buffer """
+        window = 256
+        while True:
+            start = max(0, self._pos_ - window)
+            elements = Lexer.find_rex.findall(self.buf[start:self._pos_])
+            if start > 0:
+                elements = elements[1:] # might be cut in half
+            if len(elements) >= num or start == 0:
+                return elements[-num:]
+            window *= 4
 
+    def peek(self):
+        return self._next_
+
+    def get(self):
+        e = self._next_
+        if e is not None:
+            # inlined _advance_, this is the hot path
+            m = next(self._tokens_, None)
+            if m is None:
+                self._next_ = None
+                self._pos_ = self._end_
+            else:
+                self._next_ = m.group()
+                self._pos_ = m.start()
+        return e
 
-    def Error(self,string):
-        raise RuntimeError("%s; Line %d, Last elements: %r" %
-                           (string,self.getLineNo(),self.getRetElements() ))
+    def getN(self, num):
+        e = self._next_
+        if num < 1 or e is None:
+            return []
+        result = [e]
+        result.extend( [ m.group() for m in
+                         itertools.islice(self._tokens_, num - 1) ] )
+        self._advance_()
+        return result
 
-    def getRequireNextReg(self, rex, error_context="" ):
-        val = self.get()
-        if not rex.match(val):
-            self.Error("lexer returned %r but %r compliance was expected - %s"%\
-                       (val, rex.pattern, error_context) )
-        return val
-        
-    def getRequireNext(self, string, context=""):
-        val = self.get()
-        if val != string:
-            self.Error("lexer returned %r but %r was expected - %s" % (val, string, context) )
-        return val
+    def _floatSpan_(self, lines, num):
+        """ splits the next lines of the buffer (starting at the cursor)
+        if each of them holds exactly num values; returns the values and
+        the offset of the last newline, or (None, None) """
+        pos = self._pos_
+        values = []
+        for i in xrange(lines):
+            end = self.buf.find('\n', pos)
+            if end < 0: # unterminated last line, let the token path complain
+                return None, None
+            row = self.buf[pos:end].split()
+            if len(row) != num:
+                return None, None
+            values.extend(row)
+            pos = end + 1
+        return values, end
+
+    def _skipLines_(self, lines):
+        """ moves the cursor behind the next lines newlines """
+        end = self._pos_ - 1
+        for i in xrange(lines):
+            end = self.buf.find('\n', end + 1)
+            if end < 0:
+                return None
+        return end
+
+    def getFloats(self, num, dtype):
+        """ decodes the rest of the current line straight from the buffer
+        with a single numpy call, see LexerBase.getFloats """
+        if self._next_ is None:
+            return None
+        if self.skim:
+            end = self._skipLines_(1)
+            if end is None:
+                return None
+            self.seek(end)
+            return SKIMMED
+        values, end = self._floatSpan_(1, num)
+        if values is None:
+            return None
+        try:
+            vector = numpy.array(values, dtype=dtype)
+        except ValueError:
+            return None
+        self.seek(end)
+        return vector
 
-    def getType(self, usetype):        
+    def getFloatRows(self, rows, columns, dtype):
+        """ decodes the whole matrix payload with a single numpy call,
+        see LexerBase.getFloatRows """
+        if self._next_ is None or rows < 1:
+            return None
+        if self.skim:
+            end = self._skipLines_(rows)
+            if end is None:
+                return None
+            self.seek(end + 1)
+            return SKIMMED
+        values, end = self._floatSpan_(rows, columns)
+        if values is None:
+            return None
         try:
-            retval = usetype(self.get())
+            matrix = numpy.array(values, dtype=dtype).reshape(rows, columns)
         except ValueError:
-            self.Error("couldn't convert mixture num to %r" % usetype)
-        return retval
+            return None
+        self.seek(end + 1)
+        return matrix
 
-        
-        
-    # def getRemaining(self):
-    #     ("get the elements remaining in the internal buffer, usually that is until newline\n"
-    #      "usually implies that this function probably is not a good idea")
-    #     if self.hasMore():
-    #         e = self.elements
-    #         self.elements = []
-    #         return e
-    #     return []
+    def skipToNextLine(self):
+        """skip to next newline + non newline item"""
+        e = self._next_
+        while e is not None and e != '\n':
+            e = self._advance_()
+        while e == '\n':
+            e = self._advance_()
+        return True
+
+
+def MakeLexer(filelike):
+    """ returns a BinaryLexer for HTK binary MMFs and a Lexer for text
+    MMFs, reading the content of filelike via MapFile """
+    buf, start = MapFile(filelike)
+    if BinaryLexer.detect_rex.search(buf[start:start + 4096]):
+        return BinaryLexer(buf, start)
+    return Lexer(buf, start)
+
+
+class BinaryLexer(LexerBase):
+    """ tokenizer for HTK binary MMFs (as written by HHEd/HERest -B).
+
+    Binary MMFs mix text and binary data: macro headers (~h "name") and
+    some option keywords stay text, all other keywords are written as
+    ':' followed by a one byte symbol code (see HTK_SYMBOLS).  Numbers
+    following a binary keyword are big-endian shorts (ints) and floats,
+    single ones are decoded with struct, vectors and matrices in one go
+    with numpy.frombuffer.
+    There are no newline elements, so skipToNextLine and getEOL do
+    nothing. """
+    __slots__ = "buf skim dtype lineBase _end_ _pos_ _next_ _next_pos_ _next_bin_ _binform_ _ret_elements_".split()
+    def __init__(self, filelike, pos=None):
+        if isinstance(filelike, (str, mmap.mmap)):
+            self.buf, start = filelike, 0
+        else:
+            self.buf, start = MapFile(filelike)
+        self.skim = False
+        self.dtype = DTYPE_FLOAT
+        self.lineBase = 0
+        self._end_ = len(self.buf)
+        self._next_ = None
+        self._next_bin_ = False
+        self._ret_elements_ = collections.deque(maxlen=10)
+        self.seek(start if pos is None else pos)
+
+    def tell(self):
+        return self._pos_
+
+    def seek(self, pos):
+        self._pos_ = pos
+        self._next_pos_ = None # the next element is scanned on demand
+        self._binform_ = False
+
+    def getLineNo(self):
+        return self.lineBase + self.buf[:self._pos_].count('\n') + 1
+
+    def getRetElements(self):
+        return list(self._ret_elements_)
+
+    def _scan_(self):
+        pos = self._pos_
+        if self.buf[pos:pos + 1] == ':': # the common case, a binary symbol
+            code = ord(self.buf[pos + 1:pos + 2] or '\xff')
+            if code < len(HTK_SYMBOLS):
+                self._next_ = HTK_SYMBOLS[code]
+                self._next_pos_ = pos + 2
+                self._next_bin_ = True
+                return
+        m = BinaryLexer.token_rex.match(self.buf, pos)
+        if m is None:
+            if self.buf[self._pos_:self._end_].strip():
+                self.Error("unexpected binary data %r" %
+                           self.buf[self._pos_:self._pos_ + 8])
+            self._next_ = None
+            self._next_pos_ = self._end_
+        elif m.group(1) is not None:
+            code = ord(m.group(1))
+            if code >= len(HTK_SYMBOLS):
+                self.Error("unknown binary symbol %d" % code)
+            self._next_ = HTK_SYMBOLS[code]
+            self._next_pos_ = m.end()
+            self._next_bin_ = True
+        else:
+            self._next_ = m.group(2)
+            self._next_pos_ = m.end()
+            self._next_bin_ = False
+
+    def peek(self):
+        if self._next_pos_ is None:
+            self._scan_()
+        return self._next_
+
+    def get(self):
+        e = self.peek()
+        if e is not None:
+            self._binform_ = self._next_bin_
+            self._pos_ = self._next_pos_
+            self._next_pos_ = None
+            self._ret_elements_.append(e)
+        return e
+
+    def getN(self, num):
+        result = []
+        while len(result) < num and self.peek() is not None:
+            result.append(self.get())
+        return result
+
+    def _read_(self, num):
+        """ reads num big-endian floats following the cursor """
+        size = 4 * num
+        if self._pos_ + size > self._end_:
+            self.Error("binary data ends within %d values" % num)
+        values = numpy.frombuffer(self.buf, '>f4', num, self._pos_)
+        self._pos_ += size
+        self._next_pos_ = None
+        return values
+
+    def getType(self, usetype, message=None):
+        if not self._binform_:
+            return LexerBase.getType(self, usetype, message)
+        # single numbers are decoded with struct, numpy is slow for these
+        scalar = BinaryLexer.short if usetype is int else BinaryLexer.float
+        pos = self._pos_
+        if pos + scalar.size > self._end_:
+            self.Error("binary data ends within a number")
+        value = usetype(scalar.unpack_from(self.buf, pos)[0])
+        self._pos_ = pos + scalar.size
+        self._next_pos_ = None
+        self._ret_elements_.append(value)
+        return value
+
+    def getFloats(self, num, dtype):
+        if not self._binform_:
+            return None
+        values = self._read_(num)
+        return SKIMMED if self.skim else values.astype(dtype)
+
+    def getFloatRows(self, rows, columns, dtype):
+        if not self._binform_:
+            return None
+        values = self._read_(rows * columns)
+        return SKIMMED if self.skim else values.astype(dtype).reshape(rows, columns)
+
+    def getEOL(self):
+        return '\n'
+
+    def getRequireEOL(self, context=""):
+        return '\n'
+
+    def skipToNextLine(self):
+        return True
+
+# keyword names by binary symbol code, in the order of the Symbol enum
+# of HTK's HModel.c (with the MSDINFO extension of HTS)
+HTK_SYMBOLS = [ "<%s>" % name for name in (
+    "BEGINHMM USE ENDHMM NUMMIXES NUMSTATES STREAMINFO MSDINFO VECSIZE "
+    "NULLD POISSOND GAMMAD RELD GEND DIAGC FULLC XFORMC STATE TMIX MIXTURE "
+    "STREAM SWEIGHTS MEAN VARIANCE INVCOVAR XFORM GCONST DURATION INVDIAGC "
+    "TRANSP DPROB LLTC LLTCOVAR PROJSIZE RCLASS REGTREE NODE TNODE HMMSETID "
+    "PARMKIND").split() ]
+HTK_SYMBOL_CODES = dict( (name, chr(code)) for code, name in enumerate(HTK_SYMBOLS) )
+BinaryLexer.short = struct.Struct('>h')
+BinaryLexer.float = struct.Struct('>f')
+BinaryLexer.token_rex = re.compile(r'\s*(?::(.)|(\<[^\>]+\>|~\w|\"[^\"]+\"|\'[^\']+\'|[^\<\s\"\'\>:]+))', re.S)
+# text MMFs contain neither NUL bytes nor ':' followed by a control character
+BinaryLexer.detect_rex = re.compile(r'\x00|:[\x00-\x08\x0b\x0c\x0e-\x1f]')
 
-    def skipIfNL(self):
-        if(self.peek()=='\n'):
-            self.skipToNextLine()
-                
 
-    
 #    r'(\n|\s+|(?<!\\)".*?(?<!\\)"|(?<!\\)\'.*?(?<!\\)\')'
-Lexer.split_rex = re.compile(r'(\n|\s+|\<[^\<\>]*\>|(?<!\\)".*?(?<!\\)"|(?<!\\)\'.*?(?<!\\)\')',re.MULTILINE)
-Lexer.find_rex  = re.compile(r'[^\<\s\t\"\'\>]+|\<[^\>]+\>|\n|\"[^\"]+\"|\'[^\']+\'')
+LexerBase.split_rex = re.compile(r'(\n|\s+|\<[^\<\>]*\>|(?<!\\)".*?(?<!\\)"|(?<!\\)\'.*?(?<!\\)\')',re.MULTILINE)
+LexerBase.find_rex  = re.compile(r'[^\<\s\t\"\'\>]+|\<[^\>]+\>|\n|\"[^\"]+\"|\'[^\']+\'')
 #r'[^\s\t\"\']+|\n|\"[^\"]+\"|\'[^\']+\'')
 #http://stackoverflow.com/questions/79968/split-a-string-by-spaces-preserving-quoted-substrings-in-python
 
+# default storage type of the parameters, see MMF
 DTYPE_FLOAT = numpy.float32
+# placeholder for payloads passed over by a skimming lexer
+SKIMMED = numpy.array([], dtype=DTYPE_FLOAT)
 #-------------------------------------------
 # PARSE TOOLS - Mean
 #-------------------------------------------
@@ -553,6 +1517,7 @@ def ParseUseMacro(lexer, context):
 
 def ParseMMF(lexer, mmf=None):
     if None == mmf: mmf = MMF()
+    keep = mmf.sources is not None
     while True:
         mtype = lexer.peek()
         if not mtype:
@@ -560,36 +1525,217 @@ def ParseMMF(lexer, mmf=None):
         elif mtype=='\n':
             mytpe = lexer.skipToNextLine()
             continue
-        
-        if mtype == '~o':
-            macro = mmf.findOrDeclareMacro("~o","")
-            macro.setTarget( ParseGlobalOpts(lexer))
-            continue
-        
-        macro = ParseUseMacro(lexer, mmf)
-        if mtype == "~e":
-            macro.setTarget( ParseDepTrans(lexer))
-        elif mtype=="~h":
-            macro.setTarget( ParseHMM(lexer,mmf))
-        elif (mtype=="~s"):
-            macro.setTarget( ParseMultiStream(lexer, mmf))
-        elif (mtype=="~p"): # or mtype=="~s"):
-            macro.setTarget( ParseStream(lexer, mmf))
-        elif mtype=="~t":
-            macro.setTarget( ParseTransp(lexer))
-        elif mtype=="~u":
-            macro.setTarget( ParseMean(lexer))
-        elif mtype=="~v":
-            macro.setTarget( ParseVariance(lexer))
-        elif mtype=="~w":
-            macro.setTarget( ParseSWeights(lexer))
+        if keep:
+            start = lexer.tell()
+            mmf.keepSource(ParseMacro(lexer, mmf), start, lexer.tell())
         else:
-            lexer.Error("at element %r " % mtype)
+            ParseMacro(lexer, mmf)
+    return mmf
+
+def ParseMacro(lexer, context):
+    """ parses one macro definition into context and returns its Macro """
+    mtype = lexer.peek()
+    if mtype == '~o':
+        macro = context.findOrDeclareMacro("~o","")
+        macro.setTarget( ParseGlobalOpts(lexer))
+        return macro
+
+    macro = ParseUseMacro(lexer, context)
+    if mtype == "~e":
+        macro.setTarget( ParseDepTrans(lexer))
+    elif mtype=="~h":
+        macro.setTarget( ParseHMM(lexer,context))
+    elif (mtype=="~s"):
+        macro.setTarget( ParseMultiStream(lexer, context))
+    elif (mtype=="~p"): # or mtype=="~s"):
+        macro.setTarget( ParseStream(lexer, context))
+    elif mtype=="~t":
+        macro.setTarget( ParseTransp(lexer))
+    elif mtype=="~u":
+        macro.setTarget( ParseMean(lexer))
+    elif mtype=="~v":
+        macro.setTarget( ParseVariance(lexer))
+    elif mtype=="~w":
+        macro.setTarget( ParseSWeights(lexer))
+    else:
+        lexer.Error("at element %r " % mtype)
     #    ehopstuvw
+    return macro
+
+def iterparse(filename, types=None, dtype=None):
+    """ yields (macroType, macroName, target) for the macros of filename
+    one at a time, only the macro at hand is kept in memory.  Macro
+    references in the targets are Macro objects without target.  With
+    types (like ["~p", "~s"]) only those macros are yielded, the others
+    are skimmed (their numbers are not decoded).  dtype as for MMF. """
+    if types is not None:
+        types = set( '~' + t.lstrip('~') for t in types )
+    f = fileio.openFile(filename, 'rb')
+    name = None
+    try:
+        if isinstance(f, file) or not BinaryLexer.detect_rex.search(f.peek(4096)[:4096]):
+            # plain files are mapped, compressed text is read line by line
+            lexer = MakeLexer(f) if isinstance(f, file) else LineLexer(f)
+        else:
+            name = fileio.decompressToTemp(f)
+            f.close()
+            f = open(name, 'rb')
+            lexer = MakeLexer(f)
+        skim = not isinstance(lexer, LineLexer)
+        context = MMF(dtype=dtype)
+        lexer.dtype = context.dtype
+        while True:
+            mtype = lexer.peek()
+            if not mtype:
+                break
+            elif mtype == '\n':
+                lexer.skipToNextLine()
+                continue
+            wanted = types is None or mtype in types
+            if skim and not wanted:
+                lexer.skim = True
+                try:
+                    ParseMacro(lexer, context)
+                finally:
+                    lexer.skim = False
+            else:
+                macro = ParseMacro(lexer, context)
+            context.macros.clear()
+            if wanted:
+                yield macro.macroType, macro.macroId, macro.target
+    finally:
+        f.close()
+        if name is not None:
+            os.remove(name)
+
+def ScanMMF(lexer, mmf):
+    """ records the offset of every macro definition in mmf.offsets
+    without keeping the parsed bodies.  Global options are small and
+    always needed, they are parsed into mmf right away.
+
+    Text MMFs are scanned with ScanTextMMF, otherwise the bodies are
+    parsed with a skimming lexer, so numeric payloads are passed over
+    instead of decoded. """
+    if isinstance(lexer, Lexer):
+        return ScanTextMMF(lexer, mmf)
+    scratch = MMF()
+    lexer.skim = True
+    try:
+        while True:
+            mtype = lexer.peek()
+            if not mtype:
+                break
+            elif mtype=='\n':
+                lexer.skipToNextLine()
+                continue
+            if mtype == '~o':
+                ParseMacro(lexer, mmf)
+                continue
+            pos = lexer.tell()
+            macro = ParseMacro(lexer, scratch)
+            mmf.offsets.setdefault(mtype, {})[macro.macroId] = pos
+    finally:
+        lexer.skim = False
     return mmf
 
+ScanTextMMF_rex = re.compile(r'~(?<!\S~)([ehopstuvw])(?:\s+("[^"]+"))?(?=\s*(\<[^\>]+\>)?)')
+# <STREAM> n, the rest of its line (ParseStream skips it) and whitespace
+# up to the end of the range searched
+ScanTextMMF_stream_rex = re.compile(r'\<STREAM\>\s*\d+[^\n]*\s*\Z')
+def ScanTextMMF(lexer, mmf):
+    """ ScanMMF for text MMFs, the macro headers are searched for in the
+    buffer directly.  References are told apart from definitions by
+    the grammar: bodies of ~h are skipped up to <ENDHMM>, a ~p that is
+    the next token after the line of a <STREAM> n belongs to a ~s and
+    ~e/~t/~u/~v/~w only start a definition if their body keyword follows.  Malformed bodies are
+    only reported when the macro is loaded. """
+    buf = lexer.buf
+    pos = lexer.tell()
+    while True:
+        m = ScanTextMMF_rex.search(buf, pos)
+        if m is None:
+            break
+        mtype, mname, following = m.groups()
+        last, pos = pos, m.end() # the tokens since the last header are in buf[last:]
+        if mtype == 'o':
+            ParseMacro(Lexer(buf, m.start()), mmf)
+            continue
+        if mname is None:
+            lexer.seek(m.start())
+            lexer.Error("macro %r without name" % ('~' + mtype))
+        if mtype == 'h':
+            end = buf.find('<ENDHMM>', pos)
+            pos = end if end >= 0 else len(buf)
+        elif mtype == 'p':
+            stream = buf.rfind('<STREAM>', last, m.start())
+            if stream >= 0 and ScanTextMMF_stream_rex.match(buf, stream, m.start()):
+                continue
+        elif mtype in ScanTextMMF.bodies and following != ScanTextMMF.bodies[mtype]:
+            continue
+        mmf.offsets.setdefault('~' + mtype, {})[mname.strip(' "\'')] = m.start()
+    return mmf
+ScanTextMMF.bodies = {'e': '<DEPCLASS>', 't': '<TRANSP>', 'u': '<MEAN>',
+                      'v': '<VARIANCE>', 'w': '<SWEIGHTS>'}
+
     
 
+def ParseMMFParallel(lexer, filename, processes, mmf=None):
+    """ ParseMMF with a pool of processes.  The file is split at macro
+    definitions (found by ScanMMF) into a few chunks per process, each
+    chunk is parsed by _ParseChunk and sent back in the encoding of the
+    model cache.  The chunks are merged in file order, declaring every
+    macro through findOrDeclareMacro, so references between chunks are
+    resolved just like forward references in a serial parse and the
+    result is the same.  Each job knows the line its chunk starts at, so
+    errors report the lines of the file like a serial parse. """
+    import cache # cache imports this module
+    if None == mmf: mmf = MMF()
+    start, end = lexer.tell(), len(lexer.buf)
+    starts = sorted( pos for offsets in ScanMMF(lexer, MMF()).offsets.itervalues()
+                     for pos in offsets.itervalues() )
+    chunks = processes * 4
+    bounds = [start]
+    for i in xrange(1, chunks):
+        k = bisect.bisect_left(starts, start + (end - start) * i // chunks)
+        if k < len(starts) and starts[k] > bounds[-1]:
+            bounds.append(starts[k])
+    bounds.append(end)
+    lines = [lexer.buf[:start].count('\n')]
+    for i in xrange(1, len(bounds) - 1):
+        lines.append(lines[-1] + lexer.buf[bounds[i - 1]:bounds[i]].count('\n'))
+    jobs = [ (filename, lexer.__class__.__name__, lexer.dtype, bounds[i], bounds[i + 1], lines[i])
+             for i in xrange(len(bounds) - 1) ]
+    pool = multiprocessing.Pool(processes)
+    try:
+        for records, payload in pool.imap(_ParseChunk, jobs):
+            with cache.NoGC():
+                cache.decodeMMF(marshal.loads(records),
+                                numpy.frombuffer(payload, numpy.uint8), mmf)
+    finally:
+        pool.close()
+        pool.join()
+    return mmf
+
+def _ParseChunk(job):
+    """ worker of ParseMMFParallel, parses bytes start:end of filename
+    (lines lines come before start) """
+    import cache
+    filename, lexerName, dtype, start, end, lines = job
+    f = open(filename, 'rb')
+    try:
+        buf, offset = MapFile(f)
+    finally:
+        f.close()
+    encoder = cache.Encoder()
+    with cache.NoGC():
+        lexer = globals()[lexerName](buf[start:end])
+        lexer.dtype = dtype
+        lexer.lineBase = lines
+        chunk = ParseMMF( lexer, MMF(dtype=dtype))
+        records = cache.encodeMMF(chunk, encoder)
+    # strings travel through the pool much faster than pickled records
+    return marshal.dumps(records), encoder.payload().tostring()
+
 def ParseHMM(lexer, context):
     hmm = HMM()
     lexer.getRequireNext("<BEGINHMM>")
@@ -755,7 +1901,7 @@ def ParseMixture(lexer,context):
         if mixNum != i :
             lexer.Error("retrieved mixture number, but it was %d instead %d" %\
                         (mixNum, i))
-        weight = lexer.getType(DTYPE_FLOAT)
+        weight = lexer.getType(lexer.dtype)
         lexer.skipToNextLine()
         pdf = ParsePDF(lexer, context)
         mixture.weights[i] = weight
@@ -764,29 +1910,31 @@ def ParseMixture(lexer,context):
 
 def ParseGConst(lexer):
     lexer.getRequireNext("<GCONST>")
-    try:
-        val = DTYPE_FLOAT(lexer.get())
-    except ValueError:
-        lexer.Error("couldn't convert gconst value to float")
+    val = lexer.getType(lexer.dtype, "couldn't convert gconst value to float")
     lexer.skipToNextLine()
     return val
 
 def ParseVector(lexer, tag):
     lexer.getRequireNext(tag)
-    try:
-        val = int(lexer.get())
-    except ValueError:
-        lexer.Error("couldn't convert  size of %s entry  to int" % tag)
+    val = lexer.getType(int, "couldn't convert  size of %s entry  to int" % tag)
     lexer.skipToNextLine()
     if(val>0):
-        values = lexer.getN(val)
-        try:
-            vector = numpy.array( values, dtype= DTYPE_FLOAT)
-        except ValueError:
-            lexer.Error("couldn't convert %s data (n:%d) to floats" % (tag,val))
-        lexer.getRequireNext("\n", context="%d values to be read, got: %r" % (val,values))
+        vector = lexer.getFloats(val, lexer.dtype)
+        if vector is None:
+            values = lexer.getN(val)
+            try:
+                vector = numpy.array( values, dtype= lexer.dtype)
+            except ValueError:
+                lexer.Error("couldn't convert %s data (n:%d) to floats" % (tag,val))
+        else:
+            values = vector
+        # same check as getRequireNext, but the context is only formatted on failure
+        nl = lexer.getEOL()
+        if nl != "\n":
+            lexer.Error("lexer returned %r but %r was expected - %s" %
+                        (nl, "\n", "%d values to be read, got: %r" % (val,values)))
     else:
-        vector= numpy.array([], dtype=DTYPE_FLOAT)
+        vector= numpy.array([], dtype=lexer.dtype)
     return vector
 
 
@@ -809,12 +1957,15 @@ def ParseMatrix(lexer, tag, two_dims=False):
     else:
         columns = rows
     lexer.skipIfNL()
+    result = lexer.getFloatRows(rows, columns, lexer.dtype)
+    if result is not None:
+        return result
     values = []
     for i in xrange(rows):
         values.append( lexer.getN(columns))
-        lexer.getRequireNext('\n')
+        lexer.getRequireEOL()
     try:
-        result = numpy.array(values, dtype=DTYPE_FLOAT)
+        result = numpy.array(values, dtype=lexer.dtype)
     except ValueError:
         lexer.Error("couldn't convert %s values to float: %r" % (tag,values))
     return result
@@ -826,6 +1977,54 @@ def ParseDepTrans(lexer):
     return ParseMatrix(lexer, "<DEPCLASS>", two_dims=True)
 
 # --------------------------------WRITING to file --------------------------------------------
+# The Write* functions below produce many small strings, WriteMMF passes
+# them a WriteBuffer so they reach the file in large blocks.  Numbers are
+# formatted a whole vector or matrix at a time with one %-operation, the
+# output is the same as the former numpy.savetxt(fmt=' %10.6e') lines.
+#
+# Writing to a WriteBuffer with binary=True produces HTK binary MMFs (as
+# BinaryLexer reads them): keywords become ':' and their symbol code,
+# numbers big-endian shorts and floats, macro headers stay text.
+
+class WriteBuffer(object):
+    """ file-like collecting writes, flush() passes them on to fileobj
+    as one string """
+    __slots__ = "fileobj parts write limit binary".split()
+    def __init__(self, fileobj, limit=1 << 14, binary=False):
+        self.fileobj = fileobj
+        self.parts = []
+        self.write = self.parts.append
+        self.limit = limit # number of pieces for full()
+        self.binary = binary
+
+    def full(self):
+        return len(self.parts) >= self.limit
+
+    def flush(self):
+        self.fileobj.write("".join(self.parts))
+        del self.parts[:]
+
+def FormatRows(matrix):
+    """ the lines of a 2d array, ' %10.6e' per value """
+    rows, cols = matrix.shape
+    rowFormat = FormatRows.formats.get(cols)
+    if rowFormat is None:
+        rowFormat = FormatRows.formats[cols] = ' %10.6e' * cols + '\n'
+    if rows == 1:
+        return rowFormat % tuple(matrix.ravel().tolist())
+    return (rowFormat * rows) % tuple(matrix.ravel().tolist())
+FormatRows.formats = {}
+
+def isBinary(fileobj):
+    return getattr(fileobj, 'binary', False)
+
+def BinaryKeyword(name, *shorts):
+    """ binary form of keyword name (like "<MEAN>") and the shorts following it """
+    return ':' + HTK_SYMBOL_CODES[name] + struct.pack('>%dh' % len(shorts), *shorts)
+
+def BinaryFloats(values):
+    return numpy.asarray(values, dtype='>f4').tostring()
+
 def WriteUseMacro(fileobj, macro):
     fileobj.write('%s "%s"\n' % (macro.macroType, macro.macroId))
     pass
@@ -839,35 +2038,52 @@ def WritePDF(fileobj, pdf):
         WriteUseMacro(fileobj, pdf.variances)
     else:
         WriteVector(fileobj,"<VARIANCE>", pdf.variances)
-    if pdf.gconst!=None:
+    if pdf.gconst is not None:
         WriteGConst(fileobj, pdf.gconst)
 def WriteGConst(fileobj, gconst):
+    if isBinary(fileobj):
+        fileobj.write(BinaryKeyword("<GCONST>") + BinaryFloats([gconst]))
+        return
     fileobj.write("<GCONST> %10.6e \n" % gconst)
 
 def WriteVector(filobj, name, vector):
-    vecview = vector.reshape(1,-1)
     veclen  = vector.shape[-1]
-    filobj.write("%s %d\n" % (name, veclen))
-    if veclen > 0:        
-        numpy.savetxt(filobj, vecview, delimiter='', fmt=' %10.6e')
+    if isBinary(filobj):
+        filobj.write(BinaryKeyword(name, veclen) + BinaryFloats(vector.ravel()))
+    elif veclen > 0:
+        filobj.write("%s %d\n%s" % (name, veclen, FormatRows(vector.reshape(1,-1))))
+    else:
+        filobj.write("%s %d\n" % (name, veclen))
 
 def WriteMatrix(filobj, name, matrix, two_dims=False):
+    if isBinary(filobj) and name in HTK_SYMBOL_CODES:
+        shape = matrix.shape if two_dims else matrix.shape[:1]
+        filobj.write(BinaryKeyword(name, *shape) + BinaryFloats(matrix.ravel()))
+        return
+    # keywords without a binary symbol (<DEPCLASS>) are written as text
     if two_dims:
         filobj.write("%s %d %d\n" % (name, matrix.shape[0], matrix.shape[1]))
     else:
         filobj.write("%s %d\n" % (name, matrix.shape[0]))
-    (rows, cols) = matrix.shape
-    numpy.savetxt(filobj, matrix, delimiter='', fmt=' %10.6e')
+    if matrix.size > 0:
+        filobj.write(FormatRows(matrix))
     
 def WriteMixture(fileobj, mixture):
+    binary = isBinary(fileobj)
     if not mixture.pseudo:
-        fileobj.write("<NUMMIXES> %d\n" % len(mixture.pdfs))
+        if binary:
+            fileobj.write(BinaryKeyword("<NUMMIXES>", len(mixture.pdfs)))
+        else:
+            fileobj.write("<NUMMIXES> %d\n" % len(mixture.pdfs))
     keys = sorted( mixture.pdfs.iterkeys())
     if mixture.pseudo:
         WritePDF( fileobj, mixture.pdfs[ keys[0]])
     else:
         for k in keys:
-            fileobj.write("<MIXTURE> %d %10.6e\n" % (k, mixture.weights[k]) )
+            if binary:
+                fileobj.write(BinaryKeyword("<MIXTURE>", k) + BinaryFloats([mixture.weights[k]]))
+            else:
+                fileobj.write("<MIXTURE> %d %10.6e\n" % (k, mixture.weights[k]) )
             WritePDF( fileobj, mixture.pdfs[ k ] )
 
 #def WriteDepTrans(fileobj, deptrans):
@@ -879,9 +2095,13 @@ def WriteMultiStream(fileobj, multistream):
 
 
 def WriteStream(fileobj, stream):
-    if not stream.pseudo:
+    if stream.pseudo:
+        pass
+    elif isBinary(fileobj):
+        fileobj.write(BinaryKeyword("<STREAM>", stream.streamNumber))
+    else:
         fileobj.write("<STREAM> %d\n" % stream.streamNumber)
-    if stream.deptrans != None:
+    if stream.deptrans is not None:
         if isMacro(stream.deptrans):
             WriteUseMacro(fileobj, stream.deptrans)
         else:
@@ -892,18 +2112,38 @@ def WriteStream(fileobj, stream):
         WriteMixture(fileobj,stream.mixture)
 
 def WriteState(fileobj, state):
-    fileobj.write("<STATE> %d\n" % state.number)
+    if isBinary(fileobj):
+        fileobj.write(BinaryKeyword("<STATE>", state.number))
+    else:
+        fileobj.write("<STATE> %d\n" % state.number)
     if isMacro(state.weight):
         WriteUseMacro(fileobj, state.weight)
-    elif len(state.weight)>0:
-        WriteVector(fileobj, "<SWEIGHTS>", state.vector)
+    elif state.weight is not None and len(state.weight)>0:
+        WriteVector(fileobj, "<SWEIGHTS>", state.weight)
     if isMacro(state.stream) and macroType(state.stream)=='~s':
         WriteUseMacro(fileobj, state.stream)
     else:
         keys = sorted( state.stream.iterkeys())
         for k in keys:
             WriteStream(fileobj, state.stream[k])
+def WriteBinaryGlobalOpts(fileobj, gopts):
+    fileobj.write("~o\n")
+    nums = [ gopts.streaminfo[k] for k in sorted(gopts.streaminfo.iterkeys())]
+    fileobj.write(BinaryKeyword("<STREAMINFO>", len(nums), *nums))
+    if gopts.msdinfo != None:
+        msd  = [ gopts.msdinfo[k] for k in sorted(gopts.msdinfo.iterkeys())]
+        fileobj.write(BinaryKeyword("<MSDINFO>", len(msd), *msd))
+    if gopts.vecsize != None:
+        fileobj.write(BinaryKeyword("<VECSIZE>", gopts.vecsize))
+    # the kinds stay text, in the order of HTK's text MMFs
+    for kind in (gopts.durkind, gopts.parmkind, gopts.covkind):
+        if kind is not None:
+            fileobj.write("<%s>" % kind)
+    fileobj.write('\n')
+
 def WriteGlobalOpts(fileobj, gopts):
+    if isBinary(fileobj):
+        return WriteBinaryGlobalOpts(fileobj, gopts)
     fileobj.write("~o \n")
     # stream info
     nums = [ str(gopts.streaminfo[k]) for k in sorted(gopts.streaminfo.iterkeys())]
@@ -927,8 +2167,12 @@ def WriteGlobalOpts(fileobj, gopts):
     fileobj.write('\n')
     pass
 def WriteHMM(fileobj, hmm):
-    fileobj.write("<BEGINHMM>\n")
-    fileobj.write("<NUMSTATES> %d\n" % (hmm.numstates) )
+    binary = isBinary(fileobj)
+    if binary:
+        fileobj.write(BinaryKeyword("<BEGINHMM>") + BinaryKeyword("<NUMSTATES>", hmm.numstates))
+    else:
+        fileobj.write("<BEGINHMM>\n")
+        fileobj.write("<NUMSTATES> %d\n" % (hmm.numstates) )
     keys = sorted( hmm.state.iterkeys())
     for k in keys:
         WriteState(fileobj, hmm.state[k])
@@ -937,32 +2181,154 @@ def WriteHMM(fileobj, hmm):
     else:
         WriteMatrix(fileobj, "<TRANSP>", hmm.transp)
         
-    fileobj.write("<ENDHMM>\n")
+    fileobj.write(BinaryKeyword("<ENDHMM>") if binary else "<ENDHMM>\n")
     
-def WriteMMF(fileobj, mmfile):
-    WriteGlobalOpts(fileobj,mmfile.getMacro("~o","").target)
-    for macro_type in WriteMMF.macro_order:
-        if not mmfile.macros.has_key("~"+macro_type):
+def DedupMMF(mmfile, minVectorSize=4):
+    """ a copy of mmfile in which content that is written more than once
+    is shared through macros: identical inline streams of the ~h states
+    become ~p macros, identical mean and variance vectors (of at least
+    minVectorSize values, shorter ones are smaller than a reference) of
+    the inline and the new ~p pdfs become ~u and ~v macros.  The new
+    macros are named by content hash, mmfile is not changed. """
+    mmfile.loadAll()
+    result = MMF()
+    for mtype, macros in mmfile.macros.iteritems():
+        result.macros[mtype].update(macros)
+    # unchanged macros can still be copied from the source
+    result.buf, result.sources = mmfile.buf, mmfile.sources
+    hashes = {} # id -> content hash, the same objects are often shared
+    def contentHash(value):
+        key = id(value)
+        if key not in hashes:
+            hashes[key] = ContentHash(value)
+        return hashes[key]
+    def isInline(stream):
+        return type(stream) is Stream and not isMacro(stream.mixture)
+    def states():
+        for macro in result.macros.get('~h', {}).itervalues():
+            if type(macro.target) is HMM:
+                for state in macro.target.state.itervalues():
+                    if type(state) is State and type(state.stream) is dict:
+                        yield state
+
+    # streams used more than once become ~p macros
+    counts = collections.defaultdict(int)
+    for state in states():
+        for stream in state.stream.itervalues():
+            if isInline(stream):
+                counts[contentHash(stream)] += 1
+    shared = {}
+    def sharedStream(stream):
+        key = contentHash(stream)
+        if counts[key] < 2:
+            return stream
+        if key not in shared:
+            shared[key] = result.findOrDeclareMacro('~p', 'shared_p_' + key[:20])
+            shared[key].setTarget(stream)
+        return Stream(stream.streamNumber, shared[key], None, stream.pseudo)
+    for macro in result.macros.get('~h', {}).values():
+        if type(macro.target) is not HMM:
             continue
+        hmm = macro.target
+        newStates = {}
+        for k, state in hmm.state.iteritems():
+            if type(state) is State and type(state.stream) is dict:
+                state = State(state.number, dict( (n, sharedStream(stream) if isInline(stream)
+                                                      else stream)
+                                                  for n, stream in state.stream.iteritems() ),
+                              state.weight)
+            newStates[k] = state
+        result.macros['~h'][macro.macroId] = Macro('~h', macro.macroId,
+                                                   HMM(hmm.numstates, newStates, hmm.transp))
+
+    # vectors used more than once become ~u/~v macros
+    streams = [ macro.target for macro in shared.itervalues() ]
+    streams.extend( stream for state in states() for stream in state.stream.itervalues()
+                    if isInline(stream) )
+    def vectors(stream):
+        for pdf in stream.mixture.pdfs.itervalues():
+            for mtype, vector in (('~u', pdf.means), ('~v', pdf.variances)):
+                if type(vector) is numpy.ndarray and vector.size >= minVectorSize:
+                    yield mtype, vector
+    counts = collections.defaultdict(int)
+    for stream in streams:
+        for mtype, vector in vectors(stream):
+            counts[mtype, contentHash(vector)] += 1
+    def sharedVector(mtype, vector):
+        if type(vector) is not numpy.ndarray or vector.size < minVectorSize:
+            return vector
+        key = contentHash(vector)
+        if counts[mtype, key] < 2:
+            return vector
+        macro = result.findOrDeclareMacro(mtype, 'shared_%s_%s' % (mtype[1], key[:20]))
+        macro.setTarget(vector)
+        return macro
+    replaced = {}
+    def sharedVectors(stream):
+        key = id(stream)
+        if key not in replaced:
+            mixture = stream.mixture
+            pdfs = dict( (k, PDF(sharedVector('~u', pdf.means),
+                                 sharedVector('~v', pdf.variances), pdf.gconst))
+                         for k, pdf in mixture.pdfs.iteritems() )
+            replaced[key] = Stream(stream.streamNumber,
+                                   Mixture(pdfs, mixture.weights, mixture.pseudo),
+                                   stream.deptrans, stream.pseudo)
+        return replaced[key]
+    for macro in shared.itervalues():
+        macro.setTarget(sharedVectors(macro.target))
+    for state in states():
+        for n, stream in state.stream.items():
+            if isInline(stream):
+                state.stream[n] = sharedVectors(stream)
+    return result
+
+def WriteMMF(fileobj, mmfile, binary=False, dedup=False):
+    """ writes mmfile, in HTK binary format if binary is set (fileobj
+    should be opened in binary mode then), with repeated content shared
+    through macros if dedup is set (see DedupMMF).  Macros of an MMF
+    loaded with keepSource=True that were not modified since are copied
+    from the source (see MMF.getSource) when writing text, macros that
+    were declared but never defined are left out.  The macros of a type
+    are written sorted by name. """
+    if dedup:
+        mmfile = DedupMMF(mmfile)
+    out = WriteBuffer(fileobj, binary=binary)
+    getSource = (lambda mtype, mname: None) if binary else mmfile.getSource
+    source = getSource("~o", "")
+    if source is not None:
+        out.write(source)
+    else:
+        WriteGlobalOpts(out,mmfile.getMacro("~o","").target)
+    for macro_type in WriteMMF.macro_order:
         macros = mmfile.getMacros("~"+macro_type)
-        for macro in macros:
+        if macros is None:
+            continue
+        for macro in sorted(macros):
             target = macros[macro].target
-            WriteUseMacro(fileobj, macros[macro])
+            if target is None:
+                continue
+            source = getSource("~"+macro_type, macro)
+            if source is not None:
+                out.write(source)
+                continue
+            WriteUseMacro(out, macros[macro])
             if macro_type in WriteMMF.macro_explicit:
                 if macro_type=="u":
-                    WriteVector(fileobj, "<MEAN>", target)
+                    WriteVector(out, "<MEAN>", target)
                 elif macro_type=="v":
-                    WriteVector(fileobj, "<VARIANCE>", target)
+                    WriteVector(out, "<VARIANCE>", target)
                 elif macro_type=="t":
-                    WriteMatrix(fileobj, "<TRANSP>", target, False)
+                    WriteMatrix(out, "<TRANSP>", target, False)
                 elif macro_type=="e":
-                    WriteMatrix(fileobj, "<DEPCLASS>", target, True)
+                    WriteMatrix(out, "<DEPCLASS>", target, True)
                 elif macro_type=="s":
-                    WriteMultiStream(fileobj, target)
+                    WriteMultiStream(out, target)
             else:
-                WriteMMF.writers[target.__class__.__name__]( fileobj, target)
-
-    pass
+                WriteMMF.writers[target.__class__.__name__]( out, target)
+            if out.full():
+                out.flush()
+    out.flush()
 WriteMMF.macro_order="eutvwpsh"
 WriteMMF.macro_explicit=set("etvus")
 WriteMMF.writers = {
@@ -973,3 +2339,18 @@ WriteMMF.writers = {
     'Mixture': WriteMixture,
     
     }
+
+
+if __name__ == '__main__':
+    import sys
+    args = sys.argv[1:]
+    names = '-n' in args
+    if names:
+        args.remove('-n')
+    if len(args) != 3 or args[0] != 'diff':
+        sys.exit("Usage: python mmf.py diff [-n] <mmf a> <mmf b>\n"
+                 "  compares the macros of two MMFs, -n lists the differing macros;\n"
+                 "  exits with 1 if they differ")
+    differences = diff(MMF(args[1]), MMF(args[2]))
+    print FormatDiff(differences, names)
+    sys.exit(1 if any(differences) else 0)
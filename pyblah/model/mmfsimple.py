@@ -1,17 +1,23 @@
 #!/usr/bin/python
 
 import re
+import array
 import logging
 
+import numpy
+
+import fileio
+
 logger = logging.getLogger("mmf")
 
 #-------------------------------------------
 # PDFInfo
 #-------------------------------------------
 class PDFInfo:
+    """Means and variances of a pdf, always as float numpy arrays."""
     def __init__(self):
-        self.means = []
-        self.variances = []
+        self.means = numpy.zeros(0)
+        self.variances = numpy.zeros(0)
         
     def setMeans(self, m):
         self.means = m
@@ -113,19 +119,225 @@ class SMacro:
 #<STREAM> 2
 #~p "logF0_s2_15-2"
 #-------------------------------------------
-class LabelEntry:                
-    def __init__(self, name):
+class LabelEntry(object):
+    """ a ~h context of a full mmf; the macros it uses are looked up in
+    the ContextIndex it was loaded into """
+    __slots__ = 'name index number'.split()
+    cphone_rex = re.compile('([^ -]+)\-([^ \+]+)\+')
+
+    def __init__(self, name, index=None, number=None):
         self.name = name
-        self.cphone = ""
-        
-        ret = re.match('([^ -]+)\-([^ \+]+)\+', self.name)
-        if ret: self.cphone = ret.group(2)
-        
-        #print 'C-Phone for ' + self.name + " is " + self.cphone             
-        
-        self.associatedMacroNames = []
-    
-        
+        self.index = index
+        self.number = number
+
+    @property
+    def cphone(self):
+        ret = LabelEntry.cphone_rex.match(self.name)
+        return ret.group(2) if ret else ""
+
+    @property
+    def associatedMacroNames(self):
+        if self.index is None:
+            return []
+        return self.index.macrosOf(self.number)
+
+    def __eq__(self, other):
+        return isinstance(other, LabelEntry) and self.name == other.name and \
+               self.index is other.index and self.number == other.number
+    def __ne__(self, other):
+        return not self == other
+    def __hash__(self):
+        return hash(self.name)
+    def __repr__(self):
+        return "LabelEntry(%r)" % self.name
+
+
+#-------------------------------------------
+# ContextIndex
+#-------------------------------------------
+class ContextIndex(object):
+    """ which ~p/~s macros the ~h contexts of a full mmf use, and back.
+
+    Contexts and macros are numbered in the order they are first seen
+    and both directions are kept as CSR arrays: the macros of context c
+    are macroIds[macroPtr[c]:macroPtr[c+1]], the contexts of macro m are
+    contextIds[contextPtr[m]:contextPtr[m+1]] (in file order).  The
+    forward arrays are filled while the file is read (addContext,
+    addMacro), finish derives the reverse ones.  Contexts added after
+    finish (another file) extend the index, finish has to be called
+    again then. """
+    __slots__ = ('contexts macros macroNumbers macroPtr macroIds '
+                 'contextPtr contextIds').split()
+
+    def __init__(self):
+        self.contexts = []         # context names by number
+        self.macros = []           # macro names by number
+        self.macroNumbers = {}
+        self.macroPtr = array.array('i')
+        self.macroIds = array.array('i')
+        self.contextPtr = None
+        self.contextIds = None
+
+    def _reopen_(self):
+        """ the forward arrays as array.arrays again after finish """
+        if isinstance(self.macroPtr, numpy.ndarray):
+            self.macroPtr = array.array('i', self.macroPtr[:-1].tostring())
+            self.macroIds = array.array('i', self.macroIds.tostring())
+            self.contextPtr = self.contextIds = None
+
+    def addContext(self, name):
+        """ starts the next context, returns its number """
+        self._reopen_()
+        self.contexts.append(intern(name))
+        self.macroPtr.append(len(self.macroIds))
+        return len(self.contexts) - 1
+
+    def addMacro(self, name):
+        """ adds a macro used by the last context """
+        self._reopen_()
+        number = self.macroNumbers.get(name)
+        if number is None:
+            number = self.macroNumbers[intern(name)] = len(self.macros)
+            self.macros.append(name)
+        self.macroIds.append(number)
+
+    def finish(self):
+        """ turns the forward arrays into numpy arrays and builds the
+        reverse ones """
+        self.macroPtr.append(len(self.macroIds))
+        self.macroPtr = numpy.frombuffer(self.macroPtr, numpy.intc)
+        self.macroIds = numpy.frombuffer(self.macroIds, numpy.intc)
+        counts = numpy.bincount(self.macroIds, minlength=len(self.macros))
+        self.contextPtr = numpy.zeros(len(self.macros) + 1, numpy.intc)
+        numpy.cumsum(counts, out=self.contextPtr[1:])
+        # a stable sort keeps the contexts of each macro in file order
+        owners = numpy.repeat(numpy.arange(len(self.contexts), dtype=numpy.intc),
+                              numpy.diff(self.macroPtr))
+        self.contextIds = owners[numpy.argsort(self.macroIds, kind='mergesort')]
+
+    def macrosOf(self, context):
+        """ names of the macros context (a number) uses """
+        ids = self.macroIds[self.macroPtr[context]:self.macroPtr[context + 1]]
+        return [ self.macros[i] for i in ids ]
+
+    def contextsOf(self, macro):
+        """ numbers of the contexts using the macro named macro """
+        number = self.macroNumbers.get(macro)
+        if number is None:
+            return self.contextIds[:0]
+        return self.contextIds[self.contextPtr[number]:self.contextPtr[number + 1]]
+
+    def nbytes(self):
+        """ bytes taken by the arrays """
+        return sum( values.nbytes for values in (self.macroPtr, self.macroIds,
+                                                 self.contextPtr, self.contextIds) )
+
+
+class MacroToLabels(object):
+    """ read-only mapping of macro names to the LabelEntrys using them,
+    a view of the ContextIndex of an HTSMMF """
+    __slots__ = 'index labels'.split()
+    def __init__(self, index, labels):
+        self.index = index
+        self.labels = labels
+
+    def __getitem__(self, name):
+        if name not in self.index.macroNumbers:
+            raise KeyError(name)
+        return [ self.labels[i] for i in self.index.contextsOf(name) ]
+    def get(self, name, default=None):
+        return self[name] if name in self else default
+    def __contains__(self, name):
+        return name in self.index.macroNumbers
+    has_key = __contains__
+    def __len__(self):
+        return len(self.index.macros)
+    def __iter__(self):
+        return iter(self.index.macros)
+    def keys(self):
+        return list(self.index.macros)
+    def iteritems(self):
+        for name in self.index.macros:
+            yield name, self[name]
+    def items(self):
+        return list(self.iteritems())
+
+
+#-------------------------------------------
+# MonoReader
+#-------------------------------------------
+class MonoReader(object):
+    """ state of HTSMMF.loadMonoMMF: the line handlers by first token,
+    each gets the line split into that token and the rest """
+    __slots__ = 'mmf file hmm state stream mixture'.split()
+
+    def __init__(self, mmf, mmfFile):
+        self.mmf = mmf
+        self.file = mmfFile
+        self.hmm = self.state = self.stream = self.mixture = None
+
+    def readVector(self):
+        """ the values on the next line as a numpy array, malformed
+        values raise a ValueError """
+        return numpy.array(self.file.readline().split(), float)
+
+    # ~h "A"
+    def hmacro(self, parts):
+        if len(parts) < 2 or not parts[1].startswith('"'):
+            return
+        self.hmm = HMacro(parts[1].split('"')[1])
+        self.mmf.macroList.append(self.hmm)
+        self.mmf.macroDict[ self.hmm.name ] = self.hmm
+        self.state = self.stream = self.mixture = None
+        logger.info('Loading macro %s', self.hmm.name)
+
+    # <STATE> 2
+    def stateTag(self, parts):
+        self.state = StateInfo(self.hmm, int(parts[1]))
+        self.hmm.addStateInfo(self.state)
+        self.stream = self.mixture = None
+
+    # <STREAM> 1
+    def streamTag(self, parts):
+        self.stream = StreamInfo(self.state, int(parts[1]))
+        self.state.addStreamInfo(self.stream)
+        self.mmf.streamList.append(self.stream)
+        self.mixture = None
+
+    # <MIXTURE> 1 9.999700e-01
+    def mixtureTag(self, parts):
+        number, weight = parts[1].split()
+        self.mixture = MixtureInfo(self.stream, int(number))
+        self.mixture.setWeight(float(weight))
+        self.stream.addMixtureInfo(self.mixture)
+
+    def readPDFVector(self, parts, setter):
+        """ reads the values of a <MEAN>/<VARIANCE> line into the pdf of
+        the current mixture (a single mixture is implicit).  The unvoiced
+        space of a multi space distribution has <MEAN> 0 and no pdf """
+        if self.stream is None:
+            return
+        if self.mixture is None:
+            self.mixture = MixtureInfo(self.stream, 1)
+            self.mixture.setWeight(1.0)
+            self.stream.addMixtureInfo(self.mixture)
+        if int(parts[1]) > 0:
+            if self.mixture.pdf is None:
+                self.mixture.setPDF(PDFInfo())
+            setter(self.mixture.pdf, self.readVector())
+
+    # <MEAN> 120
+    def meanTag(self, parts):
+        self.readPDFVector(parts, PDFInfo.setMeans)
+
+    # <VARIANCE> 120
+    def varianceTag(self, parts):
+        self.readPDFVector(parts, PDFInfo.setVariances)
+
+MonoReader.dispatch = { '~h': MonoReader.hmacro, '<STATE>': MonoReader.stateTag,
+                        '<STREAM>': MonoReader.streamTag, '<MIXTURE>': MonoReader.mixtureTag,
+                        '<MEAN>': MonoReader.meanTag, '<VARIANCE>': MonoReader.varianceTag }
+
 
 #-------------------------------------------
 # HTSMMF
@@ -142,7 +354,8 @@ class HTSMMF:
 
         self.labelList = []              # for full mmf, contains LabelEntry
         self.labelDict = {}              # for full mmf, contains LabelEntry
-        self.macroToLabels = {}          # for full mmf, contains nameof(~p) -> [ ~h ~h ~h ], ie. mcep_s2_234 -> [ x^x-sil.., x^sil-OY.., ... ]
+        self.contextIndex = ContextIndex()   # for full mmf, ~h <-> ~p/~s
+        self.macroToLabels = MacroToLabels(self.contextIndex, self.labelList) # for full mmf, nameof(~p) -> [ ~h ~h ~h ], ie. mcep_s2_234 -> [ x^x-sil.., x^sil-OY.., ... ]
         self.pmacroDict = {}             # for full mmf, contains PMacro objects
         self.smacroDict = {}             # for full mmf, contains SMacro objects
         
@@ -197,12 +410,12 @@ class HTSMMF:
             # read means for current stream/mix/pdf
             elif stream and line.startswith( "<MEAN>" ):
                 line = mmfFile.readline().strip()
-                mix.pdf.setMeans(map(float, line.split()))
+                mix.pdf.setMeans(numpy.array(line.split(), float))
                 
             # read variances for current stream/mix/pdf                
             elif stream and line.startswith( "<VARIANCE>" ):                 
                 line = mmfFile.readline().strip()
-                mix.pdf.setVariances(map(float, line.split()))               
+                mix.pdf.setVariances(numpy.array(line.split(), float))               
             
             line = mmfFile.readline().strip()                        
                   
@@ -240,10 +453,10 @@ class HTSMMF:
                 line = mmfFile.readline().strip()
                 if line.startswith("<MEAN>"):
                     line = mmfFile.readline().strip()
-                    pdf.setMeans(map(float, line.split()))
+                    pdf.setMeans(numpy.array(line.split(), float))
                 elif line.startswith("<VARIANCE>"):
                     line = mmfFile.readline().strip()
-                    pdf.setVariances(map(float, line.split()))                    
+                    pdf.setVariances(numpy.array(line.split(), float))                    
                 else: 
                     return
             #TODO: logf0, bndap            
@@ -259,11 +472,12 @@ class HTSMMF:
         
     # loadFullMMF
     def loadFullMMF(self, path):
-        """ loads an mmf file containing full models """
+        """ loads an mmf file containing full models, the macros used by
+        the contexts go into contextIndex """
         
         logger.info('Loading macro file %s', path)
             
-        mmfFile = open(path)
+        mmfFile = fileio.openFile(path)
         
         currentLabel = None
         hRegExp = re.compile("~h \"(.+)\"")
@@ -299,9 +513,11 @@ class HTSMMF:
             # ~h "v^schwa-h+schwa=m@1_2/A:0_0_4/B:0-0-2@1-2&2-7#1-1$1-1!0-0;0-0|0/C:0+0+3/D:det_1/E:content+2@2+3&1+2#0+1/F:content_4/G:0_0/H:7=4@1=1|0/I:0=0/J:7+4-1"            
             ret = hRegExp.match(line)
             if ret:
-                currentLabel = LabelEntry(ret.group(1))                
+                index = self.contextIndex
+                number = index.addContext(ret.group(1))
+                currentLabel = LabelEntry(index.contexts[number], index, number)
                 self.labelList.append(currentLabel)
-                self.labelDict[ ret.group(1) ] = currentLabel
+                self.labelDict[ currentLabel.name ] = currentLabel
                 
                 
             # we are already in the ~h section
@@ -317,29 +533,20 @@ class HTSMMF:
                 if not ret:
                     ret = sRegExp.match(line)
                 if ret:
-                    currentLabel.associatedMacroNames.append(ret.group(1))
-                    
-                    # fill macroToLabels
-                    if ret.group(1) in self.macroToLabels:
-                        self.macroToLabels[ ret.group(1) ].append(currentLabel)
-                    else:
-                        self.macroToLabels[ ret.group(1) ] = [ currentLabel ]
+                    self.contextIndex.addMacro(ret.group(1))
                                         
             
             line = mmfFile.readline()
         mmfFile.close()
+        self.contextIndex.finish()
         #print 'done: ' + str(len( self.macroToLabels ))
         #print self.macroToLabels
                 
         
     # loadMonoMMF    
     def loadMonoMMF(self, path):
-        """ loads an mmf file containing monophon models """
-        
-        currentHMM = None
-        currentState = None
-        currentStream = None
-        currentMixture = None
+        """ loads an mmf file containing monophon models, every line is
+        dispatched on its first token (see MonoReader) """
         
         # Example:
         # ~h "A"
@@ -357,102 +564,16 @@ class HTSMMF:
         
         logger.info('Loading monophon macro file %s', path)
             
-        mmfFile = open(path)
-        
-        # read file line by line
-        line = mmfFile.readline()
-        while line != "":
-            line = line.strip("\n").strip()
-            
-            # found a new ~h macro?
-            ret = re.match("~h \"(\S+)\"", line)
-            if ret is not None:
-                currentHMM = HMacro(ret.group(1))
-                self.macroList.append(currentHMM)
-                self.macroDict[ currentHMM.name ] = currentHMM
-                
-                currentState = None
-                currentStream = None
-                currentMixture = None
-                logger.info('Loading macro %s', currentHMM.name) 
-                
-            # state given?
-            ret = re.match("<STATE>\s+([0-9]+)", line)
-            if ret is not None:                
-                currentState = StateInfo(currentHMM, int(ret.group(1)))
-                currentHMM.addStateInfo(currentState)
-                
-                currentStream = None
-                currentMixture = None                
-
-            # stream given?            
-            ret = re.match("<STREAM>\s+([0-9]+)", line)
-            if ret is not None:
-                currentStream = StreamInfo(currentState, int(ret.group(1)))
-                currentState.addStreamInfo(currentStream)
-                self.streamList.append(currentStream)
-                
-                currentMixture = None
-                
-            # mixture given?            
-            ret = re.match("<MIXTURE>\s+([0-9]+)\s+(.+)", line)            
-            if ret is not None:
-                #print 'Found mixture with ' + ret.group(1) + ' ' + ret.group(2)
-                currentMixture = MixtureInfo(currentStream, int(ret.group(1)))
-                currentMixture.setWeight(float(ret.group(2)))
-                currentStream.addMixtureInfo(currentMixture)
-                                
-                                
-            # means given?
-            ret = re.match("<MEAN>\s+([0-9]+)", line)
-            if currentStream is not None and ret is not None:
-                numMeans = int(ret.group(1))
-                
-                if currentMixture is None:
-                    currentMixture = MixtureInfo(currentStream, 1)
-                    currentMixture.setWeight(1.0)
-                    currentStream.addMixtureInfo(currentMixture)
-                            
-                # not a multi space distribution with a mixture for unvoiced
-                if numMeans > 0:   
-                    line = mmfFile.readline()
-                    means = map(float, line.split())
-                    
-                    pdf = currentMixture.pdf 
-                    if pdf is None:
-                        pdf = PDFInfo()
-                        currentMixture.setPDF(pdf)
-                       
-                    pdf.setMeans(means)
-                    
-            # variances given?
-            ret = re.match("<VARIANCE>\s+([0-9]+)", line)
-            if currentStream is not None and ret is not None:
-                numVars = int(ret.group(1))
-                
-                if currentMixture is None:
-                    currentMixture = MixtureInfo(currentStream, 1)
-                    currentMixture.setWeight(1.0)
-                    currentStream.addMixtureInfo(currentMixture)
-                            
-                # not a multi space distribution with a mixture for unvoiced
-                if numVars > 0:   
-                    line = mmfFile.readline()
-                    variances = map(float, line.split())
-                    
-                    pdf = currentMixture.pdf 
-                    if pdf is None:
-                        pdf = PDFInfo()
-                        currentMixture.setPDF(pdf)
-                       
-                    pdf.setVariances(variances)                    
-            
-            
-            # read next line and then finish loop
-            line = mmfFile.readline()
-                    
-        # close the file and leave method                    
-        mmfFile.close()
+        mmfFile = fileio.openFile(path)
+        try:
+            reader = MonoReader(self, mmfFile)
+            dispatch = MonoReader.dispatch
+            for line in iter(mmfFile.readline, ''):
+                parts = line.split(None, 1)
+                if parts and parts[0] in dispatch:
+                    dispatch[parts[0]](reader, parts)
+        finally:
+            mmfFile.close()
         
 
 
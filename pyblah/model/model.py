@@ -14,6 +14,8 @@ import cPickle
 
 import decisiontree
 import mmf
+import cache
+import memory
 import subprocess
 
 
@@ -44,16 +46,21 @@ class HTSVoiceModel(object):
     dur
     '''
     
-    def __init__(self, path = None):
+    def __init__(self, path = None, useCache = True, dtype = None):
         '''
-        Constructor
+        Constructor, with useCache the parsed mmfs and trees are kept in 
+        the on-disk cache (see cache.py), dtype is the precision of the
+        mmf parameters (see mmf.MMF)
         '''
         
+        self.useCache = useCache
+        self.dtype = dtype
         self.defaultStateRange = range( 2, 7 )     # states [2-6]
         self.cmpMMF = None
         self.durMMF = None        
         self.modelPath = None
         self.trees = {}                             # contains treename -> MetaTree object           
+        self.questionSet = decisiontree.QuestionSet()   # the questions of all trees
                
         if path:
             self.loadModel( path )
@@ -74,6 +81,22 @@ class HTSVoiceModel(object):
         self.addMetaTree( "dur", self._loadMetaTree( os.path.join( self.modelPath, "tree.dur.inf" ) , [2] ) )
 
             
+    def publishMMFs(self):
+        """ publishes the mmfs for worker processes (see cache.publishMMF),
+        returns the paths to pass to attachMMFs """
+        return dict( cmp=cache.publishMMF( self.cmpMMF ),
+                     dur=cache.publishMMF( self.durMMF ) )
+
+    def attachMMFs(self, paths):
+        """ uses mmfs published by publishMMFs instead of loading them,
+        their arrays are shared and read-only """
+        self.cmpMMF = cache.attachMMF( paths['cmp'] )
+        self.durMMF = cache.attachMMF( paths['dur'] )
+
+    def memoryReport(self):
+        """ a memory.MemoryReport of the loaded mmfs and trees """
+        return memory.reportModel(self)
+
     def getMMF(self):
         """ Returns an HTSMMF object to the models MMF """
         return self.mmf
@@ -90,13 +113,38 @@ class HTSVoiceModel(object):
     def classifyLabelString( self, labelString ):
         ''' Classifies a label using all loaded trees '''
         ret = []
+        answers = self.labelAnswers( labelString )
         for t in self.trees:
-            ret.append( self.trees[t].classifyLabelString( labelString ) )
+            ret.append( self.trees[t].classifyLabelString( labelString, answers ) )
         return ret
 
+    def classifyLabels( self, labelStrings ):
+        ''' Classifies labels in batch using all loaded trees, returns the
+        classifyLabelString result of each label '''
+        ret = [ [] for l in labelStrings ]
+        answers = self.answerMatrix( labelStrings )
+        for t in self.trees:
+            for r, names in zip( ret, self.trees[t].classifyLabels( labelStrings, answers ) ):
+                r.append( names )
+        return ret
+
+    def answerMatrix( self, labelStrings ):
+        ''' The answers of labels to the questions asked in all trees (see
+        decisiontree.QuestionSet.answerMatrix), to pass to their classifyLabels '''
+        numbers = set()
+        for t in self.trees.itervalues():
+            for tree in t.treeList:
+                numbers.update( tree.flatTree().questionNumbers() )
+        return self.questionSet.answerMatrix( labelStrings, numbers )
+
+    def labelAnswers( self, labelString ):
+        ''' The answers of a label to the questions of all trees (a
+        decisiontree.LabelAnswers), to pass to their classifyLabelString '''
+        return self.questionSet.answers( labelString )
+
     def getCmpPDF(self, modelName, mix=1 ):
         ''' Convenience method, returns the pdf with given macroname for the cmp mmf. '''
-        return self.cmpMMF.getMacro( '~p', modelName ).mixture.pdfs[mix]                                 
+        return self.cmpMMF.getTarget( '~p', modelName ).mixture.pdfs[mix]                                 
                            
                            
     def _loadMetaTree(self, filename, staterange=None):
@@ -104,128 +152,86 @@ class HTSVoiceModel(object):
         if staterange is None:
             staterange = self.defaultStateRange                    
         logger.info( "Loading trees: " + filename )
-        mt = decisiontree.MetaTree()        
+        if self.useCache:
+            return cache.loadMetaTree( filename, staterange, questionSet=self.questionSet )
+        mt = decisiontree.MetaTree( self.questionSet )
         mt.loadTrees( filename, staterange )
         return mt
         
 
     def _loadMMF(self, mmftype):
-        """ Loads an MMF and returns it, also works for binary mmfs by using HHED to convert it. """        
-        configAvailable = True
+        """ Loads an MMF and returns it, text and HTK binary mmfs are both read directly,
+        binary ones the reader can not parse are converted with HHEd. """
         modeldir = self.modelPath                
-        ret = None         
-        
-        # is there a pickle file available? get that
-        # TODO: check if its up to date       
-        #mmffilepkl = os.path.join( modeldir, 'clustered.' + mmftype + '.mmf.pkl' )
-        #if os.path.exists(mmffilepkl):
-        #    logger.info( "Loading " + mmftype + " mmf (pickle): " + mmffilepkl )
-        #    f = open(mmffilepkl, 'rb')
-        #    ret = cPickle.load( f )
-        #    f.close()            
-            # in this case, do nothing else!
-        #    return ret        
-        
-        # is there a file with .ascii suffix available? load that
-        mmffileascii = os.path.join( modeldir, 'clustered.' + mmftype + '.mmf.ascii' )
-        if os.path.exists(mmffileascii):
-            logger.info( "Loading " + mmftype + " mmf (ascii): " + mmffileascii )
-            ret = mmf.MMF(mmffileascii)
         
-        # else use default filename and convert it
-        else:                                        
-            # check mmf file
+        # is there a file with .ascii suffix available (from an earlier HHEd conversion)? load that
+        # else the mmf itself (mmf.MMF detects binary files)
+        mmffile = os.path.join( modeldir, 'clustered.' + mmftype + '.mmf.ascii' )
+        if not os.path.exists(mmffile):
             mmffile = os.path.join( modeldir, 'clustered.' + mmftype + '.mmf' ) 
-            if not os.path.exists(mmffile):            
+            if not os.path.exists(mmffile):
                 raise FileLoadException( mmffile )
             
-            # check if the mmf is actually ascii
-            textchars = ''.join(map(chr, [7,8,9,10,12,13,27] + range(0x20, 0x100)))
-            is_binary_string = lambda ibytes: bool(ibytes.translate(None, textchars))
+        logger.info( "Loading " + mmftype + " mmf: " + mmffile )
+        try:
+            if self.useCache:
+                return cache.loadMMF(mmffile, dtype=self.dtype)
+            return mmf.MMF(mmffile, dtype=self.dtype)
+        except RuntimeError as e:
+            f = open(mmffile, 'rb')
+            head = f.read(4096)
+            f.close()
+            if not mmf.BinaryLexer.detect_rex.search(head):
+                raise
+            logger.warning( "Could not read binary mmf " + mmffile + " (" + str(e) + "), converting it with HHEd" )
+            return mmf.MMF(self._convertMMF(mmftype, mmffile), dtype=self.dtype)
 
-            if not is_binary_string( open(mmffile).read(1024) ):
-                logger.info( "Loading " + mmftype + " mmf (ascii): " + mmffile )
-                ret = mmf.MMF(mmffile)
-            
-            # file is binary, try to convert it using hhed
-            else:            
-                logger.info( "Converting " + mmftype + " mmf from binary to ascii: " + mmffile )
-            
-                # try to find config, first try one level higher, else two levels higher 
-                # (there might be another subfolder in the "models" folder)
-                conf = os.path.join(modeldir, '..', 'config', 'general.conf')
-                if not os.path.exists(conf):
-                    conf = os.path.join(modeldir, '..', '..', 'config', 'general.conf')
-                    if not os.path.exists(conf):
-                        #raise FileLoadException( "general.conf" )
-                        configAvailable = False
-                    
-                    #TODO: generate config if not available
-                                        
-                # check list file 
-                contextlist = os.path.join(modeldir, 'context.' + mmftype + '.list')
-                if not os.path.exists(contextlist):
-                    contextlist = os.path.join(modeldir, 'context.full.list')
-                    if not os.path.exists(contextlist):
-                        raise FileLoadException( contextlist )
-                
-                # find HHEd...
-                # TODO: think about different solution here :(
-                selfpath = os.path.dirname(os.path.realpath(__file__))
-                HHEd = os.path.join( os.path.abspath(selfpath), '..', '..', 'hts', 'tool', 'bin', 'HHEd')
-                print HHEd
-                if not os.path.exists(HHEd):
-                    raise FileLoadException( HHEd )
-                    
-                # HHEd -A -C ../config/general.conf -H 1/clustered.dur.mmf -w clustered.dur.mmf.txt /dev/null 1/context.dur.list   
-                #(handle, asciifile) = tempfile.mkstemp()
-                #os.close(handle)
-                asciifile = mmffile + ".ascii"
-                                              
-                
-                (handle, nullhed) = tempfile.mkstemp()
-                os.close(handle)                
-                
-                # call HHEd to make ascii mmf file
-                if configAvailable:
-                    logger.info( "Config used for converting: " + conf)
-                    cmndlist = [
-                        HHEd,
-                        #'-A',
-                        '-C', conf,
-                        '-H', mmffile,
-                        '-w', asciifile,
-                        nullhed,
-                        contextlist
-                    ]
-                else:
-                    logger.info( "No config available for converting.")
-                    cmndlist = [
-                        HHEd,
-                        #'-A',
-                        '-H', mmffile,
-                        '-w', asciifile,
-                        nullhed,
-                        contextlist
-                    ]
-                
-                logger.info( "Calling: " + " ".join( cmndlist ) )
-                    
-                subprocess.call(cmndlist)
-                
-                logger.info( "Loading " + mmftype + " mmf (ascii): " + asciifile )
-                ret = mmf.MMF(asciifile)
-                                
-                logger.info( "Removing: " + asciifile )                        
-                os.remove( nullhed )
+    def _convertMMF(self, mmftype, mmffile):
+        """ converts the binary mmffile to text using HHEd, returns the name of the text file """
+        configAvailable = True
+        modeldir = self.modelPath                
 
-       
-        # store pickle file 
-        #f = open( mmffilepkl, 'wb')
-        #cPickle.dump( ret, f, cPickle.HIGHEST_PROTOCOL )
-        #f.close()
-                                                                  
-        return ret
+        # try to find config, first try one level higher, else two levels higher 
+        # (there might be another subfolder in the "models" folder)
+        conf = os.path.join(modeldir, '..', 'config', 'general.conf')
+        if not os.path.exists(conf):
+            conf = os.path.join(modeldir, '..', '..', 'config', 'general.conf')
+            if not os.path.exists(conf):
+                configAvailable = False
+                                
+        # check list file 
+        contextlist = os.path.join(modeldir, 'context.' + mmftype + '.list')
+        if not os.path.exists(contextlist):
+            contextlist = os.path.join(modeldir, 'context.full.list')
+            if not os.path.exists(contextlist):
+                raise FileLoadException( contextlist )
+        
+        # find HHEd...
+        selfpath = os.path.dirname(os.path.realpath(__file__))
+        HHEd = os.path.join( os.path.abspath(selfpath), '..', '..', 'hts', 'tool', 'bin', 'HHEd')
+        if not os.path.exists(HHEd):
+            raise FileLoadException( HHEd )
+            
+        # HHEd -A -C ../config/general.conf -H 1/clustered.dur.mmf -w clustered.dur.mmf.txt /dev/null 1/context.dur.list   
+        asciifile = mmffile + ".ascii"
+        (handle, nullhed) = tempfile.mkstemp()
+        os.close(handle)                
+        
+        # call HHEd to make ascii mmf file
+        cmndlist = [ HHEd ]
+        if configAvailable:
+            logger.info( "Config used for converting: " + conf)
+            cmndlist += [ '-C', conf ]
+        else:
+            logger.info( "No config available for converting.")
+        cmndlist += [ '-H', mmffile, '-w', asciifile, nullhed, contextlist ]
+        
+        logger.info( "Calling: " + " ".join( cmndlist ) )
+        try:
+            subprocess.call(cmndlist)
+        finally:
+            os.remove( nullhed )
+        return asciifile
         
         
         
@@ -257,13 +263,21 @@ def get_model_manager():
 # test main
 #------------------------------------------------------------------------------        
 if __name__ == '__main__':
-    if len(sys.argv) < 2:
-        sys.exit( "Usage: python " + __file__ + " <model directory>" )
+    args = sys.argv[1:]
+    showMemory = '--memory' in args
+    if showMemory:
+        args.remove('--memory')
+    if len(args) < 1:
+        sys.exit( "Usage: python " + __file__ + " [--memory] <model directory>\n"
+                  "  --memory prints the memory taken by the loaded mmfs and trees" )
         
     logging.basicConfig(level=logging.DEBUG)        
     model = HTSVoiceModel()
     try:
-        model.loadModel( sys.argv[1] )
+        model.loadModel( args[0] )
     except FileLoadException as fle:
         print "Could not load file " + fle.filename
+    else:
+        if showMemory:
+            print model.memoryReport().format()
         
\ No newline at end of file
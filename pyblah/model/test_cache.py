@@ -0,0 +1,153 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import cache
+import mmf
+from test_mmf import SAMPLE_MMF, SAMPLE_MMF_BINARY
+
+SAMPLE_TREE = (
+    'QS C-a { "*-a+*" }\n'
+    'QS L-b { "*^b-*","*^c-*" }\n'
+    '\n'
+    '{*}[2]\n'
+    '{\n'
+    '   0 C-a -1 "mcep_s2_1"\n'
+    '  -1 L-b "mcep_s2_2" "mcep_s2_3"\n'
+    '}\n'
+    '\n'
+    '{*}[3]\n'
+    '{\n'
+    '   0 C-a "mcep_s3_1" "mcep_s3_2"\n'
+    '}\n'
+    )
+
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.cachedir = os.path.join(self.dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def source(self, name, content):
+        filename = os.path.join(self.dir, name)
+        f = open(filename, 'wb')
+        f.write(content)
+        f.close()
+        return filename
+
+    def testMMF(self):
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            filename = self.source('model.mmf', content)
+            reference = mmf.MMF(filename)
+            built = cache.loadMMF(filename, self.cachedir)
+            cached = cache.loadMMF(filename, self.cachedir)
+            for result in (built, cached):
+                self.assertItemsEqual(result.macros, reference.macros)
+                for mtype in reference.macros:
+                    self.assertEqual(result.getMacros(mtype), reference.getMacros(mtype))
+            # references are shared as in parsed MMFs
+            hmm = cached.getMacro('~h', 'sil^a-b+c=d@1_2')
+            self.assertTrue(hmm.state[2].stream[1].mixture is cached.getMacro('~p', 'mcep_s2_1'))
+            means = cached.getMacro('~p', 'mcep_s2_1').mixture.pdfs[1].means
+            self.assertEqual(means.dtype, numpy.float32)
+            means[0] = 42 # copy on write, the entry is not modified
+            self.assertNotEqual(cache.loadMMF(filename, self.cachedir).getMacro(
+                    '~p', 'mcep_s2_1').mixture.pdfs[1].means[0], 42)
+
+    def testPrecision(self):
+        filename = self.source('model.mmf', SAMPLE_MMF)
+        for dtype in (numpy.float16, None, numpy.float64):
+            for result in (cache.loadMMF(filename, self.cachedir, dtype=dtype),
+                           cache.loadMMF(filename, self.cachedir, dtype=dtype)):
+                means = result.getTarget('~p', 'mcep_s2_1').mixture.pdfs[1].means
+                self.assertEqual(means.dtype, dtype or numpy.float32)
+                self.assertEqual(result.dtype, dtype or numpy.float32)
+
+    def testInvalidation(self):
+        filename = self.source('model.mmf', SAMPLE_MMF)
+        cache.loadMMF(filename, self.cachedir)
+        entry = cache.entryName(filename, 'mmf', self.cachedir)
+        # touched only: still valid
+        os.utime(filename, (time.time() + 10, time.time() + 10))
+        self.assertNotEqual(cache.readEntry(entry, filename), None)
+        # changed content of the same size: rebuilt
+        self.source('model.mmf', SAMPLE_MMF.replace('trP_1', 'trP_2'))
+        os.utime(filename, (time.time() + 20, time.time() + 20))
+        self.assertEqual(cache.readEntry(entry, filename), None)
+        result = cache.loadMMF(filename, self.cachedir)
+        self.assertTrue(result.hasMacro('~t', 'trP_2'))
+        self.assertEqual(len([ name for name in os.listdir(self.cachedir)
+                               if name.endswith('.npy') ]), 1)
+        # broken entries are rebuilt
+        open(entry + '.rec', 'wb').write('garbage')
+        self.assertTrue(cache.loadMMF(filename, self.cachedir).hasMacro('~t', 'trP_2'))
+
+    def testBrokenPayload(self):
+        filename = self.source('model.mmf', SAMPLE_MMF)
+        cache.loadMMF(filename, self.cachedir)
+        def decode(records, payload):
+            raise IndexError("payload too short")
+        built = []
+        def build():
+            built.append(mmf.MMF(filename))
+            return built[-1]
+        result = cache.load(filename, 'mmf', build, cache.encodeMMF, decode, self.cachedir)
+        self.assertTrue(built and result is built[0])
+
+    def testChangedWhileBuilding(self):
+        filename = self.source('model.mmf', SAMPLE_MMF)
+        def build():
+            result = mmf.MMF(filename)
+            self.source('model.mmf', SAMPLE_MMF.replace('trP_1', 'trP_2') + '\n')
+            return result
+        result = cache.load(filename, 'mmf', build, cache.encodeMMF, cache.decodeMMF,
+                            self.cachedir)
+        self.assertTrue(result.hasMacro('~t', 'trP_1'))
+        self.assertEqual(cache.readEntry(cache.entryName(filename, 'mmf', self.cachedir),
+                                         filename), None)
+        self.assertTrue(cache.loadMMF(filename, self.cachedir).hasMacro('~t', 'trP_2'))
+
+    def testSharedMMF(self):
+        os.environ['PYBLAH_SHARED_DIR'] = self.dir
+        try:
+            reference = mmf.MMF(self.source('model.mmf', SAMPLE_MMF))
+            path = cache.publishMMF(reference)
+        finally:
+            del os.environ['PYBLAH_SHARED_DIR']
+        self.assertEqual(os.path.dirname(path), self.dir)
+        workers = [ cache.attachMMF(path) for i in range(2) ]
+        for attached in workers:
+            for mtype in reference.macros:
+                self.assertEqual(attached.getMacros(mtype), reference.getMacros(mtype))
+            means = attached.getTarget('~p', 'mcep_s2_1').mixture.pdfs[1].means
+            self.assertFalse(means.flags.writeable)
+            self.assertRaises(ValueError, means.__setitem__, 0, 42)
+        cache.unpublishMMF(path)
+        self.assertFalse(os.path.exists(path + '.rec') or os.path.exists(path + '.npy'))
+        # the attached ones stay valid
+        self.assertEqual(workers[0].getMacro('~t', 'trP_1'), reference.getMacro('~t', 'trP_1'))
+        self.assertRaises(IOError, cache.attachMMF, path)
+
+    def testMetaTree(self):
+        filename = self.source('tree.inf', SAMPLE_TREE)
+        built = cache.loadMetaTree(filename, [2, 3], self.cachedir)
+        cached = cache.loadMetaTree(filename, [2, 3], self.cachedir)
+        self.assertEqual(sorted(cached.leavesDict), sorted(built.leavesDict))
+        for label in ('x^b-a+c', 'x^c-d+e', 'x^d-d+e'):
+            self.assertEqual(cached.classifyLabelString(label),
+                             built.classifyLabelString(label))
+        self.assertEqual(cached.classifyLabelString('x^c-d+e'), ['mcep_s2_3', 'mcep_s3_1'])
+        # one question table for the trees of the file
+        first, second = cached.treeList
+        self.assertTrue(first.questionsDict is second.questionsDict)
+        self.assertTrue(first.questions is second.questions)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,201 @@
+import os
+import re
+import sys
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import label
+import decisiontree
+from test_cache import SAMPLE_TREE
+
+LABELS = [
+    'x^x-sil+a=b@1_2/A:0_0_0/B:x-x-x@x-x',
+    'sil^a-b+c=d@1_2/A:0_0_1/B:1-2-3@1-2',
+    'a^b-a+c=d@2_1/A:1_0_1/B:1-2-3@10-2',
+    'b^c-d+e=f@3_1/A:1_1_1/B:0-0-3@12-1',
+    '*^?-a+*=*@x_x',
+    'x^a:-b+c-a+d=e@1_2/H:9=5@1=1|L-L%/I:0=0',
+    ]
+
+class DecisionTreeTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def source(self, name, content):
+        filename = os.path.join(self.dir, name)
+        f = open(filename, 'w')
+        f.write(content)
+        f.close()
+        return filename
+
+    def testQuestion(self):
+        patterns = [ '"*-?#*"', '*-10#*', '"*^a-*"', '*@1?_*', '*/B:*-3@*', '"*"',
+                     '*-a+*', '*-a:+*', '*^a:-*', '*|L-L%/*', 'x^*', '*@1_*', '*/B:1-*' ]
+        for pattern in patterns:
+            question = decisiontree.Question('Q', [pattern])
+            # the per pattern regex the trees were classified with before
+            regex = re.escape(pattern.strip("\"*")).replace("\?", ".")
+            for l in LABELS + [ 'x-1#y', 'x-10#y', 'x-100#y', '' ]:
+                self.assertEqual(question.matches(l), re.search(regex, l) is not None,
+                                 (pattern, l))
+        question = decisiontree.Question('Q', patterns[:4])
+        self.assertEqual([ question.layout.contexts[field] for field, values in question.fields ],
+                         [('-', '#'), ('^', '-')])
+        self.assertEqual(question.substrings, ())
+        self.assertTrue(question.matches('x-1#y'))
+        self.assertTrue(question.matches('x@12_y'))
+        self.assertFalse(question.matches('x@1_2'))
+
+    def testFields(self):
+        self.assertEqual(label.questionField('-a+'), ('-', 'a', '+'))
+        self.assertEqual(label.questionField('/B:1-'), ('/B:', '1', '-'))
+        self.assertEqual(label.questionField('-a:+'), ('-', 'a', ':+'))
+        for pattern in ('x^', '-?#', '+', 'a'):
+            self.assertEqual(label.questionField(pattern), None)
+        layout = label.FieldLayout()
+        self.assertEqual(layout.field('-', '+'), 0)
+        self.assertEqual(layout.field('/B:', '-'), 1)
+        self.assertEqual(layout.field('-', '+'), 0)
+        fields = layout.parse(LABELS[2])
+        self.assertEqual(fields[0], frozenset(['a']))
+        self.assertEqual(fields[1], frozenset(['1']))
+        # every occurrence of left counts
+        fields = layout.parse(LABELS[-1])
+        self.assertEqual(fields[0], frozenset(['b', 'a']))
+
+    def testLoadTrees(self):
+        filename = self.source('tree.inf', SAMPLE_TREE)
+        opened = []
+        openFile = decisiontree.fileio.openFile
+        decisiontree.fileio.openFile = lambda *args: opened.append(args) or openFile(*args)
+        try:
+            metatree = decisiontree.MetaTree()
+            metatree.loadTrees(filename, [2, 3, 4])
+        finally:
+            decisiontree.fileio.openFile = openFile
+        self.assertEqual(len(opened), 1)
+        self.assertEqual([ t.state for t in metatree.treeList ], [2, 3, 4])
+        self.assertEqual([ len(t.nodeList) for t in metatree.treeList ], [2, 1, 0])
+        self.assertEqual(sorted(metatree.leavesDict),
+                         ['mcep_s2_1', 'mcep_s2_2', 'mcep_s2_3', 'mcep_s3_1', 'mcep_s3_2'])
+        first, second, missing = metatree.treeList
+        self.assertTrue(first.questionsDict is second.questionsDict)
+        self.assertTrue(first.questions is second.questions)
+        self.assertEqual(missing.classifyLabelString(LABELS[0]), '')
+        # the trees loaded one by one
+        for tree in metatree.treeList:
+            single = decisiontree.DecisionTree()
+            single.load(filename, tree.state)
+            self.assertEqual([ n.code for n in single.nodeList ], [ n.code for n in tree.nodeList ])
+            self.assertEqual([ single.classifyLabelString(l) for l in LABELS ],
+                             [ tree.classifyLabelString(l) for l in LABELS ])
+
+    def testQuestionSet(self):
+        questionSet = decisiontree.QuestionSet()
+        filename = self.source('tree.inf', SAMPLE_TREE)
+        metatrees = [ decisiontree.MetaTree(questionSet) for i in range(2) ]
+        for metatree in metatrees:
+            metatree.loadTrees(filename, [2, 3])
+        # the same questions in every tree
+        self.assertEqual([ q.name for q in questionSet.questions ], ['C-a', 'L-b'])
+        self.assertTrue(metatrees[0].treeList[1].questions['C-a'] is
+                        metatrees[1].treeList[0].questions['C-a'])
+        answers = questionSet.answers(LABELS[3])
+        self.assertEqual(list(answers.known), [decisiontree.UNKNOWN] * 2)
+        self.assertEqual([ m.classifyLabelString(LABELS[3], answers) for m in metatrees ],
+                         [['mcep_s2_3', 'mcep_s3_1']] * 2)
+        self.assertEqual(list(answers.known), [0, 1])
+        # questions added after the answers were created
+        question = questionSet.add('R-e', ['*+e=*'])
+        self.assertEqual(question.number, 2)
+        self.assertEqual(answers.answer(question.number), 1)
+
+    def testAnswerMatrix(self):
+        questionSet = decisiontree.QuestionSet()
+        for name, patterns in (('C-a', ['*-a+*', '*-b+*']), ('L-sil', ['*^sil-*']),
+                               ('Syl<=2', ['*@?_*', '*@1?_*']), ('Q', ['*1_2/*', 'x^*']),
+                               ('Any', ['*'])):
+            questionSet.add(name, patterns)
+        answers = questionSet.answerMatrix(LABELS)
+        self.assertEqual(answers.shape, (len(LABELS), 5))
+        self.assertEqual(answers.tolist(),
+                         [ [ q.matches(l) for q in questionSet.questions ] for l in LABELS ])
+        self.assertTrue(answers[:, 0].any() and answers[:, 2].any() and answers[:, 3].any())
+        partial = questionSet.answerMatrix(LABELS, [1])
+        self.assertEqual(partial[:, 1].tolist(), answers[:, 1].tolist())
+        self.assertFalse(partial[:, [0, 2, 3, 4]].any())
+        self.assertEqual(questionSet.answerMatrix([]).shape, (0, 5))
+
+    def testFlatTree(self):
+        metatree = decisiontree.MetaTree()
+        metatree.loadTrees(self.source('tree.inf', SAMPLE_TREE), [2, 3, 4])
+        questions = metatree.questionSet.questions
+        flat = metatree.treeList[0].flatTree()
+        self.assertTrue(metatree.treeList[0].flatTree() is flat)
+        self.assertEqual([ questions[q].name if q >= 0 else None for q in flat.question ],
+                         ['C-a', None, 'L-b', None, None])
+        self.assertEqual(flat.yes.tolist()[::2], [1, 3, 0])
+        self.assertEqual(flat.no.tolist()[::2], [2, 4, 0])
+        self.assertEqual(flat.leaf.tolist(), [-1, 0, -1, 1, 2])
+        self.assertEqual(flat.leafNames, ['mcep_s2_1', 'mcep_s2_3', 'mcep_s2_2'])
+        self.assertEqual(flat.questionNumbers().tolist(), [0, 1])
+        self.assertEqual(metatree.classifyLabels(LABELS),
+                         map(metatree.classifyLabelString, LABELS))
+        # an unknown question ends the walk without a leaf
+        tree = metatree.treeList[1]
+        tree.root.question = 'R-x'
+        tree.flat = None
+        stdout, sys.stdout = sys.stdout, StringIO.StringIO()
+        try:
+            flat = tree.flatTree()
+            tree.flatTree()
+            reported = sys.stdout.getvalue()
+        finally:
+            sys.stdout = stdout
+        self.assertEqual(reported, "ERROR: Question R-x unknown!\n")
+        self.assertEqual(flat.classify(metatree.questionSet.answerMatrix(LABELS)).tolist(),
+                         [-1] * len(LABELS))
+        self.assertEqual([ names[1] for names in metatree.classifyLabels(LABELS) ],
+                         [''] * len(LABELS))
+
+    def testClassify(self):
+        tree = decisiontree.DecisionTree()
+        tree.load(self.source('tree.inf', SAMPLE_TREE), 2)
+        self.assertEqual(sorted(tree.questions), ['C-a', 'L-b'])
+        self.assertEqual([ tree.classifyLabelString(l) for l in LABELS ],
+                         ['mcep_s2_2', 'mcep_s2_2', 'mcep_s2_1', 'mcep_s2_3', 'mcep_s2_1', 'mcep_s2_1'])
+        # answers of another QuestionSet are not used
+        other = decisiontree.QuestionSet()
+        other.add('L-b', ['"*^b-*"'])
+        other.add('C-a', ['"*-a+*"'])
+        self.assertEqual([ tree.classifyLabelString(l, other.answers(l)) for l in LABELS ],
+                         [ tree.classifyLabelString(l) for l in LABELS ])
+
+    def testClassifyAnswerMatrix(self):
+        metatree = decisiontree.MetaTree()
+        metatree.loadTrees(self.source('tree.inf', SAMPLE_TREE), [2, 3])
+        expected = metatree.classifyLabels(LABELS)
+        self.assertEqual(metatree.classifyLabels(LABELS, metatree.questionSet.answerMatrix(LABELS)),
+                         expected)
+        # the matrix of a set with other questions, or from before some were added
+        other = decisiontree.QuestionSet()
+        other.add('L-b', ['"*^b-*"'])
+        self.assertEqual(metatree.classifyLabels(LABELS, other.answerMatrix(LABELS)), expected)
+        self.assertEqual(metatree.classifyLabelString(LABELS[1], other.answers(LABELS[1])),
+                         expected[1])
+        # a tree of another QuestionSet gets answers of its own
+        tree = decisiontree.DecisionTree(other)
+        tree.load(self.source('tree.inf', SAMPLE_TREE), 3)
+        tree.state = 4
+        metatree.addStateTree(tree)
+        self.assertEqual(metatree.classifyLabels(LABELS, metatree.questionSet.answerMatrix(LABELS)),
+                         [ names + names[1:] for names in expected ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import os
+import gzip
+import shutil
+import StringIO
+import tempfile
+import unittest
+
+import fileio
+import mmf
+import label
+import decisiontree
+from test_mmf import SAMPLE_MMF, SAMPLE_MMF_BINARY
+from test_cache import SAMPLE_TREE
+
+SAMPLE_LABEL = (
+    '0 100 x^x-sil+a=b@1_2\n'
+    '100 200 sil^a-b+c=d@1_2\n'
+    )
+
+class FileIOTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def compressed(self, name, content):
+        filename = os.path.join(self.dir, name)
+        f = gzip.GzipFile(filename, 'wb')
+        f.write(content)
+        f.close()
+        return filename
+
+    def testOpenFile(self):
+        plain = os.path.join(self.dir, 'plain.txt')
+        f = fileio.openFile(plain, 'wb')
+        f.write('line 1\nline 2\n')
+        f.close()
+        self.assertEqual(fileio.compression(plain), None)
+        zipped = os.path.join(self.dir, 'zipped.txt.gz')
+        f = fileio.openFile(zipped, 'wb')
+        f.write('line 1\nline 2\n')
+        f.close()
+        self.assertEqual(fileio.compression(zipped), 'gz')
+        for filename in (plain, zipped):
+            f = fileio.openFile(filename)
+            self.assertEqual(list(f), ['line 1\n', 'line 2\n'])
+            f.close()
+        if fileio.lzma is None:
+            xz = os.path.join(self.dir, 'model.xz')
+            open(xz, 'wb').write(fileio.XZ_MAGIC + '\0' * 10)
+            self.assertRaises(IOError, fileio.openFile, xz)
+
+    def testMMF(self):
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            reference = mmf.ParseMMF(mmf.MakeLexer(StringIO.StringIO(content)))
+            filename = self.compressed('model.mmf', content)
+            for options in (dict(), dict(lazy=True), dict(processes=2), dict(keepSource=True),
+                            dict(include=mmf.MacroFilter(types=['~p']))):
+                mfile = mmf.MMF(filename, **options)
+                mfile.loadAll()
+                for mtype in mfile.macros:
+                    self.assertEqual(mfile.getMacros(mtype), reference.getMacros(mtype))
+            self.assertEqual(os.listdir(self.dir), ['model.mmf'])
+            # without room for the copy text is parsed while decompressing
+            decompressToTemp = fileio.decompressToTemp
+            def full(stream):
+                raise IOError(28, "No space left on device")
+            fileio.decompressToTemp = full
+            try:
+                if content is SAMPLE_MMF:
+                    self.assertEqual(mmf.MMF(filename).getMacros('~p'), reference.getMacros('~p'))
+                else:
+                    self.assertRaises(IOError, mmf.MMF, filename)
+                self.assertRaises(IOError, mmf.MMF, filename, lazy=True)
+            finally:
+                fileio.decompressToTemp = decompressToTemp
+            self.assertEqual([ mname for mtype, mname, target in
+                               mmf.iterparse(filename, types=['~p']) ],
+                             ['logF0_s2_1-2', 'mcep_s2_1'])
+            self.assertEqual(os.listdir(self.dir), ['model.mmf'])
+        written = os.path.join(self.dir, 'written.mmf.gz')
+        f = fileio.openFile(written, 'wb')
+        mmf.WriteMMF(f, reference)
+        f.close()
+        self.assertEqual(fileio.compression(written), 'gz')
+        self.assertEqual(mmf.MMF(written).getMacros('~p'), reference.getMacros('~p'))
+
+    def testLabelsAndTrees(self):
+        utterance = label.UtteranceLabel(self.compressed('utt.lab', SAMPLE_LABEL))
+        self.assertEqual([ l.phon for l in utterance.labels ], ['sil', 'b'])
+        metatree = decisiontree.MetaTree()
+        metatree.loadTrees(self.compressed('tree.inf', SAMPLE_TREE), [2, 3])
+        self.assertEqual(metatree.classifyLabelString('x^c-d+e'), ['mcep_s2_3', 'mcep_s3_1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import mmf
+import cache
+import memory
+import decisiontree
+from test_mmf import SAMPLE_MMF
+from test_cache import SAMPLE_TREE
+
+class MemoryTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def source(self, name, content):
+        filename = os.path.join(self.dir, name)
+        f = open(filename, 'wb')
+        f.write(content)
+        f.close()
+        return filename
+
+    def testMMF(self):
+        mfile = mmf.MMF(self.source('model.mmf', SAMPLE_MMF))
+        mfile.getPDFTable(1)
+        report = memory.reportMMF(mfile, 'cmp')
+        self.assertEqual(report.counts.keys(),
+                         ['cmp pdf tables', 'cmp ~o', 'cmp ~t', 'cmp ~v', 'cmp ~p stream 2',
+                          'cmp ~p stream 1', 'cmp ~s stream 1', 'cmp ~s', 'cmp ~h', 'cmp'])
+        # the mcep pdf is a view into the table, its payload is counted there
+        self.assertEqual(report.sizes['cmp pdf tables']['payload'], 4 * 4 * 2 + 4 * 2)
+        self.assertFalse('payload' in report.sizes['cmp ~p stream 1'])
+        self.assertEqual(report.counts['cmp ~p stream 1']['Macro'], 1)
+        self.assertEqual(report.counts['cmp ~p stream 1']['Stream'], 1)
+        self.assertEqual(report.sizes['cmp ~t']['payload'], 9 * 4)
+        # referenced macros are counted once, with their own type
+        self.assertEqual(report.counts['cmp ~h']['Macro'], 2)
+        self.assertEqual(report.counts['cmp ~h']['HMM'], 2)
+        self.assertFalse('ndarray' in report.counts['cmp ~h'])
+        self.assertEqual(report.counts['cmp ~s stream 1']['Stream'], 1)
+        self.assertEqual(report.counts['cmp ~s']['Macro'], 1)
+        objects, size = report.total()
+        self.assertEqual(objects, sum( report.total(s)[0] for s in report.counts ))
+        self.assertTrue(size > sys.getsizeof(mfile.macros))
+        self.assertTrue(report.format().splitlines()[-1].startswith('total'))
+
+    def testSharedMMF(self):
+        path = cache.publishMMF(mmf.MMF(self.source('model.mmf', SAMPLE_MMF)),
+                                os.path.join(self.dir, 'shared'))
+        try:
+            report = memory.reportMMF(cache.attachMMF(path), 'cmp')
+        finally:
+            cache.unpublishMMF(path)
+        # attached arrays are views into the mapped payload
+        self.assertFalse(any( 'payload' in sizes for sizes in report.sizes.itervalues() ))
+        self.assertTrue(sum( sizes['mapped'] for sizes in report.sizes.itervalues() ) > 0)
+
+    def testMetaTree(self):
+        metatree = decisiontree.MetaTree()
+        metatree.loadTrees(self.source('tree.inf', SAMPLE_TREE), [2, 3])
+        report = memory.reportMetaTree(metatree, 'tree mcep')
+        self.assertEqual(report.counts.keys(), ['tree mcep questions', 'tree mcep state 2',
+                                                'tree mcep state 3', 'tree mcep'])
+        self.assertEqual(report.counts['tree mcep questions']['Question'], 2)
+        # 2 nodes and 3 leaves, 1 node and 2 leaves
+        self.assertEqual(report.counts['tree mcep state 2']['Node'], 5)
+        self.assertEqual(report.counts['tree mcep state 3']['Node'], 3)
+        self.assertEqual(report.counts['tree mcep']['MetaTree'], 1)
+        self.assertFalse('Node' in report.counts['tree mcep'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -5,6 +5,10 @@ import numpy
 import StringIO
 import datetime
 import itertools
+import tempfile
+import struct
+import os
+import copy
 
 import sys
 if sys.version_info < (2, 6, 0):
@@ -18,6 +22,149 @@ def SLexer( sval ):
     return mmf.Lexer(StringIO.StringIO(sval))
 
 
+SAMPLE_MMF = (
+    '~o\n'
+    '<STREAMINFO> 5 123 180 1 1 1\n'
+    '<MSDINFO> 5 0 0 1 1 1\n'
+    '<VECSIZE> 306<NULLD><USER><DIAGC>\n'
+    '~t "trP_1"\n'
+    '<TRANSP> 3\n'
+    ' 1.000000e+00 2.000000e+00 3.000000e+00\n'
+    ' 4.000000e+00 5.000000e+00 6.000000e+00\n'
+    ' 7.000000e+00 8.000000e+00 9.000000e+00\n'
+    '~v "varFloor3"\n'
+    '<VARIANCE> 1\n'
+    ' 5.329445e-05\n'
+    '~s "dur_s2_25"\n'
+    '<MEAN> 5\n'
+    ' 2.380282e+00 6.014084e+00 3.225352e+00 5.549296e+00 3.478873e+00\n'
+    '<VARIANCE> 5\n'
+    ' 1.094989e+01 2.353197e+02 1.083246e+01 2.172435e+02 4.882293e+01\n'
+    '<GCONST> 2.869543e+01\n'
+    '~p "logF0_s2_1-2"\n'
+    '<STREAM> 2\n'
+    '<NUMMIXES> 2\n'
+    '<MIXTURE> 1 9.999700e-01\n'
+    '<MEAN> 1\n'
+    ' -5.783626e-03\n'
+    '<VARIANCE> 1\n'
+    ' 2.020562e-04\n'
+    '<GCONST> -6.669087e+00\n'
+    '<MIXTURE> 2 3.000000e-05\n'
+    '<MEAN> 0\n'
+    '<VARIANCE> 0\n'
+    '<GCONST> 0.000000e+00\n'
+    '~p "mcep_s2_1"\n'
+    '<STREAM> 1\n'
+    '<MEAN> 4\n'
+    ' 5.227783e-02 9.354116e-02 1.573079e-01 2.662440e-01 \n'
+    '<VARIANCE> 4\n'
+    ' 3.093076e-04 5.616156e-04 1.446284e-03 2.297929e-03 \n'
+    '<GCONST> -8.066434e+02\n'
+    '~h "C"\n'
+    '<BEGINHMM>\n'
+    '<NUMSTATES> 3\n'
+    '<STATE> 2\n'
+    '~s "dur_s2_25"\n'
+    '~t "trP_1"\n'
+    '<ENDHMM>\n'
+    '~h "sil^a-b+c=d@1_2"\n'
+    '<BEGINHMM>\n'
+    '<NUMSTATES> 3\n'
+    '<STATE> 2\n'
+    '<STREAM> 1\n'
+    '~p "mcep_s2_1"\n'
+    '<STREAM> 2\n'
+    '~p "logF0_s2_1-2"\n'
+    '~t "trP_1"\n'
+    '<ENDHMM>\n'
+    )
+
+def htk_sym(name):
+    """ binary form of keyword <name> """
+    return ':' + chr(mmf.HTK_SYMBOLS.index('<%s>' % name))
+def htk_shorts(*values):
+    return struct.pack('>%dh' % len(values), *values)
+def htk_floats(*values):
+    return struct.pack('>%df' % len(values), *values)
+def htk_vector(name, *values):
+    return htk_sym(name) + htk_shorts(len(values)) + htk_floats(*values)
+
+# SAMPLE_MMF in HTK's binary format (the macros in the order WriteMMF
+# writes them), built with the helpers above
+SAMPLE_MMF_BINARY = (
+    '~o\n' +
+    htk_sym('STREAMINFO') + htk_shorts(5, 123, 180, 1, 1, 1) +
+    htk_sym('MSDINFO') + htk_shorts(5, 0, 0, 1, 1, 1) +
+    htk_sym('VECSIZE') + htk_shorts(306) + '<NULLD><USER><DIAGC>\n' +
+    '~t "trP_1"\n' +
+    htk_sym('TRANSP') + htk_shorts(3) + htk_floats(*range(1, 10)) +
+    '~v "varFloor3"\n' + htk_vector('VARIANCE', 5.329445e-05) +
+    '~p "logF0_s2_1-2"\n' +
+    htk_sym('STREAM') + htk_shorts(2) + htk_sym('NUMMIXES') + htk_shorts(2) +
+    htk_sym('MIXTURE') + htk_shorts(1) + htk_floats(9.999700e-01) +
+    htk_vector('MEAN', -5.783626e-03) + htk_vector('VARIANCE', 2.020562e-04) +
+    htk_sym('GCONST') + htk_floats(-6.669087e+00) +
+    htk_sym('MIXTURE') + htk_shorts(2) + htk_floats(3.000000e-05) +
+    htk_vector('MEAN') + htk_vector('VARIANCE') +
+    htk_sym('GCONST') + htk_floats(0) +
+    '~p "mcep_s2_1"\n' +
+    htk_sym('STREAM') + htk_shorts(1) +
+    htk_vector('MEAN', 5.227783e-02, 9.354116e-02, 1.573079e-01, 2.662440e-01) +
+    htk_vector('VARIANCE', 3.093076e-04, 5.616156e-04, 1.446284e-03, 2.297929e-03) +
+    htk_sym('GCONST') + htk_floats(-8.066434e+02) +
+    '~s "dur_s2_25"\n' +
+    htk_vector('MEAN', 2.380282e+00, 6.014084e+00, 3.225352e+00, 5.549296e+00, 3.478873e+00) +
+    htk_vector('VARIANCE', 1.094989e+01, 2.353197e+02, 1.083246e+01, 2.172435e+02, 4.882293e+01) +
+    htk_sym('GCONST') + htk_floats(2.869543e+01) +
+    '~h "C"\n' +
+    htk_sym('BEGINHMM') + htk_sym('NUMSTATES') + htk_shorts(3) +
+    htk_sym('STATE') + htk_shorts(2) + '~s "dur_s2_25"\n' +
+    '~t "trP_1"\n' + htk_sym('ENDHMM') +
+    '~h "sil^a-b+c=d@1_2"\n' +
+    htk_sym('BEGINHMM') + htk_sym('NUMSTATES') + htk_shorts(3) +
+    htk_sym('STATE') + htk_shorts(2) +
+    htk_sym('STREAM') + htk_shorts(1) + '~p "mcep_s2_1"\n' +
+    htk_sym('STREAM') + htk_shorts(2) + '~p "logF0_s2_1-2"\n' +
+    '~t "trP_1"\n' + htk_sym('ENDHMM')
+    )
+
+# SAMPLE_MMF_BINARY as a literal, laid out by hand after HTK's binary
+# format (not produced by HHEd): the symbol codes of HModel.h (with
+# MSDINFO), big-endian shorts and floats, text macro headers and kinds.
+# Independent of HTK_SYMBOLS and the writer, so both are checked against it.
+SAMPLE_MMF_BINARY_LITERAL = (
+    '~o\n:\x05\x00\x05\x00{\x00\xb4\x00\x01\x00\x01\x00\x01:\x06\x00'
+    '\x05\x00\x00\x00\x00\x00\x01\x00\x01\x00\x01:\x07\x012<NULLD><US'
+    'ER><DIAGC>\n'
+    '~t "trP_1"\n:\x1c\x00\x03?\x80\x00\x00@\x00\x00\x00@@\x00\x00@'
+    '\x80\x00\x00@\xa0\x00\x00@\xc0\x00\x00@\xe0\x00\x00A\x00\x00\x00'
+    'A\x10\x00\x00'
+    '~v "varFloor3"\n:\x16\x00\x018_\x88{'
+    '~p "logF0_s2_1-2"\n:\x13\x00\x02:\x03\x00\x02:\x12\x00\x01?\x7f'
+    '\xfe\x09:\x15\x00\x01\xbb\xbd\x84\x92:\x16\x00\x019S\xdf\x0c:'
+    '\x19\xc0\xd5i):\x12\x00\x027\xfb\xa8\x82:\x15\x00\x00:\x16\x00'
+    '\x00:\x19\x00\x00\x00\x00'
+    '~p "mcep_s2_1"\n:\x13\x00\x01:\x15\x00\x04=V!G=\xbf\x92\x82>!'
+    '\x15R>\x88Q":\x16\x00\x049\xa2*\x90:\x139c:\xbd\x91=;\x16\x98'
+    '\xda:\x19\xc4I\xa9-'
+    '~s "dur_s2_25"\n:\x15\x00\x05@\x18V\x8a@\xc0s`@Nl+@\xb1\x93\xd5@'
+    '^\xa5\xdb:\x16\x00\x05A/2\xc0CkQ\xd8A-Q\xc2CY>VBCJ\xae:\x19A\xe5'
+    '\x90>'
+    '~h "C"\n:\x00:\x04\x00\x03:\x10\x00\x02~s "dur_s2_25"\n~t "trP_1'
+    '"\n:\x02'
+    '~h "sil^a-b+c=d@1_2"\n:\x00:\x04\x00\x03:\x10\x00\x02:\x13\x00'
+    '\x01~p "mcep_s2_1"\n:\x13\x00\x02~p "logF0_s2_1-2"\n~t "trP_1"\n'
+    ':\x02'
+    )
+
+def tmpfile(content):
+    """ writes content to a temporary file and returns its name """
+    handle, name = tempfile.mkstemp(suffix='.mmf')
+    os.write(handle, content)
+    os.close(handle)
+    return name
+
 def assertEqualAttrs(test, a, b, attrs):
     for attr in attrs:
         test.assertEqual(getattr(a,attr),getattr(b,attr),
@@ -547,6 +694,34 @@ class MyTest(unittest.TestCase):
         pass
                           
 
+    def testBulkVectorErrors(self):
+        """ the bulk decoding path reports malformed payloads like the token path """
+        cases = [ ("<MEAN>", "<MEAN> 1 \n 5.0e+00  5.0e+00 \n"),
+                  ("<MEAN>", "<MEAN> 2 \n 5.0e+00  \n<GCONST> 1\n"),
+                  ("<MEAN>", "<MEAN> 2 \n 5.0e+00 x \n"),
+                  ("<MEAN>", "<MEAN> 2 \n 5.0e+00 6.0e+00"),
+                  ("<TRANSP>", "<TRANSP> 2\n 1.0 0.0\n 1.0\n"),
+                  ("<TRANSP>", "<TRANSP> 2\n 1.0 0.0\n 1.0 y\n") ]
+        def message(lexer, tag):
+            try:
+                if tag == "<TRANSP>":
+                    mmf.ParseTransp(lexer)
+                else:
+                    mmf.ParseMean(lexer)
+            except RuntimeError as e:
+                return str(e).split("; Line")[0]
+            self.fail("no error raised")
+        for tag, text in cases:
+            self.assertEqual(message(SLexer(text), tag),
+                             message(mmf.LineLexer(StringIO.StringIO(text)), tag))
+
+    def testBulkMatrix(self):
+        text = '<TRANSP> 3\n 1 2 3\n 4 5 6\n 7 8 9\n<ENDHMM>\n'
+        lexer = SLexer(text)
+        numpy.testing.assert_array_equal(mmf.ParseTransp(lexer),
+                                          numpy.arange(1, 10).reshape(3, 3))
+        self.assertEqual(lexer.get(), '<ENDHMM>')
+
     def testLexer(self):
         file_like = StringIO.StringIO(
             "this is a 'test'. "
@@ -569,6 +744,301 @@ class MyTest(unittest.TestCase):
                 break
         pass
 
+    def testLexerMatchesLineLexer(self):
+        """ the buffer lexer yields the same token stream as the line lexer """
+        new = SLexer(SAMPLE_MMF)
+        old = mmf.LineLexer(StringIO.StringIO(SAMPLE_MMF))
+        self.assertEqual(new.getN(7), old.getN(7))
+        new.skipToNextLine(); old.skipToNextLine()
+        while True:
+            self.assertEqual(new.peek(), old.peek())
+            val = new.get()
+            self.assertEqual(val, old.get())
+            if val is None:
+                break
+        self.assertEqual(new.getN(3), [])
+
+    def testLexerMemoryMapped(self):
+        name = tmpfile(SAMPLE_MMF)
+        try:
+            mfile = mmf.MMF(name)
+        finally:
+            os.remove(name)
+        reference = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        self.assertItemsEqual(mfile.macros, reference.macros)
+        for mtype in reference.macros:
+            self.assertEqual(mfile.getMacros(mtype), reference.getMacros(mtype))
+
+    def testBinaryMMF(self):
+        """ binary MMFs are detected and parse to the same macros as text """
+        name = tmpfile(SAMPLE_MMF_BINARY)
+        try:
+            mfile = mmf.MMF(name)
+        finally:
+            os.remove(name)
+        reference = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        self.assertItemsEqual(mfile.macros, reference.macros)
+        for mtype in reference.macros:
+            self.assertEqual(mfile.getMacros(mtype), reference.getMacros(mtype))
+        self.assertEqual(mfile.getMacro('~t', 'trP_1').target.dtype, self.dtype)
+
+    def testBinaryFixture(self):
+        """ the literal binary fixture parses like its text twin """
+        self.assertEqual(SAMPLE_MMF_BINARY, SAMPLE_MMF_BINARY_LITERAL)
+        mfile = mmf.ParseMMF(mmf.MakeLexer(StringIO.StringIO(SAMPLE_MMF_BINARY_LITERAL)))
+        reference = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        self.assertItemsEqual(mfile.macros, reference.macros)
+        for mtype in reference.macros:
+            self.assertEqual(mfile.getMacros(mtype), reference.getMacros(mtype))
+
+    def testBinaryLexerErrors(self):
+        truncated = SAMPLE_MMF_BINARY[:SAMPLE_MMF_BINARY.index('~v')-5]
+        self.assertRaises(RuntimeError, mmf.ParseMMF, mmf.BinaryLexer(truncated))
+        lexer = mmf.BinaryLexer(htk_sym('MEAN') + htk_shorts(1) + htk_floats(1) + ':\x7f')
+        self.assertEqual(mmf.ParseMean(lexer), [1])
+        self.assertRaises(RuntimeError, lexer.get)
+
+    def testLazyMMF(self):
+        """ lazy MMFs parse macros on first access and end up like eager ones """
+        reference = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            name = tmpfile(content)
+            try:
+                mfile = mmf.MMF(name, lazy=True)
+            finally:
+                os.remove(name)
+            self.assertEqual(mfile.macros.keys(), ['~o'])
+            self.assertTrue(mfile.hasMacro('~p', 'mcep_s2_1'))
+            self.assertFalse(mfile.hasMacro('~p', 'mcep_s2_2'))
+            self.assertEqual(mfile.macros.keys(), ['~o'])
+
+            hmm = mfile.getMacro('~h', 'C')
+            self.assertEqual(hmm, reference.getMacro('~h', 'C'))
+            self.assertTrue(mfile.hasMacro('~s', 'dur_s2_25'))
+            self.assertEqual(sorted(mfile.macros['~s']), ['dur_s2_25'])
+            self.assertFalse(mfile.macros.has_key('~p'))
+            # references resolve to the memoised macro
+            self.assertTrue(hmm.state[2].stream is mfile.getMacro('~s', 'dur_s2_25'))
+            self.assertTrue(mfile.findOrDeclareMacro('~t', '"trP_1"') is hmm.transp)
+
+            mfile.loadAll()
+            self.assertItemsEqual(mfile.macros, reference.macros)
+            for mtype in reference.macros:
+                self.assertEqual(mfile.getMacros(mtype), reference.getMacros(mtype))
+
+    def testLazyReferences(self):
+        """ the text scan does not mistake references for definitions """
+        text = ('~o\n<STREAMINFO> 2 1 1\n<VECSIZE> 2<NULLD><USER><DIAGC>\n'
+                '~u "m"\n<MEAN> 1\n 1.0\n'
+                '~p "a"\n~u "m"\n~v "v"\n'
+                '~v "v"\n<VARIANCE> 1\n 2.0\n'
+                '~e "d"\n<DEPCLASS> 1 1\n 3.0\n'
+                '~p "b"\n<STREAM> 1\n~e "d"\n~u "m"\n<VARIANCE> 1\n 4.0\n'
+                '~s "s"\n<STREAM> 1\n~p "a"\n<STREAM> 2\n~p "b"\n'
+                # the rest of the <STREAM> line is skipped, however long
+                '~s "s2"\n<STREAM> 1' + ' ' * 80 + '\n\n~p "a"\n'
+                '<STREAM> 2 ' + 'x' * 80 + '\n~p "b"\n'
+                '~p "c"\n<STREAM> 2\n<MEAN> 1\n 5.0\n~v "v"\n'
+                '~h "x"\n<BEGINHMM>\n<NUMSTATES> 3\n<STATE> 2\n~s "s"\n'
+                '~t "t"\n<ENDHMM>\n'
+                '~t "t"\n<TRANSP> 3\n 0 1 0\n 0 0 1\n 0 0 0\n')
+        reference = mmf.ParseMMF(SLexer(text))
+        name = tmpfile(text)
+        try:
+            mfile = mmf.MMF(name, lazy=True)
+        finally:
+            os.remove(name)
+        self.assertEqual(dict((k, sorted(v)) for k, v in mfile.offsets.iteritems()),
+                         {'~u': ['m'], '~v': ['v'], '~e': ['d'], '~p': ['a', 'b', 'c'],
+                          '~s': ['s', 's2'], '~h': ['x'], '~t': ['t']})
+        mfile.loadAll()
+        for mtype in reference.macros:
+            self.assertEqual(mfile.getMacros(mtype), reference.getMacros(mtype))
+
+    def testSelectiveMMF(self):
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            name = tmpfile(content)
+            try:
+                mcep = mmf.MMF(name, include=mmf.MacroFilter(types=['~p'], streams=[1]))
+                noctx = mmf.MMF(name, exclude=mmf.MacroFilter(names=r'sil\^|mcep'))
+                lazy = mmf.MMF(name, lazy=True, include=mmf.MacroFilter(types='hp'))
+            finally:
+                os.remove(name)
+            reference = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+            self.assertEqual(sorted(mcep.macros), ['~o', '~p'])
+            self.assertEqual(mcep.getMacros('~p'),
+                             {'mcep_s2_1': reference.getMacro('~p', 'mcep_s2_1')})
+            self.assertFalse(any(mcep.offsets.values()))
+            self.assertEqual(sorted(noctx.getMacros('~h')), ['C'])
+            self.assertEqual(sorted(noctx.getMacros('~p')), ['logF0_s2_1-2'])
+            self.assertFalse(noctx.hasMacro('~p', 'mcep_s2_1'))
+            self.assertEqual(noctx.getMacros('~s'), reference.getMacros('~s'))
+            # excluded macros referenced by loaded ones stay undefined
+            self.assertEqual(sorted(lazy.offsets), ['~h', '~p'])
+            hmm = lazy.getMacro('~h', 'C')
+            self.assertTrue(mmf.isDanglingMacro(hmm.state[2].stream))
+            self.assertTrue(mmf.isDanglingMacro(hmm.transp))
+
+    def testIterparse(self):
+        reference = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            name = tmpfile(content)
+            try:
+                macros = list(mmf.iterparse(name))
+                mceps = list(mmf.iterparse(name, types=['p', '~s']))
+            finally:
+                os.remove(name)
+            # in file order
+            expected = sorted([('~o', ''), ('~t', 'trP_1'), ('~v', 'varFloor3'), ('~s', 'dur_s2_25'),
+                               ('~p', 'logF0_s2_1-2'), ('~p', 'mcep_s2_1'), ('~h', 'C'),
+                               ('~h', 'sil^a-b+c=d@1_2')],
+                              key=lambda (mtype, mname): content.index('%s "%s"' % (mtype, mname))
+                              if mname else 0)
+            self.assertEqual([ (mtype, mname) for mtype, mname, target in macros ], expected)
+            for mtype, mname, target in macros[:-2]:
+                self.assertEqual(reference.getMacro(mtype, mname), mmf.Macro(mtype, mname, target))
+            # references are not resolved
+            hmm = macros[-1][2]
+            self.assertEqual(hmm.state[2].stream[1].mixture.macroId, 'mcep_s2_1')
+            self.assertTrue(mmf.isDanglingMacro(hmm.state[2].stream[1].mixture))
+            self.assertEqual([ mname for mtype, mname, target in mceps ],
+                             [ mname for mtype, mname in expected if mtype in ('~p', '~s') ])
+            self.assertEqual(dict( (mname, target) for mtype, mname, target in mceps )['mcep_s2_1'],
+                             reference.getTarget('~p', 'mcep_s2_1'))
+
+    def testParallelMMF(self):
+        """ parsing with a process pool gives the same result as a serial parse """
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            name = tmpfile(content)
+            try:
+                serial = mmf.MMF(name)
+                parallel = mmf.MMF(name, processes=2)
+            finally:
+                os.remove(name)
+            self.assertItemsEqual(parallel.macros, serial.macros)
+            for mtype in serial.macros:
+                self.assertItemsEqual(parallel.getMacros(mtype), serial.getMacros(mtype))
+                self.assertEqual(parallel.getMacros(mtype), serial.getMacros(mtype))
+            hmm = parallel.getMacro('~h', 'sil^a-b+c=d@1_2')
+            self.assertTrue(hmm.state[2].stream[2].mixture is parallel.getMacro('~p', 'logF0_s2_1-2'))
+            self.assertFalse(mmf.isDanglingMacro(hmm.transp))
+
+    def testParallelErrors(self):
+        """ errors in later chunks report the line in the file """
+        broken = SAMPLE_MMF[:SAMPLE_MMF.rindex('<STATE> 2')] + '<STATE> x\n' + \
+                 SAMPLE_MMF[SAMPLE_MMF.rindex('<STATE> 2') + 10:]
+        name = tmpfile(broken)
+        try:
+            messages = []
+            for kwargs in ({}, dict(processes=2)):
+                try:
+                    mmf.MMF(name, **kwargs)
+                except RuntimeError as e:
+                    messages.append(str(e))
+        finally:
+            os.remove(name)
+        self.assertEqual(len(messages), 2)
+        self.assertTrue('Line %d,' % (broken[:broken.index('<STATE> x')].count('\n') + 1)
+                        in messages[0])
+        self.assertEqual(messages[1], messages[0])
+
+    def testPrecision(self):
+        """ the parameters are stored in the dtype of the MMF in every mode """
+        for content in (SAMPLE_MMF, SAMPLE_MMF_BINARY):
+            name = tmpfile(content)
+            try:
+                reference = mmf.MMF(name, dtype=numpy.float64)
+                for dtype in (numpy.float16, numpy.float64):
+                    for kwargs in ({}, dict(lazy=True), dict(processes=2)):
+                        mfile = mmf.MMF(name, dtype=dtype, **kwargs)
+                        self.assertEqual(mfile.dtype, dtype)
+                        pdf = mfile.getTarget('~p', 'logF0_s2_1-2').mixture.pdfs[1]
+                        self.assertEqual(pdf.means.dtype, dtype)
+                        self.assertEqual(type(pdf.gconst), dtype)
+                        self.assertEqual(type(mfile.getTarget('~p', 'logF0_s2_1-2').mixture.weights[1]), dtype)
+                        self.assertEqual(mfile.getTarget('~t', 'trP_1').dtype, dtype)
+                        self.assertEqual(mfile.getPDFTable(1).means.dtype, dtype)
+                        expected = reference.getTarget('~p', 'mcep_s2_1').mixture.pdfs[1].means
+                        numpy.testing.assert_allclose(mfile.getTarget('~p', 'mcep_s2_1').mixture.pdfs[1].means,
+                                                      expected, rtol=1e-3)
+                target = next( target for mtype, mname, target in
+                               mmf.iterparse(name, types=['~v'], dtype='float16') )
+                self.assertEqual(target.dtype, numpy.float16)
+            finally:
+                os.remove(name)
+        self.assertEqual(mmf.MMF().dtype, numpy.float32)
+
+    def testDiff(self):
+        a = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        self.assertFalse(any(mmf.diff(a, mmf.ParseMMF(SLexer(SAMPLE_MMF)))))
+        b = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        b.getTarget('~p', 'mcep_s2_1').mixture.pdfs[1].means[1] += 0.5
+        b.getTarget('~s', 'dur_s2_25')[1].mixture.pdfs[1].gconst = None
+        del b.macros['~v']['varFloor3']
+        b.findOrDeclareMacro('~t', 'trP_2').setTarget(numpy.eye(3, dtype=numpy.float32))
+        b.getTarget('~h', 'C').numstates = 5
+        b.findOrDeclareMacro('~u', 'undefined')
+        diffs = dict( ((d.macroType, d.stream), d) for d in mmf.diff(a, b) )
+        self.assertEqual(sorted(diffs), [('~h', None), ('~o', None), ('~p', 1), ('~p', 2),
+                                         ('~s', 1), ('~t', None), ('~v', None)])
+        mcep = diffs[('~p', 1)]
+        self.assertEqual((mcep.compared, mcep.changed), (1, set(['mcep_s2_1'])))
+        self.assertAlmostEqual(mcep.maxDiff['means'], 0.5)
+        self.assertAlmostEqual(mcep.meanDiff['means'], 0.125)
+        self.assertEqual(mcep.maxDiff['variances'], 0)
+        self.assertFalse(diffs[('~p', 2)])
+        self.assertEqual(diffs[('~p', 2)].compared, 1)
+        self.assertEqual(diffs[('~s', 1)].changed, set(['dur_s2_25']))
+        self.assertEqual(diffs[('~v', None)].removed, ['varFloor3'])
+        self.assertEqual(diffs[('~t', None)].added, ['trP_2'])
+        self.assertFalse(diffs[('~t', None)].changed)
+        self.assertEqual(diffs[('~h', None)].changed, set(['C']))
+        self.assertFalse(diffs[('~o', None)])
+        report = mmf.FormatDiff(mmf.diff(a, b), names=True)
+        self.assertTrue('~p stream 1: 1 compared, 0 added, 0 removed, 1 changed; '
+                        'means max 5.000e-01 mean 1.250e-01' in report)
+        self.assertTrue('  - ~v "varFloor3"' in report)
+        self.assertTrue('  * ~h "C"' in report)
+
+    def testPDFTable(self):
+        mfile = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        table = mfile.getPDFTable(1)
+        self.assertEqual(table.names, ['mcep_s2_1'])
+        self.assertEqual(table.means.shape, (1, 4))
+        pdf = mfile.getMacro('~p', 'mcep_s2_1').mixture.pdfs[1]
+        numpy.testing.assert_array_equal(table.means[table.index['mcep_s2_1']], pdf.means)
+        # the pdfs are views into the table
+        table.means *= 2
+        self.assertEqual(pdf.means[0], table.means[0, 0])
+        self.assertTrue(mfile.getPDFTable(1) is table)
+        # so is gconst, changes in place show on both sides
+        pdf.gconst[...] = 42
+        self.assertEqual(table.gconst[0], 42)
+        table.gconst[0] = -1
+        self.assertEqual(pdf.gconst, -1)
+        self.assertEqual(mfile.getPDFTable(1).gconst[0], -1)
+        fout = StringIO.StringIO()
+        mmf.WriteMMF(fout, mfile)
+        self.assertTrue('<GCONST> -1.000000e+00' in fout.getvalue())
+
+        voiced = mfile.getPDFTable(2)
+        self.assertEqual(voiced.weights.tolist(), [self.dtype('9.999700e-01')])
+        self.assertEqual(voiced.gconst.tolist(), [self.dtype('-6.669087e+00')])
+        voiced.weights[0] = 0.5
+        self.assertEqual(mfile.getMacro('~p', 'logF0_s2_1-2').mixture.weights[1], 0.5)
+        self.assertEqual(mfile.getPDFTable(2, mixture=2).means.shape, (1, 0))
+        duration = mfile.getPDFTable(1, macroType='~s')
+        self.assertEqual(duration.means.shape, (1, 5))
+        self.assertRaises(KeyError, mfile.getPDFTable, 5)
+
+    def testLexerErrorContext(self):
+        lexer = SLexer("<MEAN> 1 2 3 4 5 6 7 8 9 10 11 12\n<VARIANCE> x\n")
+        lexer.getN(13)
+        lexer.skipToNextLine()
+        self.assertEqual(lexer.getLineNo(), 2)
+        self.assertEqual(lexer.getRetElements(), [str(i) for i in range(4,13)] + ['\n'])
+        self.assertRaises(RuntimeError, mmf.ParseVariance, lexer)
+
     def testLexerGetType(self):
         file_like = StringIO.StringIO(
             "1 two 3 4.5 5.6")
@@ -879,6 +1349,125 @@ class MyTest(unittest.TestCase):
             numpy.testing.assert_array_almost_equal( values, funparse(mmf.Lexer(f)))
         #self.fail()
         pass
+
+    def test_write_state_fixes(self):
+        """ regression test: inline <SWEIGHTS> and <DEPCLASS> are written,
+        macros that were only declared are not """
+        text = ('~o\n<STREAMINFO> 2 1 1\n<VECSIZE> 2<NULLD><USER><DIAGC>\n'
+                '~h "x"\n<BEGINHMM>\n<NUMSTATES> 3\n<STATE> 2\n'
+                '<SWEIGHTS> 2\n 1.000000e+00 5.000000e-01\n'
+                '<STREAM> 1\n<DEPCLASS> 1 2\n 3.000000e+00 4.000000e+00\n'
+                '<MEAN> 1\n 1.000000e+00\n<VARIANCE> 1\n 2.000000e+00\n'
+                '<STREAM> 2\n<MEAN> 1\n 5.000000e+00\n<VARIANCE> 1\n 6.000000e+00\n'
+                '~t "t"\n<ENDHMM>\n'
+                '~t "t"\n<TRANSP> 3\n 0 1 0\n 0 0 1\n 0 0 0\n')
+        mfile = mmf.ParseMMF(SLexer(text))
+        mfile.findOrDeclareMacro('~u', 'undefined')
+        f = StringIO.StringIO()
+        mmf.WriteMMF(f, mfile)
+        written = f.getvalue()
+        self.assertTrue('<SWEIGHTS> 2\n 1.000000e+00 5.000000e-01\n' in written)
+        self.assertTrue('<DEPCLASS> 1 2\n 3.000000e+00 4.000000e+00\n' in written)
+        self.assertFalse('undefined' in written)
+        self.assertEqual(mmf.ParseMMF(SLexer(written)).getMacros('~h'), mfile.getMacros('~h'))
+
+    def test_write_matches_savetxt(self):
+        rnd = numpy.random.RandomState(1)
+        for shape in [ (1, 7), (4, 3), (2, 1) ]:
+            values = (rnd.standard_normal(shape) * 1e3).astype(self.dtype)
+            values[0, 0] = -0.0
+            f = StringIO.StringIO()
+            numpy.savetxt(f, values, delimiter='', fmt=' %10.6e')
+            self.assertEqual(mmf.FormatRows(values), f.getvalue())
+
+    def test_write_binary(self):
+        mfile = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        fout = StringIO.StringIO()
+        mmf.WriteMMF(fout, mfile, binary=True)
+        written = fout.getvalue()
+        self.assertTrue(mmf.BinaryLexer.detect_rex.search(written))
+        self.assertEqual(written, SAMPLE_MMF_BINARY_LITERAL)
+        fout = StringIO.StringIO()
+        mmf.WriteMMF(fout, mmf.ParseMMF(mmf.BinaryLexer(SAMPLE_MMF_BINARY_LITERAL)), binary=True)
+        self.assertEqual(fout.getvalue(), SAMPLE_MMF_BINARY_LITERAL)
+        parsed = mmf.ParseMMF(mmf.MakeLexer(StringIO.StringIO(written)))
+        self.assertItemsEqual(parsed.macros, mfile.macros)
+        for mtype in mfile.macros:
+            self.assertEqual(parsed.getMacros(mtype), mfile.getMacros(mtype))
+
+    def test_write_binary_deptrans(self):
+        values = numpy.array( [[1,2,3],[4,5,6]], dtype=self.dtype)
+        stream = mmf.Stream(1, mmf.Mixture({1: mmf.PDF(values[0], values[1], self.dtype(1))},
+                                           {1: 1.0}, pseudo=True), deptrans=values)
+        f = mmf.WriteBuffer(StringIO.StringIO(), binary=True)
+        mmf.WriteStream(f, stream)
+        f.flush()
+        parsed = mmf.ParseStream(mmf.BinaryLexer(f.fileobj.getvalue()), mmf.MMF())
+        numpy.testing.assert_array_equal(parsed.deptrans, values)
+        numpy.testing.assert_array_equal(parsed.mixture.pdfs[1].variances, values[1])
+
+    def test_write_dedup(self):
+        mfile = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        resolved = mfile.resolve()
+        # an HMM with inline copies of the same streams, as interpolate.py builds them
+        states = dict( (n, mmf.State(n, {1: copy.deepcopy(resolved['~p']['mcep_s2_1']),
+                                         2: resolved['~p']['logF0_s2_1-2']}, None))
+                       for n in (2, 3, 4) )
+        states[5] = mmf.State(5, {1: copy.deepcopy(resolved['~s']['dur_s2_25'][1])}, None)
+        states[5].stream[1].mixture.pdfs[1].means = \
+            resolved['~p']['mcep_s2_1'].mixture.pdfs[1].means.copy()
+        mfile.findOrDeclareMacro('~h', 'interpolated').setTarget(
+            mmf.HMM(6, states, mfile.getMacro('~t', 'trP_1')))
+        fout = StringIO.StringIO()
+        mmf.WriteMMF(fout, mfile, dedup=True)
+        inline = StringIO.StringIO()
+        mmf.WriteMMF(inline, mfile)
+        self.assertTrue(fout.tell() < inline.tell())
+        fout.seek(0)
+        written = mmf.ParseMMF(mmf.Lexer(fout))
+        shared = [ name for name in written.getMacros('~p') if name.startswith('shared_') ]
+        self.assertEqual(len(shared), 2)
+        # the mean of state 5 and the shared mcep ~p, long enough to share
+        self.assertEqual(len(written.getMacros('~u')), 1)
+        self.assertFalse('~v' in written.macros and
+                         any(name.startswith('shared_') for name in written.getMacros('~v')))
+        hmm = written.getTarget('~h', 'interpolated')
+        for n in (2, 3, 4):
+            self.assertEqual(hmm.state[n].stream[1].mixture.macroId, hmm.state[2].stream[1].mixture.macroId)
+        # same content, the model itself is unchanged
+        expected = mfile.resolve()['~h']['interpolated']
+        actual = written.resolve()['~h']['interpolated']
+        for n in states:
+            for k in expected.state[n].stream:
+                self.assertEqual(actual.state[n].stream[k].mixture, expected.state[n].stream[k].mixture)
+        self.assertTrue(mfile.getTarget('~h', 'interpolated').state[2] is states[2])
+        self.assertFalse(any(name.startswith('shared_') for name in mfile.getMacros('~p')))
+
+    def test_write_keep_source(self):
+        text = SAMPLE_MMF.replace('<GCONST> 2.869543e+01', '<GCONST>   28.69543')
+        name = tmpfile(text)
+        try:
+            for lazy in (False, True):
+                mfile = mmf.MMF(name, lazy=lazy, keepSource=True)
+                fout = StringIO.StringIO()
+                mmf.WriteMMF(fout, mfile)
+                # unchanged macros are copied, including their formatting
+                self.assertTrue('<GCONST>   28.69543\n' in fout.getvalue())
+                self.assertEqual(mfile.getSource('~t', 'trP_1'),
+                                 '~t "trP_1"\n' + text.split('~t "trP_1"\n')[1].split('~')[0])
+                # modified macros are formatted again
+                mfile.getMacro('~s', 'dur_s2_25')[1].mixture.pdfs[1].means[0] = 42
+                self.assertEqual(mfile.getSource('~s', 'dur_s2_25'), None)
+                fout = StringIO.StringIO()
+                mmf.WriteMMF(fout, mfile)
+                self.assertFalse('<GCONST>   28.69543\n' in fout.getvalue())
+                fout.seek(0)
+                written = mmf.ParseMMF(mmf.Lexer(fout))
+                for mtype in mfile.macros:
+                    self.assertEqual(written.getMacros(mtype), mfile.getMacros(mtype))
+            self.assertEqual(mmf.MMF(name).getSource('~t', 'trP_1'), None)
+        finally:
+            os.remove(name)
     
     def testMacro(self):
         testlist = ['a','b']
@@ -888,6 +1477,36 @@ class MyTest(unittest.TestCase):
         self.assertEqual(macro[1],'b')
         self.assertTrue(mmf.isMacro(macro))
         self.assertFalse(mmf.isMacro(testlist))
+        self.assertEqual(len(macro), 2)
+        self.assertEqual(list(macro), testlist)
+        self.assertFalse(hasattr(macro, '__dict__'))
+        vector = mmf.Macro('~u', 'mean', numpy.arange(3, dtype=self.dtype))
+        numpy.testing.assert_array_equal(vector * 2 + 1, [1, 3, 5])
+        numpy.testing.assert_array_equal(1 - vector, [1, 0, -1])
+        numpy.testing.assert_array_equal(numpy.asarray(vector), vector.target)
+        stream = mmf.Macro('~p', 'stream', mmf.Stream(1, mmf.Mixture({1: 'pdf'})))
+        self.assertTrue(stream)
+        self.assertEqual(stream.pdfs, {1: 'pdf'})
+        copied = copy.copy(stream)
+        self.assertTrue(copied.target is stream.target)
+
+    def testResolve(self):
+        mfile = mmf.ParseMMF(SLexer(SAMPLE_MMF))
+        resolved = mfile.resolve()
+        self.assertItemsEqual(resolved, mfile.macros)
+        hmm = resolved['~h']['sil^a-b+c=d@1_2']
+        self.assertEqual(type(hmm.transp), numpy.ndarray)
+        self.assertTrue(hmm.transp is mfile.getTarget('~t', 'trP_1'))
+        stream = hmm.state[2].stream[1]
+        self.assertEqual(type(stream), mmf.Stream)
+        # unchanged values are shared, the ones with references copied
+        self.assertTrue(stream is mfile.getTarget('~p', 'mcep_s2_1'))
+        self.assertTrue(resolved['~p']['mcep_s2_1'] is stream)
+        self.assertEqual(type(resolved['~h']['C'].state[2].stream), dict)
+        self.assertEqual(hmm.state[2].stream[2].weights,
+                         mfile.getTarget('~p', 'logF0_s2_1-2').weights)
+        # the MMF keeps its references
+        self.assertTrue(mmf.isMacro(mfile.getTarget('~h', 'sil^a-b+c=d@1_2').transp))
     def testEqualities(self):
         pdf1 = mmf.PDF(means=[1,2,3], variances=[4,5,6], gconst=0)
         pdf2 = mmf.PDF(means=[1,2,3], variances=[4,5,6], gconst=0)
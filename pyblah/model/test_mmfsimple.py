@@ -0,0 +1,189 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import mmfsimple
+
+SAMPLE_FULL_MMF = (
+'~o\n'
+'<STREAMINFO> 2 2 1\n'
+'<VECSIZE> 3<NULLD><USER><DIAGC>\n'
+'~p "mcep_s2_1"\n'
+'<STREAM> 1\n'
+'<MEAN> 2\n'
+' 1.000000e+00 2.000000e+00\n'
+'<VARIANCE> 2\n'
+' 3.000000e+00 4.000000e+00\n'
+'<GCONST> 5.000000e+00\n'
+'~s "dur_s2_1"\n'
+'<STREAM> 1\n'
+'<MEAN> 1\n'
+' 6.000000e+00\n'
+'<VARIANCE> 1\n'
+' 7.000000e+00\n'
+'~h "x^sil-a+b=c@1_2"\n'
+'<BEGINHMM>\n'
+'<NUMSTATES> 3\n'
+'<STATE> 2\n'
+'~s "dur_s2_1"\n'
+'<STREAM> 1\n'
+'~p "mcep_s2_1"\n'
+'<STREAM> 2\n'
+'~p "logF0_s2_1-2"\n'
+'<ENDHMM>\n'
+'~h "sil^a-b+c=d@2_1"\n'
+'<BEGINHMM>\n'
+'<NUMSTATES> 3\n'
+'<STATE> 2\n'
+'<STREAM> 1\n'
+'~p "mcep_s2_2"\n'
+'<STREAM> 2\n'
+'~p "logF0_s2_1-2"\n'
+'<ENDHMM>\n'
+'~h "a^b-c+d=e@1_1"\n'
+'<BEGINHMM>\n'
+'<NUMSTATES> 3\n'
+'<STATE> 2\n'
+'<STREAM> 1\n'
+'~p "mcep_s2_1"\n'
+'<STREAM> 2\n'
+'~p "logF0_s2_1-2"\n'
+'<ENDHMM>\n'
+)
+
+SAMPLE_MONO_MMF = (
+'~o\n'
+'<STREAMINFO> 2 2 1\n'
+'<VECSIZE> 3<NULLD><USER><DIAGC>\n'
+'~h "A"\n'
+'<BEGINHMM>\n'
+'<NUMSTATES> 3\n'
+'<STATE> 2\n'
+'<SWEIGHTS> 2\n'
+' 1.000000e+00 0.000000e+00\n'
+'<STREAM> 1\n'
+'<MEAN> 2\n'
+' 1.000000e+00 -2.500000e-01\n'
+'<VARIANCE> 2\n'
+' 3.000000e+00 4.000000e+00\n'
+'<GCONST> 5.000000e+00\n'
+'<STREAM> 2\n'
+'<NUMMIXES> 2\n'
+'<MIXTURE> 1 9.000000e-01\n'
+'<MEAN> 1\n'
+' 4.500000e+00\n'
+'<VARIANCE> 1\n'
+' 2.000000e-02\n'
+'<MIXTURE> 2 1.000000e-01\n'
+'<MEAN> 0\n'
+'<VARIANCE> 0\n'
+'<TRANSP> 3\n'
+' 0.0 1.0 0.0\n'
+' 0.0 0.5 0.5\n'
+' 0.0 0.0 0.0\n'
+'<ENDHMM>\n'
+'~h "B"\n'
+'<BEGINHMM>\n'
+'<NUMSTATES> 3\n'
+'<STATE> 2\n'
+'<STREAM> 1\n'
+'<MEAN> 2\n'
+' 6.000000e+00 7.000000e+00\n'
+'<VARIANCE> 2\n'
+' 8.000000e+00 9.000000e+00\n'
+'<ENDHMM>\n'
+)
+
+class MMFSimpleTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'full.mmf')
+        f = open(self.filename, 'wb')
+        f.write(SAMPLE_FULL_MMF)
+        f.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def testLoadFullMMF(self):
+        mfile = mmfsimple.HTSMMF()
+        mfile.loadFullMMF(self.filename)
+        names = ['x^sil-a+b=c@1_2', 'sil^a-b+c=d@2_1', 'a^b-c+d=e@1_1']
+        self.assertEqual([ label.name for label in mfile.labelList ], names)
+        self.assertEqual([ label.cphone for label in mfile.labelList ], ['a', 'b', 'c'])
+        label = mfile.labelDict['x^sil-a+b=c@1_2']
+        self.assertTrue(label is mfile.labelList[0])
+        self.assertEqual(label.associatedMacroNames, ['dur_s2_1', 'mcep_s2_1', 'logF0_s2_1-2'])
+        self.assertEqual(mfile.labelList[1].associatedMacroNames, ['mcep_s2_2', 'logF0_s2_1-2'])
+        # reverse lookups, contexts in file order
+        self.assertEqual([ l.name for l in mfile.macroToLabels['mcep_s2_1'] ], [names[0], names[2]])
+        self.assertEqual(mfile.macroToLabels['logF0_s2_1-2'], mfile.labelList)
+        self.assertEqual(mfile.macroToLabels['dur_s2_1'], [label])
+        self.assertTrue('mcep_s2_2' in mfile.macroToLabels)
+        self.assertFalse('mcep_s2_3' in mfile.macroToLabels)
+        self.assertRaises(KeyError, lambda: mfile.macroToLabels['mcep_s2_3'])
+        self.assertEqual(mfile.macroToLabels.get('mcep_s2_3'), None)
+        self.assertItemsEqual(mfile.macroToLabels.keys(),
+                              ['dur_s2_1', 'mcep_s2_1', 'logF0_s2_1-2', 'mcep_s2_2'])
+        self.assertEqual(mfile.contextIndex.contextsOf('mcep_s2_2').tolist(), [1])
+        self.assertEqual(mfile.contextIndex.contextsOf('mcep_s2_3').tolist(), [])
+        # the macro definitions are still read
+        means = mfile.pmacroDict['mcep_s2_1'].mixtures[1].pdf.means
+        variances = (mfile.smacroDict['dur_s2_1'].state.streamInfoDict[1]
+                     .mixtures[1].pdf.variances)
+        self.assertTrue(isinstance(means, numpy.ndarray))
+        self.assertTrue(isinstance(variances, numpy.ndarray))
+        self.assertEqual(means.tolist(), [1.0, 2.0])
+        self.assertEqual(variances.tolist(), [7.0])
+
+    def testLoadFullMMFTwice(self):
+        mfile = mmfsimple.HTSMMF()
+        mfile.loadFullMMF(self.filename)
+        first = mfile.labelList[0]
+        mfile.loadFullMMF(self.filename)
+        # like before the index, the contexts of the second file are added
+        self.assertEqual(len(mfile.labelList), 6)
+        self.assertEqual([ l.number for l in mfile.macroToLabels['mcep_s2_1'] ], [0, 2, 3, 5])
+        self.assertEqual(mfile.contextIndex.contextsOf('dur_s2_1').tolist(), [0, 3])
+        self.assertEqual(first.associatedMacroNames, ['dur_s2_1', 'mcep_s2_1', 'logF0_s2_1-2'])
+        self.assertEqual(mfile.labelList[4].associatedMacroNames, ['mcep_s2_2', 'logF0_s2_1-2'])
+
+    def testLoadMonoMMF(self):
+        filename = os.path.join(self.dir, 'mono.mmf')
+        f = open(filename, 'wb')
+        f.write(SAMPLE_MONO_MMF)
+        f.close()
+        mfile = mmfsimple.HTSMMF()
+        mfile.loadMonoMMF(filename)
+        self.assertEqual([ hmm.name for hmm in mfile.macroList ], ['A', 'B'])
+        self.assertTrue(mfile.macroDict['B'] is mfile.macroList[1])
+        self.assertEqual([ stream.getFullName() for stream in mfile.streamList ],
+                         ['A, state: 2, stream: 1', 'A, state: 2, stream: 2', 'B, state: 2, stream: 1'])
+        state = mfile.macroDict['A'].stateInfoDict[2]
+        pdf = state.streamInfoDict[1].mixtures[1].pdf
+        self.assertTrue(isinstance(pdf.means, numpy.ndarray))
+        self.assertEqual(pdf.means.tolist(), [1.0, -0.25])
+        self.assertEqual(pdf.variances.tolist(), [3.0, 4.0])
+        self.assertEqual(state.streamInfoDict[1].mixtures[1].weight, 1.0)
+        mixtures = state.streamInfoDict[2].mixtures
+        self.assertEqual([ mixtures[i].weight for i in (1, 2) ], [0.9, 0.1])
+        self.assertEqual(mixtures[1].pdf.means.tolist(), [4.5])
+        self.assertEqual(mixtures[1].pdf.variances.tolist(), [0.02])
+        # unvoiced space of the msd stream: no pdf
+        self.assertEqual(mixtures[2].pdf, None)
+        self.assertEqual(mfile.macroDict['B'].stateInfoDict[2].streamInfoDict[1]
+                         .mixtures[1].pdf.means.tolist(), [6.0, 7.0])
+
+    def testLoadMonoMMFErrors(self):
+        filename = os.path.join(self.dir, 'mono.mmf')
+        f = open(filename, 'wb')
+        f.write(SAMPLE_MONO_MMF.replace('-2.500000e-01', '-2.5x'))
+        f.close()
+        self.assertRaises(ValueError, mmfsimple.HTSMMF().loadMonoMMF, filename)
+
+if __name__ == '__main__':
+    unittest.main()
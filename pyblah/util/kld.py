@@ -2,38 +2,45 @@
 
 import math
 
+import numpy
+
+# the parameters may be stored in float16/float32 (see mmf.MMF dtype),
+# the divergences are always computed in float64
+
 def spectrumKLD(means1, vars1, means2, vars2):
     '''
     Calculates KLD for spectral/cepstral distributions
     '''
     lp = min(len(means1), len(means2))
-    flTmp = 0.0
-    
-    for i in range(lp):
-        flTmp += ((1 / vars1[i] + 1 / vars2[i]) * (means1[i] - means2[i]) * (means1[i] - means2[i]) + 
-                   vars1[i] / vars2[i] + vars2[i] / vars1[i]);        
-        
-    return flTmp / 2 - lp
-        
+    means1, vars1, means2, vars2 = [ numpy.asarray(values, dtype=numpy.float64)[:lp]
+                                     for values in (means1, vars1, means2, vars2) ]
+    diff = means1 - means2
+    flTmp = ((1 / vars1 + 1 / vars2) * diff * diff + vars1 / vars2 + vars2 / vars1).sum()
+
+    return float(flTmp) / 2 - lp
+
 
 def pitchKLD( weight1, means1, vars1, weight2, means2, vars2 ):
+    weight1, mean1, var1 = float(weight1), float(means1[0]), float(vars1[0])
+    weight2, mean2, var2 = float(weight2), float(means2[0]), float(vars2[0])
     return ( math.log ( weight1 / weight2 * (1-weight2) / (1-weight1) )
                  * (weight1 - weight2) + 0.5 * (weight1 - weight2)
-                 * math.log( vars2[0] / vars1[0] ) + 0.5 * (means1[0] - means2[0]) * (means1[0] - means2[0])
-                 * (weight1 / vars2[0] + weight2 / vars1[0]) - 0.5 * (weight1 + weight2)
-                 + 0.5 * ( weight1 * vars1[0] / vars2[0] + weight2 * vars2[0] / vars1[0] ) )
+                 * math.log( var2 / var1 ) + 0.5 * (mean1 - mean2) * (mean1 - mean2)
+                 * (weight1 / var2 + weight2 / var1) - 0.5 * (weight1 + weight2)
+                 + 0.5 * ( weight1 * var1 / var2 + weight2 * var2 / var1 ) )
 
 
 def bndapKLD( means1, vars1, means2, vars2 ):
-    flTmp = 0.0
-    for i in range(len(means1)):
-        flTmp += ( (1.0 / vars1[i] + 1.0 / vars2[i]) * (means1[i] - means2[i]) * (means1[i] - means2[i])
-                 + vars1[i] / vars2[i] + vars2[i] / vars1[i] )        
-    
-    return flTmp / 2.0 - len(means1);
+    means1, vars1, means2, vars2 = [ numpy.asarray(values, dtype=numpy.float64)
+                                     for values in (means1, vars1, means2, vars2) ]
+    diff = means1 - means2
+    flTmp = ((1.0 / vars1 + 1.0 / vars2) * diff * diff + vars1 / vars2 + vars2 / vars1).sum()
+
+    return float(flTmp) / 2.0 - len(means1);
 
 
 def durationKLD(mean1, var1, mean2, var2):
+    mean1, var1, mean2, var2 = float(mean1), float(var1), float(mean2), float(var2)
     return (math.log(var2 / var1) + 
            (math.pow(var1, 2) + math.pow(mean1 - mean2, 2)) / (2*math.pow(var2,2)) 
               - 0.5